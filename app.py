@@ -1,6 +1,8 @@
-from flask_server import flask_server, db
+from flask_server import create_app, db
 from flask_server.models import User, Post
 
+flask_server = create_app()
+
 
 @flask_server.shell_context_processor
 def make_shell_context():
@@ -1,16 +1,114 @@
 import os
-import random
-import string
+import secrets
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-rand_string = "".join(
-    random.choice(string.ascii_uppercase + string.digits) for _ in range(30)
-)
+
+def _secret_key():
+    """ Every worker must sign sessions with the same key.
+
+    A key generated per process logs users out whenever a request lands on a
+    different gunicorn worker, so without `SECRET_KEY` in the environment we
+    generate one once and keep it next to the app.
+    """
+    if os.environ.get("SECRET_KEY"):
+        return os.environ["SECRET_KEY"]
+    path = os.path.join(basedir, ".secret_key")
+    try:
+        if not os.path.exists(path):
+            _create_secret_key(path)
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        # Read-only checkout: sessions only survive within this process.
+        return secrets.token_hex(32)
+
+
+def _create_secret_key(path):
+    # Written privately under a temporary name, then linked into place: linking
+    # fails if another worker got there first, and nobody reads half a key.
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    fd = os.open(tmp, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+        os.link(tmp, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.unlink(tmp)
 
 
 class Config(object):
-    SECRET_KEY = os.environ.get("SECRET_KEY") or rand_string
+    SECRET_KEY = _secret_key()
     SQLALCHEMY_DATABASE_URI = os.environ.get("SQLALCHEMY_DATABASE_URI")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     POSTS_PER_PAGE = 2
+    # Cards per request when script.js appends more while scrolling.
+    POSTS_PER_FRAGMENT = 10
+    # Load templates and configure mappers in create_app(), before gunicorn forks.
+    WARMUP_ON_STARTUP = True
+    # Compiled template bytecode shared by all processes; empty to disable.
+    TEMPLATE_CACHE_DIR = os.environ.get(
+        "TEMPLATE_CACHE_DIR", os.path.join(basedir, "template-cache")
+    )
+    # Comma-separated; posts and follow edges of user N live on shard N % len.
+    SHARD_DATABASE_URIS = [
+        uri for uri in os.environ.get("SHARD_DATABASE_URIS", "").split(",") if uri
+    ]
+    # Show each video once on /discover, with its latest post.
+    DISCOVER_COLLAPSE_VIDEOS = True
+    # How long /discover and profile pages reuse the posts they list; 0 disables.
+    PAGE_CACHE_SECONDS = 10
+    # Set to share cached pages (and coalesce misses) across this host's workers;
+    # created private (0700), since entries are pickled.
+    PAGE_CACHE_DIR = os.environ.get("PAGE_CACHE_DIR")
+    # API bearer tokens expire after this long; a revocation reaches every
+    # worker within API_TOKEN_VERSION_SECONDS.
+    API_TOKEN_SECONDS = 3600
+    API_TOKEN_VERSION_SECONDS = 30
+    # Stop sending statements after this many consecutive database errors or
+    # slow statements, and check again in the background after a while.
+    BREAKER_FAILURES = 5
+    BREAKER_SLOW_SECONDS = 2.0
+    BREAKER_RESET_SECONDS = 15.0
+    # Last good renders kept per worker, served while the breaker is open.
+    BREAKER_STALE_PAGES = 1000
+    # Comma-separated usernames allowed on /admin and to profile requests.
+    ADMIN_USERNAMES = [
+        name for name in os.environ.get("ADMIN_USERNAMES", "").split(",") if name
+    ]
+    PROFILER_INTERVAL = 0.005
+    PROFILER_MAX_SECONDS = 60
+    PROFILER_MAX_DEPTH = 64
+    PROFILE_DIR = os.environ.get("PROFILE_DIR") or os.path.join(basedir, "profiles")
+    # Rows `flask analytics refresh` reads into memory at a time.
+    ANALYTICS_CHUNK_SIZE = 10000
+    # Tune a file SQLALCHEMY_DATABASE_URI for serving, see flask_server/sqlite.py.
+    SQLITE_WAL = bool(os.environ.get("SQLITE_WAL"))
+    SQLITE_PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "cache_size": -20000,  # KiB
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    }
+    # Connections per worker; SQLite itself admits one writer at a time.
+    SQLITE_WRITERS = 2
+    SQLITE_READERS = 8
+    ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "365"))
+    # "local" or a redis:// URL shared by all workers, see flask_server/pubsub.py.
+    PUBSUB_TRANSPORT = os.environ.get("PUBSUB_TRANSPORT", "local")
+    SSE_BUFFER_SIZE = 64
+    SSE_HEARTBEAT_SECONDS = 15
+    # How often each worker writes its batched post view counts.
+    VIEW_FLUSH_SECONDS = 30
+    BLOOM_ERROR_RATE = 0.01
+    BLOOM_REFRESH_SECONDS = 600
+    AVATAR_CACHE_DIR = os.environ.get("AVATAR_CACHE_DIR") or os.path.join(
+        basedir, "avatar-cache"
+    )
+    AVATAR_SIZES = (32, 64, 128, 256)
+    AVATAR_OFFLINE = bool(os.environ.get("AVATAR_OFFLINE"))
+    AVATAR_FETCH_TIMEOUT = 2
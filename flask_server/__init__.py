@@ -1,14 +1,116 @@
+import time
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
-from flask_login import LoginManager, login_required
+from flask_login import LoginManager
 from config import Config
 
-flask_server = Flask(__name__, static_folder="static")
-flask_server.config.from_object(Config)
-db = SQLAlchemy(flask_server)
-migrate = Migrate(flask_server, db)
-login = LoginManager(flask_server)
-login.login_view = "login"
+db = SQLAlchemy()
+migrate = Migrate()
+login = LoginManager()
+login.login_view = "main.login"
 
-from flask_server import routes, models, errors
+
+def create_app(config_class=Config):
+    """ Build and configure a Flask application.
+
+    Extensions are created once at import time but only bound here, so tests can
+    build isolated apps and gunicorn can build one in the master with
+    `--preload` and share it with its workers (see `flask_server/startup.py`).
+    """
+    started = time.perf_counter()
+    app = Flask(__name__, static_folder="static")
+    app.config.from_object(config_class)
+
+    db.init_app(app)
+
+    from flask_server import sqlite
+
+    sqlite.init_app(app)
+    migrate.init_app(app, db)
+    login.init_app(app)
+
+    from flask_server import breaker
+
+    breaker.init_app(app)
+
+    from flask_server.errors import bp as errors_bp
+
+    app.register_blueprint(errors_bp)
+
+    from flask_server.routes import bp as main_bp
+
+    app.register_blueprint(main_bp)
+
+    from flask_server.api import bp as api_bp
+
+    app.register_blueprint(api_bp)
+
+    from flask_server import tokens
+
+    tokens.init_app(app)
+
+    from flask_server import templating
+
+    templating.init_app(app)
+    app.cli.add_command(templating.templates_cli)
+
+    from flask_server.admin import bp as admin_bp
+
+    app.register_blueprint(admin_bp)
+
+    from flask_server import profiler
+
+    profiler.init_app(app)
+
+    from flask_server.sharding import shards
+
+    shards.init_app(app)
+
+    from flask_server import pubsub
+
+    pubsub.init_app(app)
+
+    from flask_server import viewcounts
+
+    viewcounts.init_app(app)
+
+    from flask_server import pagecache
+
+    pagecache.init_app(app)
+
+    from flask_server import bloom
+
+    bloom.init_app(app)
+
+    from flask_server import avatars
+
+    avatars.init_app(app)
+
+    from flask_server.bulk import data
+
+    app.cli.add_command(data)
+
+    from flask_server.archive import archive
+
+    app.cli.add_command(archive)
+
+    from flask_server.videos import videos_cli
+
+    app.cli.add_command(videos_cli)
+
+    from flask_server.analytics import analytics_cli
+
+    app.cli.add_command(analytics_cli)
+
+    from flask_server.bench import bench
+
+    app.cli.add_command(bench)
+
+    from flask_server import startup
+
+    startup.init_app(app, started)
+    return app
+
+
+from flask_server import models
@@ -0,0 +1,111 @@
+""" Pages and endpoints for the users listed in `ADMIN_USERNAMES`.
+
+Everyone else, logged in or not, gets a 404, so the URLs don't advertise that
+they exist.
+"""
+import os
+from functools import wraps
+
+from flask import (
+    Blueprint,
+    abort,
+    current_app,
+    flash,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    send_file,
+    url_for,
+)
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from flask_server import analytics
+from flask_server.forms import ProfileWindowForm
+from flask_server.profiler import is_admin, profiler
+
+bp = Blueprint("admin", __name__, url_prefix="/admin")
+
+
+def admin_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not is_admin(current_user):
+            abort(404)
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def _wants_html():
+    best = request.accept_mimetypes.best_match(["application/json", "text/html"])
+    return best == "text/html"
+
+
+@bp.route("/profiler", methods=["GET", "POST"])
+@admin_required
+def profiles():
+    """ GET lists saved profiles; POST `seconds=N` profiles this worker.
+
+    Browsers get a page with the form, other clients JSON. The POST needs the
+    form's CSRF token, like every form of the site; JSON clients find it in
+    the GET response. Answers 409 while this worker already runs a window.
+    """
+    form = ProfileWindowForm()
+    if not form.validate_on_submit():
+        status = 400 if request.method == "POST" else 200
+        if _wants_html():
+            page = render_template(
+                "profiler.html",
+                title="Profiler",
+                form=form,
+                profiles=profiler().profiles(),
+            )
+            return page, status
+        if status == 400:
+            return jsonify(error="Invalid form.", fields=form.errors), 400
+        return jsonify(profiles=profiler().profiles(), csrf_token=generate_csrf())
+    seconds = form.seconds.data if form.seconds.data is not None else 10
+    name = profiler().start_window(seconds)
+    if name is None:
+        if _wants_html():
+            flash("This worker is already profiling.")
+            return redirect(url_for("admin.profiles"))
+        return jsonify(error="This worker is already profiling."), 409
+    limit = current_app.config["PROFILER_MAX_SECONDS"]
+    seconds = min(seconds, limit)
+    if _wants_html():
+        flash("Profiling worker {} for {:g} seconds.".format(os.getpid(), seconds))
+        return redirect(url_for("admin.profiles"))
+    return jsonify(profile=name, pid=os.getpid(), seconds=seconds), 202
+
+
+@bp.route("/profiler/<name>")
+@admin_required
+def profile(name):
+    """ One saved profile, as collapsed stacks. """
+    if name not in profiler().profiles():
+        abort(404)
+    path = os.path.join(current_app.config["PROFILE_DIR"], name)
+    return send_file(path, mimetype="text/plain", cache_timeout=0)
+
+
+@bp.route("/analytics")
+@admin_required
+def analytics_report():
+    """ The engagement reports, as of the last `flask analytics refresh`.
+
+    See `flask_server/analytics.py`; `?days=` sets the period (default 30,
+    1 to 366 days). A refresh reads every new post, too much for a request,
+    so the page has no refresh button.
+    """
+    days = min(max(request.args.get("days", 30, type=int), 1), 366)
+    return render_template(
+        "analytics.html",
+        title="Analytics",
+        days=days,
+        last_refresh=analytics.last_refresh(),
+        posts_per_day=analytics.posts_per_day(days),
+        follower_growth=analytics.follower_growth(days),
+        top_posters=analytics.top_posters(),
+    )
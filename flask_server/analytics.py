@@ -0,0 +1,269 @@
+""" Engagement reports: posts per day, follower growth and the top posters.
+
+`flask analytics refresh` (run it from cron; /admin/analytics only shows the
+results) reads the `post`, `post_archive` and `followers` tables of every
+shard in chunks of `ANALYTICS_CHUNK_SIZE` rows, counts them with pandas
+group-bys, and folds the counts into small summary tables, which the reports
+read instead of the source tables:
+
+    analytics_day        posts published per day
+    analytics_user       posts per user, and their current followers
+    analytics_followers  followers per user on each day a refresh ran
+
+Posts are read once. `analytics_mark` keeps the highest post id summarized
+on each shard and a refresh only reads newer posts. That relies on post ids
+never being reused (`post` is AUTOINCREMENT, see `flask shards upgrade`):
+archived posts keep their id in `post_id`, so archiving doesn't count them
+twice, and deleting a post doesn't uncount it. `flask shards rebalance` gives
+the moved posts new ids, so rebuild the summaries after it. `followers` has no
+timestamps to resume from, so it is recounted every time, one narrow column;
+growth is the difference between the counts of two days.
+
+A refresh runs in one transaction on the main database that starts by
+writing the `refresh` row of `analytics_mark`, so concurrent refreshes run one
+after the other and each starts from the marks the previous one saved.
+
+    flask analytics refresh [--rebuild]
+    flask analytics report --days 30 --top 10
+"""
+from datetime import datetime, timedelta
+
+import click
+import pandas as pd
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, select, union_all
+from flask_server import db
+from flask_server.models import (
+    AnalyticsDay,
+    AnalyticsFollowers,
+    AnalyticsMark,
+    AnalyticsUser,
+    ArchivedPost,
+    Post,
+    User,
+    followers,
+)
+from flask_server.sharding import reuses_post_ids, shards
+from flask_server.sqlite import reader
+
+HOT, COLD, USERS = Post.__table__, ArchivedPost.__table__, User.__table__
+DAYS, USER_STATS = AnalyticsDay.__table__, AnalyticsUser.__table__
+FOLLOWER_HISTORY, MARKS = AnalyticsFollowers.__table__, AnalyticsMark.__table__
+
+# The `analytics_mark` row a refresh writes first, to lock out the others.
+LOCK = "refresh"
+
+analytics_cli = AppGroup("analytics", help="Refresh and print engagement reports.")
+
+
+def _frames(session, query, columns, chunk_size):
+    """ The rows of `query` as DataFrames of at most `chunk_size` rows. """
+    result = session.execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield pd.DataFrame.from_records(rows, columns=columns)
+    finally:
+        result.close()
+
+
+def _counts(result):
+    """ A two column result as a Series of the second indexed by the first. """
+    return pd.Series(dict(result.fetchall()), dtype="int64")
+
+
+def _posts_after(mark):
+    return union_all(
+        select([HOT.c.id, HOT.c.user_id, HOT.c.timestamp]).where(HOT.c.id > mark),
+        select([COLD.c.post_id, COLD.c.user_id, COLD.c.timestamp]).where(
+            COLD.c.post_id > mark
+        ),
+    )
+
+
+def _lock(session):
+    # A write, so SQLite takes its database write lock as well as the row lock
+    # of other databases. Two first refreshes both insert; one of them fails.
+    counter = MARKS.update().where(MARKS.c.name == LOCK)
+    if not session.execute(counter.values(last_key=MARKS.c.last_key + 1)).rowcount:
+        session.execute(MARKS.insert().values(name=LOCK, last_key=1))
+
+
+def refresh(chunk_size=None, rebuild=False):
+    """ Bring the summary tables up to date; returns how many posts were new.
+
+    Waits for a refresh running elsewhere to finish first. With `rebuild`, the
+    summaries are recounted from scratch.
+    """
+    chunk_size = chunk_size or current_app.config["ANALYTICS_CHUNK_SIZE"]
+    _lock(db.session)
+    if rebuild:
+        _clear(db.session)
+    query = select([MARKS.c.name, MARKS.c.last_key]).where(MARKS.c.name != LOCK)
+    marks = dict(db.session.execute(query).fetchall())
+    per_day, per_user = pd.Series(dtype="int64"), pd.Series(dtype="int64")
+    follower_counts = pd.Series(dtype="int64")
+    new_posts = 0
+    for index, session in enumerate(shards.read_sessions()):
+        name = "post:{}".format(index)
+        columns = ["id", "user_id", "timestamp"]
+        query = _posts_after(marks.get(name, 0))
+        for frame in _frames(session, query, columns, chunk_size):
+            days = pd.to_datetime(frame["timestamp"]).dt.date
+            per_day = per_day.add(days.value_counts(), fill_value=0)
+            per_user = per_user.add(frame["user_id"].value_counts(), fill_value=0)
+            marks[name] = max(marks.get(name, 0), int(frame["id"].max()))
+            new_posts += len(frame)
+        query = select([followers.c.followed_id])
+        for frame in _frames(session, query, ["user_id"], chunk_size):
+            follower_counts = follower_counts.add(
+                frame["user_id"].value_counts(), fill_value=0
+            )
+    _save(per_day, per_user, follower_counts, marks)
+    return new_posts
+
+
+def _save(per_day, per_user, follower_counts, marks):
+    session, now = db.session, datetime.utcnow()
+    if len(per_day):
+        days = list(per_day.index)
+        query = select([DAYS.c.day, DAYS.c.posts]).where(DAYS.c.day.in_(days))
+        per_day = per_day.add(_counts(session.execute(query)), fill_value=0)
+        session.execute(DAYS.delete().where(DAYS.c.day.in_(days)))
+        session.execute(
+            DAYS.insert(),
+            [{"day": day, "posts": int(posts)} for day, posts in per_day.items()],
+        )
+
+    query = select([USER_STATS.c.user_id, USER_STATS.c.posts])
+    posts = _counts(session.execute(query)).add(per_user, fill_value=0)
+    stats = pd.DataFrame({"posts": posts, "followers": follower_counts})
+    stats = stats.fillna(0).astype("int64")
+    session.execute(USER_STATS.delete())
+    if len(stats):
+        session.execute(
+            USER_STATS.insert(),
+            [
+                {
+                    "user_id": int(user_id),
+                    "posts": int(row.posts),
+                    "followers": int(row.followers),
+                    "updated_at": now,
+                }
+                for user_id, row in stats.iterrows()
+            ],
+        )
+
+    today = now.date()
+    session.execute(FOLLOWER_HISTORY.delete().where(FOLLOWER_HISTORY.c.day == today))
+    if len(follower_counts):
+        session.execute(
+            FOLLOWER_HISTORY.insert(),
+            [
+                {"day": today, "user_id": int(user_id), "followers": int(count)}
+                for user_id, count in follower_counts.items()
+            ],
+        )
+
+    session.execute(MARKS.delete().where(MARKS.c.name != LOCK))
+    if marks:
+        session.execute(
+            MARKS.insert(),
+            [{"name": name, "last_key": key} for name, key in marks.items()],
+        )
+    session.commit()
+
+
+def _clear(session):
+    for table in (DAYS, USER_STATS, FOLLOWER_HISTORY):
+        session.execute(table.delete())
+    session.execute(MARKS.delete().where(MARKS.c.name != LOCK))
+
+
+def clear():
+    """ Empty the summary tables, so the next refresh starts from scratch. """
+    _clear(db.session)
+    db.session.commit()
+
+
+def last_refresh():
+    """ When the summaries were last refreshed, or `None`. """
+    return reader().execute(select([func.max(USER_STATS.c.updated_at)])).scalar()
+
+
+def posts_per_day(days=30):
+    """ Posts per day over the last `days` days, oldest first, gaps as zeros. """
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    query = select([DAYS.c.day, DAYS.c.posts]).where(DAYS.c.day >= since)
+    counts = _counts(reader().execute(query))
+    return counts.reindex(pd.date_range(since, periods=days).date, fill_value=0)
+
+
+def follower_growth(days=30):
+    """ Total followers on each refreshed day of the last `days` days. """
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    query = (
+        select([FOLLOWER_HISTORY.c.day, func.sum(FOLLOWER_HISTORY.c.followers)])
+        .where(FOLLOWER_HISTORY.c.day >= since)
+        .group_by(FOLLOWER_HISTORY.c.day)
+        .order_by(FOLLOWER_HISTORY.c.day)
+    )
+    return _counts(reader().execute(query))
+
+
+def top_posters(limit=10, days=7):
+    """ The most-followed posters, with their follower growth over `days` days.
+
+    Growth is counted from the last refresh at least `days` days ago, or from
+    the first refresh if there was none that early.
+    """
+    columns = [USERS.c.id, USERS.c.username, USER_STATS.c.posts]
+    query = (
+        select(columns + [USER_STATS.c.followers])
+        .select_from(USERS.join(USER_STATS, USER_STATS.c.user_id == USERS.c.id))
+        .where(USERS.c.poster.is_(True))
+    )
+    stats = pd.DataFrame.from_records(
+        reader().execute(query).fetchall(),
+        columns=["user_id", "username", "posts", "followers"],
+    )
+    day, cutoff = FOLLOWER_HISTORY.c.day, datetime.utcnow().date() - timedelta(days)
+    baseline = reader().execute(select([func.max(day)]).where(day <= cutoff)).scalar()
+    if baseline is None:
+        baseline = reader().execute(select([func.min(day)])).scalar()
+    query = select([FOLLOWER_HISTORY.c.user_id, FOLLOWER_HISTORY.c.followers])
+    before = _counts(reader().execute(query.where(day == baseline)))
+    stats["growth"] = stats["followers"] - stats["user_id"].map(before).fillna(0)
+    stats["growth"] = stats["growth"].astype("int64")
+    stats = stats.sort_values(["followers", "posts"], ascending=False).head(limit)
+    return stats.set_index("username")[["posts", "followers", "growth"]]
+
+
+@analytics_cli.command("refresh")
+@click.option("--chunk-size", type=int, help="Rows read at a time.")
+@click.option(
+    "--rebuild", is_flag=True, help="Forget the summaries and recount all posts."
+)
+def refresh_command(chunk_size, rebuild):
+    """Fold the posts and follows since the last refresh into the summaries."""
+    for i, engine in enumerate(shards.engines()):
+        # A reused id is at or below the mark, so its post would be skipped.
+        if reuses_post_ids(engine):
+            raise click.ClickException(
+                "Post ids on shard {} can be reused; run `flask db upgrade` "
+                "and `flask shards upgrade` first.".format(i)
+            )
+    click.echo("{} new posts".format(refresh(chunk_size, rebuild)))
+
+
+@analytics_cli.command("report")
+@click.option("--days", default=30, show_default=True)
+@click.option("--top", default=10, show_default=True)
+def report_command(days, top):
+    """Print posts per day, follower growth and the most-followed posters."""
+    click.echo("Posts per day\n{}\n".format(posts_per_day(days).to_string()))
+    click.echo("Followers\n{}\n".format(follower_growth(days).to_string()))
+    click.echo("Top posters\n{}".format(top_posters(top).to_string()))
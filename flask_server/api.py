@@ -0,0 +1,122 @@
+from flask import Blueprint, current_app, g, jsonify, request
+from flask_server import readmodel, tokens
+from flask_server.admin import admin_required
+from flask_server.bloom import usernames
+from flask_server.models import User
+from flask_server.pagecache import cache
+from flask_server.tokens import token_required
+from flask_server.viewcounts import author_views, post_views
+
+bp = Blueprint("api", __name__, url_prefix="/api/v1")
+bp.before_request(tokens.authenticate)
+
+
+@bp.route("/username-available")
+def username_available():
+    """ Live availability check for the registration and profile forms.
+
+    Takes `?username=` and answers `{"username": "john", "available": false}`.
+    Names the Bloom filter has never seen are answered without touching the
+    database. There is no check for emails, see `flask_server/bloom.py`.
+    """
+    username = request.args.get("username", "").strip()
+    if not username:
+        return jsonify(error="Pass a username."), 400
+    return jsonify(username=username, available=not usernames().is_taken(username))
+
+
+@bp.route("/users/<username>/views")
+def user_views(username):
+    """ Views of all of a user's posts: `{"views", "viewers", "posts"}`.
+
+    `viewers` estimates distinct viewers across the posts. Counts lag by up to
+    `VIEW_FLUSH_SECONDS`, see `flask_server/viewcounts.py`.
+    """
+    user = User.query.filter_by(username=username).first_or_404()
+    return jsonify(author_views(user.id))
+
+
+@bp.route("/users/<username>/posts/<int:post_id>/views")
+def user_post_views(username, post_id):
+    """ Views and estimated distinct viewers of one post. """
+    user = User.query.filter_by(username=username).first_or_404()
+    return jsonify(post_views(user.id, post_id))
+
+
+@bp.route("/cache")
+@admin_required
+def cache_stats():
+    """ This worker's page cache counters since it started.
+
+    `coalesced` counts requests that waited for another request's computation
+    instead of querying; `coalesced_across_workers` those that found the value
+    another worker computed while they waited for its lock.
+    """
+    return jsonify(dict(cache().stats))
+
+
+@bp.route("/tokens", methods=["POST"])
+def create_token():
+    """ A bearer token for the user of the basic auth credentials.
+
+    `scope` is "read" (the default) or "read write"; see
+    `flask_server/tokens.py`.
+    """
+    auth = request.authorization
+    user = User.query.filter_by(username=auth.username).first() if auth else None
+    if user is None or not user.check_password(auth.password):
+        response = jsonify(error="Invalid username or password.")
+        response.status_code = 401
+        response.headers["WWW-Authenticate"] = 'Basic realm="api"'
+        return response
+    requested = request.values.get("scope", "read").split()
+    scopes = [scope for scope in tokens.SCOPES if scope in requested]
+    if not scopes:
+        return jsonify(error="Unknown scope."), 400
+    return jsonify(
+        token=tokens.issue(user, scopes),
+        expires_in=current_app.config["API_TOKEN_SECONDS"],
+        scopes=scopes,
+    )
+
+
+@bp.route("/tokens", methods=["DELETE"])
+@token_required("write")
+def revoke_tokens():
+    """ Revoke every token of the token's user, this one included. """
+    user = User.query.get(g.api_user.id)
+    # Workers keep accepting a deleted user's tokens until their version expires.
+    if user is None:
+        return tokens.unauthorized("The token's user no longer exists.")
+    tokens.revoke(user)
+    return "", 204
+
+
+@bp.route("/feed")
+@token_required("read")
+def feed():
+    """ The token user's feed, `POSTS_PER_FRAGMENT` posts at a time.
+
+    Answers `{"posts": [...], "next_cursor": "..."}`; pass `?cursor=` to get the
+    posts after those. `next_cursor` is null after the last post.
+    """
+    try:
+        cursor = request.args.get("cursor")
+        kinds = (readmodel.HOT_KIND,)
+        cursor = readmodel.decode_cursor(cursor, kinds) if cursor else None
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    limit = current_app.config["POSTS_PER_FRAGMENT"]
+    cards, next_cursor = readmodel.feed_after(g.api_user, cursor, limit)
+    posts = [
+        {
+            "id": card.post_id,
+            "author": card.author.username,
+            "url": card.url,
+            "video_id": card.video_id,
+            "body": card.body,
+            "timestamp": card.timestamp.isoformat() if card.timestamp else None,
+        }
+        for card in cards
+    ]
+    return jsonify(posts=posts, next_cursor=next_cursor)
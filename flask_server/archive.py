@@ -0,0 +1,134 @@
+""" Moves old posts out of the hot `post` table into `post_archive`.
+
+Nearly every read is for recent posts, but `post` and its indexes grow forever.
+Run the job from a scheduler (cron, Heroku Scheduler, ...):
+
+    flask archive run                   # posts older than ARCHIVE_AFTER_DAYS
+    flask archive run --days 90
+    flask archive stats
+
+Posts are moved in primary-key order, `--batch-size` at a time, each batch in
+its own short transaction, on every shard. Profile pages keep paginating into
+the archive (see `ShardRouter.user_posts`), so nothing disappears for users.
+"""
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, select, text
+from flask_server import db
+from flask_server.models import Post, ArchivedPost
+from flask_server.sharding import reuses_post_ids, shards
+from flask_server.videos import refresh
+
+archive = AppGroup("archive", help="Move old posts into the archive table.")
+
+HOT, COLD = Post.__table__, ArchivedPost.__table__
+ARCHIVED_COLUMNS = ["post_id", "url", "body", "timestamp", "user_id", "video_id"]
+
+
+def archive_posts(engine, cutoff, batch_size=1000, videos=None):
+    """ Move posts older than `cutoff` from `post` to `post_archive`.
+
+    Returns the number of posts moved, and adds their video ids to the set
+    `videos` if one is given.
+    """
+    moved = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                select([HOT.c.id, HOT.c.video_id])
+                .where(HOT.c.timestamp < cutoff)
+                .order_by(HOT.c.id)
+                .limit(batch_size)
+            ).fetchall()
+            if not rows:
+                return moved
+            ids = [row.id for row in rows]
+            if videos is not None:
+                videos.update(row.video_id for row in rows if row.video_id)
+            # `post.id` lands in `post_archive.post_id`; the names match otherwise.
+            columns = [HOT.c.id] + [HOT.c[name] for name in ARCHIVED_COLUMNS[1:]]
+            connection.execute(
+                COLD.insert().from_select(
+                    ARCHIVED_COLUMNS, select(columns).where(HOT.c.id.in_(ids))
+                )
+            )
+            connection.execute(HOT.delete().where(HOT.c.id.in_(ids)))
+        moved += len(ids)
+
+
+def table_sizes(engine, tables=(HOT, COLD)):
+    """ Row count and, where the backend reports it, data/index bytes per table. """
+    sizes = {}
+    with engine.connect() as connection:
+        for table in tables:
+            count = select([func.count()]).select_from(table)
+            sizes[table.name] = {"rows": connection.execute(count).scalar()}
+            sizes[table.name].update(_storage(connection, table.name))
+    return sizes
+
+
+def _storage(connection, name):
+    dialect = connection.dialect.name
+    try:
+        if dialect == "sqlite":
+            # Needs SQLite built with the dbstat virtual table.
+            query = (
+                "SELECT (SELECT SUM(pgsize) FROM dbstat WHERE name = :name), "
+                "(SELECT SUM(pgsize) FROM dbstat WHERE name IN (SELECT name "
+                "FROM sqlite_master WHERE type = 'index' AND tbl_name = :name))"
+            )
+        elif dialect == "mysql":
+            query = (
+                "SELECT data_length, index_length FROM information_schema.tables "
+                "WHERE table_schema = DATABASE() AND table_name = :name"
+            )
+        elif dialect == "postgresql":
+            query = "SELECT pg_relation_size(:name), pg_indexes_size(:name)"
+        else:
+            return {}
+        data, indexes = connection.execute(text(query), name=name).first()
+    except Exception:
+        return {}
+    return {"data_bytes": int(data or 0), "index_bytes": int(indexes or 0)}
+
+
+def _echo_sizes(label):
+    for i, engine in enumerate(shards.engines()):
+        for name, size in table_sizes(engine).items():
+            details = ", ".join("{}={}".format(k, v) for k, v in sorted(size.items()))
+            click.echo("{} shard {} {}: {}".format(label, i, name, details))
+
+
+@archive.command("run")
+@click.option("--days", type=int, help="Archive posts older than this.")
+@click.option("--batch-size", default=1000, show_default=True)
+def run_command(days, batch_size):
+    """Move posts older than --days into the archive on every shard."""
+    if days is None:
+        days = current_app.config["ARCHIVE_AFTER_DAYS"]
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    for i, engine in enumerate(shards.engines()):
+        # Archiving the newest posts would hand their ids, kept in
+        # `post_archive.post_id` and `post_stats`, to the next new posts.
+        if reuses_post_ids(engine):
+            raise click.ClickException(
+                "Post ids on shard {} can be reused; run `flask db upgrade` "
+                "and `flask shards upgrade` first.".format(i)
+            )
+    _echo_sizes("before")
+    videos = set()
+    for i, engine in enumerate(shards.engines()):
+        moved = archive_posts(engine, cutoff, batch_size, videos)
+        click.echo("shard {}: archived {} posts older than {}".format(i, moved, cutoff))
+    # Their latest post may have been archived.
+    refresh(db.session, videos)
+    _echo_sizes("after")
+
+
+@archive.command("stats")
+def stats_command():
+    """Show row counts and sizes of the hot and archive tables."""
+    _echo_sizes("current")
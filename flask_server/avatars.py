@@ -0,0 +1,138 @@
+""" Local avatar proxy backed by a content-addressed disk cache.
+
+Pages link to `/avatar/<user_id>/<size>?v=<digest>` instead of gravatar.com. The
+first request for a (digest, size) pair asks the fetcher for an image of exactly
+that size, stores the bytes under their sha256 and records which blob belongs
+to the pair; every later request, in any worker, is served from disk:
+
+    <AVATAR_CACHE_DIR>/blobs/<sha256>           image bytes
+    <AVATAR_CACHE_DIR>/refs/<digest>-<size>     "<sha256> <mimetype>"
+
+The fetcher is any callable `fetcher(user, size) -> (bytes, mimetype) or None`.
+The default one downloads from gravatar; with `AVATAR_OFFLINE` set an identicon
+is drawn locally instead. When a download fails the identicon is served but not
+recorded, so the next request tries the fetcher again.
+"""
+import hashlib
+import os
+import struct
+import urllib.request
+import zlib
+from collections import namedtuple
+from functools import lru_cache
+
+# `fallback` avatars stand in for one that couldn't be fetched this time.
+Avatar = namedtuple("Avatar", ["path", "sha", "mimetype", "fallback"])
+
+
+@lru_cache(maxsize=4096)
+def email_digest(email):
+    """ The gravatar md5 of `email`, computed once per address. """
+    return hashlib.md5(email.lower().encode("utf-8")).hexdigest()
+
+
+def fetch_gravatar(user, size, timeout=2):
+    with urllib.request.urlopen(user.avatar(size), timeout=timeout) as response:
+        return response.read(), response.headers.get_content_type()
+
+
+def identicon(digest, size):
+    """ Draw a 5x5 mirrored identicon for `digest` as a `size` x `size` PNG. """
+    foreground = tuple(int(digest[i : i + 2], 16) for i in (0, 2, 4))
+    background = (240, 240, 240)
+    bits = int(digest[6:14], 16)
+    # 15 bits fill the left three columns; the right two mirror them.
+    cells = [
+        [bool(bits >> (row * 3 + min(col, 4 - col)) & 1) for col in range(5)]
+        for row in range(5)
+    ]
+    cell = max(size // 6, 1)
+    margin = (size - cell * 5) // 2
+
+    rows = []
+    for y in range(size):
+        grid_y = (y - margin) // cell
+        row = bytearray(b"\x00")  # PNG filter type: none
+        for x in range(size):
+            grid_x = (x - margin) // cell
+            on = 0 <= grid_x < 5 and 0 <= grid_y < 5 and cells[grid_y][grid_x]
+            row.extend(foreground if on else background)
+        rows.append(bytes(row))
+    return _png(size, size, b"".join(rows))
+
+
+def _png(width, height, raw):
+    def chunk(kind, data):
+        body = kind + data
+        crc = struct.pack(">I", zlib.crc32(body))
+        return struct.pack(">I", len(data)) + body + crc
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(raw, 9))
+        + chunk(b"IEND", b"")
+    )
+
+
+class AvatarStore(object):
+    def __init__(self, directory, fetcher=None):
+        self.directory = directory
+        self.fetcher = fetcher
+        for name in ("blobs", "refs"):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    def blob_path(self, sha):
+        return os.path.join(self.directory, "blobs", sha)
+
+    def _ref_path(self, digest, size):
+        return os.path.join(self.directory, "refs", "{}-{}".format(digest, size))
+
+    def get(self, user, size):
+        """ Return the `Avatar` of `user` at `size`, fetching it on a miss. """
+        digest = email_digest(user.email)
+        ref = self._ref_path(digest, size)
+        try:
+            with open(ref) as f:
+                sha, mimetype = f.read().split()
+            return Avatar(self.blob_path(sha), sha, mimetype, False)
+        except (OSError, ValueError):
+            pass
+
+        image, fallback = None, False
+        if self.fetcher is not None:
+            try:
+                image = self.fetcher(user, size)
+            except Exception:
+                image = None
+            fallback = image is None
+        if image is None:
+            image = identicon(digest, size), "image/png"
+        data, mimetype = image
+
+        sha = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(sha)
+        if not os.path.exists(path):
+            _write_atomic(path, data)
+        if not fallback:
+            _write_atomic(ref, "{} {}".format(sha, mimetype).encode("utf-8"))
+        return Avatar(path, sha, mimetype, fallback)
+
+
+def _write_atomic(path, data):
+    # Concurrent workers may fill the same entry; rename makes the last one win
+    # without anyone ever reading a half-written file.
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def init_app(app):
+    if app.config["AVATAR_OFFLINE"]:
+        fetcher = None
+    else:
+        timeout = app.config["AVATAR_FETCH_TIMEOUT"]
+        fetcher = lambda user, size: fetch_gravatar(user, size, timeout)
+    app.extensions["avatars"] = AvatarStore(app.config["AVATAR_CACHE_DIR"], fetcher)
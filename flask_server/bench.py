@@ -0,0 +1,264 @@
+""" Micro-benchmarks run against the configured database.
+
+    flask bench pages                       # ORM vs read model for list pages
+    flask bench pages --username john --page 3 --repeat 200
+    flask bench templates                   # first request after a restart
+    flask bench sqlite --workers 4          # SQLite under concurrent workers
+
+Each page measurement starts from empty sessions, like a request would, and
+reads the fields a post card renders. `bench sqlite` doesn't touch the
+configured database; it works on copies of a seeded test snapshot.
+"""
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from flask_server import create_app, db, readmodel
+from flask_server.models import User
+from flask_server.sharding import shards
+
+bench = AppGroup("bench", help="Measure the cost of hot code paths.")
+
+
+def _fresh_sessions():
+    db.session.remove()
+    for session in shards.sessions():
+        session.remove()
+
+
+def _render_fields(posts):
+    return [(p.id, p.url, p.body, p.author.id, p.author.username) for p in posts.items]
+
+
+def measure(func, repeat):
+    """ Mean CPU seconds per call, and peak bytes allocated by one call. """
+    cpu = 0.0
+    for _ in range(repeat):
+        _fresh_sessions()
+        started = time.process_time()
+        func()
+        cpu += time.process_time() - started
+    _fresh_sessions()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return cpu / repeat, peak
+
+
+@bench.command("pages")
+@click.option("--username", help="Whose feed and profile to load.")
+@click.option("--page", default=1, show_default=True)
+@click.option("--per-page", default=20, show_default=True)
+@click.option("--repeat", default=50, show_default=True)
+def pages_command(username, page, per_page, repeat):
+    """Compare the ORM and read-model queries of the list pages."""
+    query = User.query.order_by(User.id)
+    user = (query.filter_by(username=username) if username else query).first()
+    if user is None:
+        raise click.ClickException("No such user.")
+    user_id = user.id
+
+    def current_user():
+        # Reloaded per call, since every measurement starts with empty sessions.
+        return User.query.get(user_id)
+
+    paths = [
+        ("discover", shards.discover, readmodel.discover, lambda: ()),
+        ("feed", shards.feed, readmodel.feed, lambda: (current_user(),)),
+        ("user", shards.user_posts, readmodel.user_posts, lambda: (current_user(),)),
+    ]
+    click.echo(
+        "{:<10}{:>12}{:>12}{:>14}{:>14}".format(
+            "page", "orm ms", "core ms", "orm KiB", "core KiB"
+        )
+    )
+    for name, orm, core, args in paths:
+        results = [
+            measure(
+                lambda fetch=fetch: _render_fields(fetch(*args(), page, per_page)),
+                repeat,
+            )
+            for fetch in (orm, core)
+        ]
+        (orm_cpu, orm_peak), (core_cpu, core_peak) = results
+        click.echo(
+            "{:<10}{:>12.2f}{:>12.2f}{:>14.1f}{:>14.1f}".format(
+                name,
+                orm_cpu * 1000,
+                core_cpu * 1000,
+                orm_peak / 1024.0,
+                core_peak / 1024.0,
+            )
+        )
+
+
+def _first_request(settings, path):
+    """ Seconds to build an app with `settings`, and to serve its first request. """
+    started = time.perf_counter()
+    app = create_app(type("BenchConfig", (object,), settings))
+    built = time.perf_counter()
+    response = app.test_client().get(path)
+    served = time.perf_counter()
+    db.get_engine(app).dispose()
+    shards.dispose(app)
+    if response.status_code != 200:
+        raise click.ClickException("{} returned {}".format(path, response.status))
+    return built - started, served - built
+
+
+@bench.command("templates")
+@click.option("--path", default="/login", show_default=True)
+@click.option("--repeat", default=5, show_default=True)
+def templates_command(path, repeat):
+    """Compare the first request with cold, cached and preloaded templates."""
+    directory = tempfile.mkdtemp(prefix="argus-templates-")
+    config = lambda cache, warmup: dict(
+        current_app.config, TEMPLATE_CACHE_DIR=cache, WARMUP_ON_STARTUP=warmup
+    )
+    scenarios = [
+        ("cold", config("", False)),
+        ("bytecode", config(directory, False)),
+        ("warmed", config(directory, True)),
+    ]
+    try:
+        _first_request(scenarios[2][1], path)  # fills the bytecode cache
+        click.echo(
+            "{:<10}{:>16}{:>20}".format(
+                "templates", "create_app ms", "first request ms"
+            )
+        )
+        for name, settings in scenarios:
+            timings = [_first_request(settings, path) for _ in range(repeat)]
+            click.echo(
+                "{:<10}{:>16.1f}{:>20.1f}".format(
+                    name,
+                    statistics.median(t[0] for t in timings) * 1000,
+                    statistics.median(t[1] for t in timings) * 1000,
+                )
+            )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def _traffic(settings, user, seconds, write_ratio, seed):
+    """ What one worker serves: `/create` with `write_ratio`, `/feed` otherwise. """
+    from flask_server.testing import SNAPSHOT_PASSWORD
+
+    app = create_app(type("BenchConfig", (object,), settings))
+    client = app.test_client()
+    client.post("/login", data={"username": user, "password": SNAPSHOT_PASSWORD})
+    rng = random.Random(seed)
+    result = {"read": [], "write": [], "errors": 0}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        write = rng.random() < write_ratio
+        started = time.perf_counter()
+        if write:
+            video = "{:011d}".format(rng.randrange(10 ** 6))
+            response = client.post("/create", data={"url": video, "body": "bench"})
+        else:
+            response = client.get("/feed")
+        result["write" if write else "read"].append(time.perf_counter() - started)
+        if response.status_code != (302 if write else 200):
+            result["errors"] += 1
+    return result
+
+
+def _run_workers(settings, workers, seconds, write_ratio):
+    """ Fork `workers` processes running `_traffic()` and collect their results. """
+    children = []
+    for i in range(workers):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                user = "user{}".format(i + 1)
+                result = _traffic(settings, user, seconds, write_ratio, i)
+                os.write(write_fd, json.dumps(result).encode("utf-8"))
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        children.append((pid, read_fd))
+    total = {"read": [], "write": [], "errors": 0}
+    for pid, read_fd in children:
+        with os.fdopen(read_fd) as f:
+            result = json.loads(f.read() or '{"read": [], "write": [], "errors": 0}')
+        os.waitpid(pid, 0)
+        for name in total:
+            total[name] += result[name]
+    return total
+
+
+@bench.command("sqlite")
+@click.option("--workers", default=4, show_default=True)
+@click.option("--seconds", default=5.0, show_default=True)
+@click.option("--write-ratio", default=0.2, show_default=True)
+@click.option("--snapshot", default="small", show_default=True)
+def sqlite_command(workers, seconds, write_ratio, snapshot):
+    """Compare default and WAL SQLite under mixed /create and /feed traffic."""
+    from flask_server.testing import SNAPSHOTS, snapshot_path
+
+    if not hasattr(os, "fork"):
+        raise click.ClickException("os.fork() is not available.")
+    if snapshot not in SNAPSHOTS:
+        raise click.ClickException("No such snapshot: {}".format(snapshot))
+    template = snapshot_path(snapshot)
+    directory = tempfile.mkdtemp(prefix="argus-sqlite-")
+    columns = ["read p50", "read p95", "write p50", "write p95", "errors", "lost"]
+    click.echo(
+        "{:<9}{:>9}{:>11}{:>11}{:>12}{:>12}{:>8}{:>8}".format("mode", "req/s", *columns)
+    )
+    try:
+        for mode, wal in (("default", False), ("wal", True)):
+            path = os.path.join(directory, mode + ".db")
+            shutil.copy(template, path)
+            settings = dict(
+                current_app.config,
+                SQLALCHEMY_DATABASE_URI="sqlite:///" + path,
+                SQLITE_WAL=wal,
+                SHARD_DATABASE_URIS=[],
+                PAGE_CACHE_SECONDS=0,
+                WARMUP_ON_STARTUP=False,
+                WTF_CSRF_ENABLED=False,
+            )
+            result = _run_workers(settings, workers, seconds, write_ratio)
+            with sqlite3.connect(path) as connection:
+                saved = connection.execute(
+                    "SELECT count(*) FROM post WHERE body = 'bench'"
+                ).fetchone()[0]
+            requests = len(result["read"]) + len(result["write"])
+            ms = lambda values, fraction: _percentile(values, fraction) * 1000
+            click.echo(
+                "{:<9}{:>9.0f}{:>11.1f}{:>11.1f}{:>12.1f}{:>12.1f}{:>8}{:>8}".format(
+                    mode,
+                    requests / seconds,
+                    ms(result["read"], 0.5),
+                    ms(result["read"], 0.95),
+                    ms(result["write"], 0.5),
+                    ms(result["write"], 0.95),
+                    result["errors"],
+                    len(result["write"]) - saved,
+                )
+            )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,148 @@
+""" A Bloom filter of taken usernames.
+
+Most names people try are free, and a Bloom filter can say "definitely free"
+from memory: it never reports a stored key as absent, it only sometimes reports
+an absent key as present (about `BLOOM_ERROR_RATE` of the time). So:
+
+    - a negative answer skips the database entirely;
+    - a positive answer is confirmed with one SELECT.
+
+The filter is built by gunicorn's master before it forks (see
+`startup.warmup_data`) and updated when this worker registers or renames a
+user. Other workers' changes show up when the filter is rebuilt, every
+`BLOOM_REFRESH_SECONDS`, in a background thread: requests keep using the old
+filter meanwhile, or ask the database if there is none yet, so no request waits
+for a scan of the `user` table. Until then a name taken through another worker
+can look free. That only affects the availability hint: registration and
+profile edits rely on the unique constraints, not on the filter.
+
+Emails are not indexed: telling anyone whether an address has an account
+would let them find out who uses the site.
+"""
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import func, inspect, select
+from flask_server import db
+from flask_server.models import User
+
+log = logging.getLogger(__name__)
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.01):
+        # Optimal bit count and number of hashes for `capacity` keys.
+        capacity = max(capacity, 1)
+        bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+        self.size = int(math.ceil(bits))
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: k positions from two 64-bit halves of one digest.
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+
+def _key(username):
+    # Lower-cased, so the filter errs on the side of "maybe taken" for backends
+    # whose unique indexes ignore case.
+    return (username or "").lower()
+
+
+class UsernameIndex(object):
+    def __init__(self, error_rate=0.01, refresh=600):
+        self.error_rate = error_rate
+        self.refresh = refresh
+        self.filter = None
+        self.built_at = 0
+        self._building = False
+        # Names added while a rebuild reads the table, replayed into its filter.
+        self._added = []
+        self._lock = threading.Lock()
+
+    def build(self, engine):
+        table = User.__table__
+        with engine.connect() as connection:
+            count = connection.execute(select([func.count()]).select_from(table))
+            # Room for twice today's names before the next rebuild.
+            bloom = BloomFilter(2 * count.scalar() + 1000, self.error_rate)
+            for (username,) in connection.execute(select([table.c.username])):
+                bloom.add(_key(username))
+        with self._lock:
+            for key in self._added:
+                bloom.add(key)
+            self._added = []
+            self.filter, self.built_at = bloom, time.monotonic()
+
+    def _rebuild(self, engine):
+        try:
+            self.build(engine)
+        except Exception:
+            log.exception("Could not rebuild the username filter")
+        finally:
+            with self._lock:
+                self._building = False
+
+    def _current(self):
+        """ The filter, or `None` until the first build has finished. """
+        if time.monotonic() - self.built_at > self.refresh and not self._building:
+            with self._lock:
+                if self._building:
+                    return self.filter
+                self._building = True
+            thread = threading.Thread(
+                target=self._rebuild,
+                args=(db.engine,),
+                name="username-filter",
+                daemon=True,
+            )
+            thread.start()
+        return self.filter
+
+    def add(self, user):
+        key = _key(user.username)
+        with self._lock:
+            if self.filter is not None:
+                self.filter.add(key)
+            if self._building:
+                self._added.append(key)
+
+    def is_taken(self, username):
+        """ Whether some user is called `username`; asks the database on a hit. """
+        bloom = self._current()
+        if bloom is not None and _key(username) not in bloom:
+            return False
+        return User.query.filter_by(username=username).first() is not None
+
+
+def init_app(app):
+    app.extensions["usernames"] = UsernameIndex(
+        app.config["BLOOM_ERROR_RATE"], app.config["BLOOM_REFRESH_SECONDS"]
+    )
+
+
+def warmup(app):
+    engine = db.get_engine(app)
+    if User.__tablename__ in inspect(engine).get_table_names():
+        app.extensions["usernames"].build(engine)
+
+
+def usernames():
+    return current_app.extensions["usernames"]
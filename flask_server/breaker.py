@@ -0,0 +1,253 @@
+""" A circuit breaker around the databases, and what pages do while it is open.
+
+Every statement on any engine (the main database and the shards) goes through
+`CircuitBreaker`. `BREAKER_FAILURES` consecutive operational errors, or
+statements slower than `BREAKER_SLOW_SECONDS`, open it. While it is open no
+statement is sent at all: they raise `DatabaseUnavailable` at once, so a sick
+database costs each request microseconds instead of a worker for the length
+of a timeout.
+
+After `BREAKER_RESET_SECONDS` a background thread pings every engine with a
+raw `SELECT 1`; if all answer, the breaker closes and pages are rendered from
+the database again, otherwise it stays open for another period. Requests never
+serve as the probe.
+
+While the breaker is open:
+
+    - read views decorated with `@serve_stale` answer with the last page they
+      rendered for the same URL and visitor, with a banner and a
+      `Warning: 110` header; without one they show the 503 page;
+    - views decorated with `@writes` fail before doing anything, with a 503
+      page saying the change was not saved;
+    - the user loader treats visitors as anonymous instead of querying;
+    - `/api/v1` endpoints answer 503 with a JSON error.
+
+Last good renders are kept per worker, for up to `BREAKER_STALE_PAGES` URLs.
+"""
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import wraps
+
+from flask import current_app, has_app_context, make_response, request, session
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+
+STALE_BANNER = (
+    b'<div class="alert alert-warning m-2">The site is having trouble reaching '
+    b"its database. You are seeing this page as it was a little while ago.</div>"
+)
+# Errors that say something about the database's health; an IntegrityError,
+# say, is an answer, not an outage.
+OUTAGE_ERRORS = (exc.OperationalError, exc.InterfaceError, exc.InternalError)
+
+
+class DatabaseUnavailable(exc.SQLAlchemyError):
+    """ A statement was refused because the breaker is open.
+
+    A `SQLAlchemyError`, so code that handles database errors (rolling back,
+    retrying later) handles this one too.
+    """
+
+
+class CircuitBreaker(object):
+    def __init__(
+        self, failures=5, slow_seconds=2.0, reset_seconds=15.0, probe=None
+    ):
+        self.failures = failures
+        self.slow_seconds = slow_seconds
+        self.reset_seconds = reset_seconds
+        self.probe = probe
+        # "closed", "open", or "probing" while the background check runs.
+        self.state = "closed"
+        self.stats = Counter()
+        self._failed = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        if (
+            self.state == "open"
+            and time.monotonic() - self._opened_at >= self.reset_seconds
+        ):
+            self._start_probe()
+        return self.state != "closed"
+
+    def succeeded(self, seconds):
+        if seconds > self.slow_seconds:
+            self.failed()
+            return
+        with self._lock:
+            self._failed = 0
+
+    def failed(self):
+        with self._lock:
+            self._failed += 1
+            if self.state == "closed" and self._failed >= self.failures:
+                self._open()
+
+    def _open(self):
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self.stats["trips"] += 1
+
+    def _start_probe(self):
+        with self._lock:
+            if self.state != "open":
+                return
+            self.state = "probing"
+        threading.Thread(target=self._run_probe, daemon=True).start()
+
+    def _run_probe(self):
+        try:
+            if self.probe is not None:
+                self.probe()
+            healthy = True
+        except Exception:
+            healthy = False
+        with self._lock:
+            if healthy:
+                self.state, self._failed = "closed", 0
+            else:
+                self._open()
+
+
+class StaleRenders(object):
+    """ The last successful render of each (URL, visitor), oldest dropped first. """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._pages.get(key)
+
+    def set(self, key, body, mimetype):
+        with self._lock:
+            self._pages[key] = (body, mimetype)
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.size:
+                self._pages.popitem(last=False)
+
+
+def _breaker():
+    if has_app_context():
+        return current_app.extensions.get("breaker")
+    return None
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    breaker = _breaker()
+    if breaker is None:
+        return
+    if breaker.is_open:
+        breaker.stats["rejected"] += 1
+        cursor.close()
+        raise DatabaseUnavailable("The database is temporarily unavailable.")
+    conn.info.setdefault("breaker_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    breaker = _breaker()
+    started = conn.info.get("breaker_started")
+    if breaker is not None and started:
+        breaker.succeeded(time.perf_counter() - started.pop())
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    breaker = _breaker()
+    if context.connection is not None:
+        started = context.connection.info.get("breaker_started")
+        if started:
+            started.pop()
+    outage = isinstance(context.sqlalchemy_exception, OUTAGE_ERRORS)
+    if breaker is not None and (outage or context.is_disconnect):
+        breaker.failed()
+
+
+def _ping(engines):
+    for engine in engines:
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+        finally:
+            connection.close()
+
+
+def _mark_stale(body):
+    match = re.search(rb"<body[^>]*>", body)
+    at = match.end() if match else 0
+    return body[:at] + STALE_BANNER + body[at:]
+
+
+def serve_stale(view):
+    """ Serve the last good render of a GET view while the breaker is open. """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = (request.full_path, session.get("user_id"))
+        renders = current_app.extensions["stale_renders"]
+        try:
+            if breaker().is_open:
+                raise DatabaseUnavailable("The database is temporarily unavailable.")
+            response = make_response(view(*args, **kwargs))
+        except (DatabaseUnavailable, *OUTAGE_ERRORS):
+            stale = renders.get(key)
+            if stale is None:
+                raise
+            breaker().stats["stale"] += 1
+            body, mimetype = stale
+            response = make_response(_mark_stale(body))
+            response.mimetype = mimetype
+            response.headers["Warning"] = '110 - "Response is Stale"'
+            response.headers["Cache-Control"] = "no-store"
+            return response
+        if response.status_code == 200 and not response.direct_passthrough:
+            renders.set(key, response.get_data(), response.mimetype)
+        return response
+
+    return wrapper
+
+
+def writes(view):
+    """ Refuse to start a view that changes data while the breaker is open. """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if breaker().is_open:
+            raise DatabaseUnavailable(
+                "The database is temporarily unavailable, so nothing was saved. "
+                "Please try again in a minute."
+            )
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def init_app(app):
+    from flask_server import db
+
+    def probe():
+        with app.app_context():
+            _ping([db.engine] + list(app.extensions["shards"].engines))
+
+    app.extensions["breaker"] = CircuitBreaker(
+        app.config["BREAKER_FAILURES"],
+        app.config["BREAKER_SLOW_SECONDS"],
+        app.config["BREAKER_RESET_SECONDS"],
+        probe,
+    )
+    app.extensions["stale_renders"] = StaleRenders(app.config["BREAKER_STALE_PAGES"])
+
+
+def breaker():
+    return current_app.extensions["breaker"]
@@ -0,0 +1,285 @@
+""" Streaming bulk import/export of users, videos, posts (hot and archived) and follows.
+
+Rows are streamed through SQLAlchemy Core instead of the ORM, so neither side
+builds model instances, fills the identity map or flushes one row at a time:
+
+    flask data export dump/                 # dump/user.jsonl, dump/post.jsonl, ...
+    flask data import dump/ --resume        # continue after an interrupted import
+
+Exports read each table in primary-key order with keyset pagination, so memory
+stays flat no matter how many rows there are. Imports insert `--batch-size` rows
+per `executemany` call and commit once per batch, writing a checkpoint after
+every commit so an interrupted import can pick up where it stopped.
+
+Both commands work on the main database only, so they refuse to run while
+`SHARD_DATABASE_URIS` is set: posts and follows would be missing from the
+export, and imported ones would land where the shard router never looks.
+"""
+import base64
+import csv
+import json
+import os
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import (
+    Boolean,
+    DateTime,
+    Integer,
+    LargeBinary,
+    and_,
+    or_,
+    select,
+    text,
+)
+from flask_server import db
+from flask_server.models import (
+    ArchivedPost,
+    Post,
+    PostStats,
+    User,
+    Video,
+    followers,
+)
+from flask_server.sharding import seed_post_ids, shards
+
+# Import order matters: posts, stats and follow edges reference users, posts
+# videos.
+TABLES = [
+    User.__table__,
+    Video.__table__,
+    Post.__table__,
+    ArchivedPost.__table__,
+    PostStats.__table__,
+    followers,
+]
+FORMATS = ["jsonl", "csv"]
+CHECKPOINT_FILE = ".import-checkpoint.json"
+
+data = AppGroup("data", help="Bulk import/export of users, posts and follows.")
+
+
+def _sort_columns(table):
+    """ The columns used to page through `table` in a stable order.
+
+    `followers` has no primary key, so its rows are ordered by the edge itself.
+    """
+    return list(table.primary_key.columns) or list(table.columns)
+
+
+def iter_rows(connection, table, batch_size=5000):
+    """ Yield every row of `table` as a dict, reading `batch_size` rows at a time.
+
+    Uses keyset pagination (`WHERE (a, b) > (last_a, last_b)`) rather than
+    OFFSET, so every batch is an index range scan and late batches are as fast
+    as early ones.
+    """
+    keys = _sort_columns(table)
+    last = None
+    while True:
+        query = select([table]).order_by(*keys).limit(batch_size)
+        if last is not None:
+            query = query.where(_after(keys, last))
+        rows = connection.execute(query).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield dict(row)
+        last = [rows[-1][key.name] for key in keys]
+
+
+def _after(keys, values):
+    # Expands a row-value comparison for backends without tuple support.
+    clauses = []
+    for i, key in enumerate(keys):
+        equal = [keys[j] == values[j] for j in range(i)]
+        clauses.append(and_(*(equal + [key > values[i]])))
+    return or_(*clauses)
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    return value
+
+
+def _decoder(column):
+    """ Return a function converting an exported value back to the column's type. """
+    if isinstance(column.type, DateTime):
+        return lambda v: datetime.fromisoformat(v) if v else None
+    if isinstance(column.type, Boolean):
+        truthy = (True, 1, "1", "True", "true")
+        return lambda v: None if v in (None, "") else v in truthy
+    if isinstance(column.type, Integer):
+        return lambda v: None if v in (None, "") else int(v)
+    if isinstance(column.type, LargeBinary):
+        return lambda v: base64.b64decode(v) if v else None
+    return lambda v: None if v == "" else v
+
+
+def export_table(connection, table, path, fmt="jsonl", batch_size=5000):
+    """ Stream `table` into the file at `path`; returns the number of rows written. """
+    count = 0
+    names = [column.name for column in table.columns]
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        if fmt == "csv":
+            writer = csv.DictWriter(f, fieldnames=names)
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            write = lambda row: f.write(json.dumps(row) + "\n")
+        for row in iter_rows(connection, table, batch_size):
+            write({name: _encode(row[name]) for name in names})
+            count += 1
+    return count
+
+
+def _read_records(path, fmt):
+    with open(path, newline="", encoding="utf-8") as f:
+        if fmt == "csv":
+            for record in csv.DictReader(f):
+                yield record
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _batches(records, size, skip=0):
+    batch = []
+    for i, record in enumerate(records):
+        if i < skip:
+            continue
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_table(
+    engine, table, path, fmt="jsonl", batch_size=5000, skip=0, on_batch=None
+):
+    """ Insert the rows stored at `path` into `table` with one `executemany` per batch.
+
+    The first `skip` records are ignored, which is how an import resumes from a
+    checkpoint. `on_batch(total)` is called after each committed batch with the
+    number of records consumed from the file so far (including skipped ones).
+    Returns the number of rows inserted.
+    """
+    decoders = {column.name: _decoder(column) for column in table.columns}
+    inserted = 0
+    for batch in _batches(_read_records(path, fmt), batch_size, skip):
+        rows = [
+            {name: decode(record.get(name)) for name, decode in decoders.items()}
+            for record in batch
+        ]
+        with engine.begin() as connection:
+            connection.execute(table.insert(), rows)
+        inserted += len(rows)
+        if on_batch is not None:
+            on_batch(skip + inserted)
+    return inserted
+
+
+def reset_sequences(engine):
+    """ Move id sequences past the imported ids.
+
+    Imported rows keep their ids, which PostgreSQL's serial columns don't
+    notice; MySQL and SQLite derive the next id from the table itself. New
+    posts must also not take the ids of imported archived posts, on any backend.
+    """
+    with engine.begin() as connection:
+        seed_post_ids(connection)
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as connection:
+        for table in TABLES:
+            if table is Post.__table__:
+                continue
+            for column in table.primary_key.columns:
+                if not isinstance(column.type, Integer):
+                    continue
+                connection.execute(
+                    text(
+                        "SELECT setval(pg_get_serial_sequence(:table, :column), "
+                        'COALESCE((SELECT MAX("{}") FROM "{}"), 0) + 1, false)'.format(
+                            column.name, table.name
+                        )
+                    ),
+                    table=table.name,
+                    column=column.name,
+                )
+
+
+def _refuse_shards():
+    if shards.enabled:
+        raise click.ClickException(
+            "Posts and follows live in SHARD_DATABASE_URIS, which `flask data` "
+            "doesn't handle; unset it to export or import the main database."
+        )
+
+
+def _load_checkpoint(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_checkpoint(path, checkpoint):
+    # Write-then-rename so a crash never leaves a truncated checkpoint behind.
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp, path)
+
+
+@data.command("export")
+@click.argument("directory", type=click.Path(file_okay=False))
+@click.option("--format", "fmt", type=click.Choice(FORMATS), default="jsonl")
+@click.option("--batch-size", default=5000, show_default=True)
+def export_command(directory, fmt, batch_size):
+    """Export users, videos, posts, archived posts and follows into DIRECTORY."""
+    _refuse_shards()
+    os.makedirs(directory, exist_ok=True)
+    with db.engine.connect() as connection:
+        for table in TABLES:
+            path = os.path.join(directory, "{}.{}".format(table.name, fmt))
+            count = export_table(connection, table, path, fmt, batch_size)
+            click.echo("{}: exported {} rows to {}".format(table.name, count, path))
+
+
+@data.command("import")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.option("--format", "fmt", type=click.Choice(FORMATS), default="jsonl")
+@click.option("--batch-size", default=5000, show_default=True)
+@click.option("--resume", is_flag=True, help="Continue from the last checkpoint.")
+def import_command(directory, fmt, batch_size, resume):
+    """Import users, videos, posts, archived posts and follows from DIRECTORY."""
+    _refuse_shards()
+    checkpoint_path = os.path.join(directory, CHECKPOINT_FILE)
+    checkpoint = _load_checkpoint(checkpoint_path) if resume else {}
+    for table in TABLES:
+        path = os.path.join(directory, "{}.{}".format(table.name, fmt))
+        if not os.path.exists(path):
+            click.echo("{}: no {} found, skipping".format(table.name, path))
+            continue
+        done = checkpoint.get(table.name, 0)
+
+        def progress(total, name=table.name):
+            checkpoint[name] = total
+            _save_checkpoint(checkpoint_path, checkpoint)
+            click.echo("{}: {} rows".format(name, total))
+
+        count = import_table(
+            db.engine, table, path, fmt, batch_size, skip=done, on_batch=progress
+        )
+        click.echo("{}: imported {} rows".format(table.name, count))
+    reset_sequences(db.engine)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
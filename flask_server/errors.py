@@ -1,13 +1,27 @@
-from flask import render_template
-from flask_server import flask_server, db
+from flask import Blueprint, current_app, jsonify, render_template, request
+from flask_server import db
+from flask_server.breaker import DatabaseUnavailable
 
+bp = Blueprint("errors", __name__)
 
-@flask_server.errorhandler(404)
+
+@bp.app_errorhandler(404)
 def not_found_error(error):
     return render_template("404.html"), 404
 
 
-@flask_server.errorhandler(500)
+@bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
     return render_template("500.html"), 500
+
+
+@bp.app_errorhandler(DatabaseUnavailable)
+def database_unavailable(error):
+    db.session.rollback()
+    retry = int(current_app.config["BREAKER_RESET_SECONDS"])
+    if request.blueprint == "api":
+        body = jsonify(error=str(error))
+    else:
+        body = render_template("503.html", message=str(error))
+    return body, 503, {"Retry-After": str(retry)}
@@ -1,7 +1,23 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, BooleanField, SubmitField, TextAreaField
-from wtforms.validators import ValidationError, DataRequired, Email, EqualTo, Length
-from flask_server.models import User
+from wtforms import (
+    BooleanField,
+    FloatField,
+    PasswordField,
+    StringField,
+    SubmitField,
+    TextAreaField,
+)
+from wtforms.validators import (
+    DataRequired,
+    Email,
+    EqualTo,
+    Length,
+    NumberRange,
+    Optional,
+    ValidationError,
+)
+from flask_server.bloom import usernames
+from flask_server.videos import video_id
 
 
 class LoginForm(FlaskForm):
@@ -24,8 +40,7 @@ class EditProfileForm(FlaskForm):
 
     def validate_username(self, username):
         if username.data != self.original_username:
-            user = User.query.filter_by(username=self.username.data).first()
-            if user is not None:
+            if usernames().is_taken(username.data):
                 raise ValidationError("Please use a different username.")
 
 
@@ -47,15 +62,8 @@ class RegistrationForm(FlaskForm):
     )
     submit = SubmitField("Register")
 
-    def validate_username(self, username):
-        user = User.query.filter_by(username=username.data).first()
-        if user is not None:
-            raise ValidationError("Please use a different username.")
-
-    def validate_email(self, email):
-        user = User.query.filter_by(email=email.data).first()
-        if user is not None:
-            raise ValidationError("Please use a different email address.")
+    # Username and email uniqueness is left to the database's unique indexes,
+    # see `routes.register`.
 
 
 class PostForm(FlaskForm):
@@ -63,8 +71,23 @@ class PostForm(FlaskForm):
     url = StringField("https://www.youtube.com/watch?v=", validators=[DataRequired()])
     submit = SubmitField("Create Post")
 
+    def validate_url(self, url):
+        if video_id(url.data) is None:
+            raise ValidationError("Please enter a YouTube link or video id.")
+
 
 class UpdateForm(FlaskForm):
     body = StringField("Say something about this video:", validators=[DataRequired()])
     url = StringField("https://www.youtube.com/watch?v=", validators=[DataRequired()])
     submit = SubmitField("Update Post")
+
+    def validate_url(self, url):
+        if video_id(url.data) is None:
+            raise ValidationError("Please enter a YouTube link or video id.")
+
+
+class ProfileWindowForm(FlaskForm):
+    seconds = FloatField(
+        "Seconds", default=10, validators=[Optional(), NumberRange(min=0)]
+    )
+    submit = SubmitField("Profile this worker")
@@ -2,7 +2,8 @@ from datetime import datetime
 from flask_server import db, login
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
-from hashlib import md5
+from flask_server.avatars import email_digest
+from flask_server.breaker import breaker
 
 followers = db.Table(
     "followers",
@@ -36,6 +37,8 @@ class User(UserMixin, db.Model):
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
     password_hash = db.Column(db.String(128))
     poster = db.Column(db.Boolean, unique=False, default=False)
+    # Bumped to revoke every API token issued so far, see `flask_server/tokens.py`.
+    token_version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     posts = db.relationship("Post", backref="author", lazy="dynamic")
     followed = db.relationship(
@@ -63,11 +66,13 @@ class User(UserMixin, db.Model):
         return check_password_hash(self.password_hash, password)
 
     def avatar(self, size):
-        digest = md5(self.email.lower().encode("utf-8")).hexdigest()
         return "https://www.gravatar.com/avatar/{}?d=identicon&s={}".format(
-            digest, size
+            self.avatar_digest(), size
         )
 
+    def avatar_digest(self):
+        return email_digest(self.email)
+
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
@@ -112,15 +117,152 @@ def load_user(id):
     """ This function is the glue between Flask-Login and the remote SQL database.
     
     """
+    if breaker().is_open:
+        # Anonymous for now, instead of failing before a stale page is served.
+        return None
     return User.query.get(int(id))
 
 
 class Post(db.Model):
+    # Ids are never reused, so the ids archived posts and view stats keep
+    # can't come back as another post's.
+    __table_args__ = {"sqlite_autoincrement": True}
+
     id = db.Column(db.Integer, primary_key=True)
     url = db.Column(db.String(140))
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    video_id = db.Column(db.String(11), db.ForeignKey("video.id"), index=True)
+
+    archived = False
 
     def __repr__(self):
         return "<Post {}>".format(self.url)
+
+
+class ArchivedPost(db.Model):
+    """ A post moved out of the hot `post` table by `flask archive run`.
+
+    Same columns as `Post`, with the id it had there kept in `post_id`. Archived
+    posts are read-only: they show up at the end of a user's profile but can no
+    longer be updated or deleted.
+    """
+
+    __tablename__ = "post_archive"
+    __table_args__ = (
+        db.Index("ix_post_archive_user_id_timestamp", "user_id", "timestamp"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(db.Integer)
+    url = db.Column(db.String(140))
+    body = db.Column(db.String(140))
+    timestamp = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    video_id = db.Column(db.String(11), index=True)
+
+    author = db.relationship("User")
+    archived = True
+
+    def __repr__(self):
+        return "<ArchivedPost {}>".format(self.url)
+
+
+class PostStats(db.Model):
+    """ View counters of a post, written in batches by `flask_server/viewcounts.py`.
+
+    Keyed by author and post: post ids are only unique per shard, and the
+    author decides the shard. `viewers` is a HyperLogLog sketch of the distinct
+    viewers. Archived posts keep their stats under their original `post_id`.
+    """
+
+    __tablename__ = "post_stats"
+
+    author_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), primary_key=True, autoincrement=False
+    )
+    post_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    views = db.Column(db.BigInteger, nullable=False, default=0)
+    viewers = db.Column(db.LargeBinary)
+    updated_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return "<PostStats {}/{}>".format(self.author_id, self.post_id)
+
+
+class Video(db.Model):
+    """ A YouTube video, however many posts link to it and in whatever URL form.
+
+    Keyed by the 11-character video id (see `flask_server/videos.py`). The
+    post count and the first and latest post are kept up to date as posts are
+    created and deleted; `flask videos recount` rebuilds them from the shards.
+    Hot and archived posts are counted; the latest post is always a hot one.
+    """
+
+    id = db.Column(db.String(11), primary_key=True)
+    post_count = db.Column(db.Integer, nullable=False, default=0, index=True)
+    first_poster_id = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)
+    first_post_id = db.Column(db.Integer)
+    first_posted_at = db.Column(db.DateTime)
+    last_poster_id = db.Column(db.Integer)
+    last_post_id = db.Column(db.Integer)
+    last_posted_at = db.Column(db.DateTime, index=True)
+
+    first_poster = db.relationship("User")
+
+    def __repr__(self):
+        return "<Video {}>".format(self.id)
+
+
+class AnalyticsDay(db.Model):
+    """ Posts published per day, kept by `flask_server/analytics.py`. """
+
+    __tablename__ = "analytics_day"
+
+    day = db.Column(db.Date, primary_key=True)
+    posts = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<AnalyticsDay {}>".format(self.day)
+
+
+class AnalyticsUser(db.Model):
+    """ Posts published by a user since analytics began, and their followers now. """
+
+    __tablename__ = "analytics_user"
+
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), primary_key=True, autoincrement=False
+    )
+    posts = db.Column(db.Integer, nullable=False, default=0)
+    followers = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return "<AnalyticsUser {}>".format(self.user_id)
+
+
+class AnalyticsFollowers(db.Model):
+    """ A user's follower count on a day `flask analytics refresh` ran. """
+
+    __tablename__ = "analytics_followers"
+
+    day = db.Column(db.Date, primary_key=True)
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    followers = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return "<AnalyticsFollowers {}/{}>".format(self.day, self.user_id)
+
+
+class AnalyticsMark(db.Model):
+    """ The high-water mark up to which a source has been summarized. """
+
+    __tablename__ = "analytics_mark"
+
+    name = db.Column(db.String(64), primary_key=True)
+    last_key = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return "<AnalyticsMark {} {}>".format(self.name, self.last_key)
@@ -0,0 +1,271 @@
+""" Alembic operations for changing large tables without taking them offline.
+
+`migrations/env.py` imports this module, which registers two operations on
+`op` for migration scripts:
+
+    op.create_index_online("ix_post_video_id", "post", ["video_id"])
+    op.backfill("post", {"video_id": video_id_of}, columns=["url"],
+                where="video_id IS NULL", batch_size=2000, pause=0.1)
+
+`create_index_online` builds the index without blocking writes where the
+backend can: `CREATE INDEX CONCURRENTLY` on PostgreSQL (outside the migration
+transaction, which it commits), `ALGORITHM=INPLACE, LOCK=NONE` on MySQL, and a
+plain `CREATE INDEX` elsewhere.
+
+`backfill` updates a table in primary-key order, `batch_size` rows at a time,
+each batch committed on its own so no lock is held for longer than one batch,
+sleeping `pause` seconds in between to leave room for regular traffic. Values
+are SQL expressions (`{"views": "0"}`) or a function of the selected `columns`
+of a row returning the new values (or None to leave the row alone). Progress is
+logged after every batch and saved in `online_migration_progress`, so a rerun
+after an interruption continues after the last committed batch. Backfills must
+be idempotent, since a batch may be repeated.
+
+The usual sequence for a new indexed or denormalized column on a big table is
+then: add it as nullable, `create_index_online`, `backfill`, and only then add
+constraints such as NOT NULL in a later migration.
+"""
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import sqlalchemy as sa
+from alembic.operations import MigrateOperation, Operations
+from alembic.util import CommandError
+
+logger = logging.getLogger("alembic.online")
+
+PROGRESS_TABLE = "online_migration_progress"
+
+
+@Operations.register_operation("create_index_online")
+class CreateIndexOnlineOp(MigrateOperation):
+    def __init__(self, index_name, table_name, columns, unique=False):
+        self.index_name = index_name
+        self.table_name = table_name
+        self.columns = columns
+        self.unique = unique
+
+    @classmethod
+    def create_index_online(
+        cls, operations, index_name, table_name, columns, unique=False
+    ):
+        """ Create an index without blocking writes to the table. """
+        return operations.invoke(cls(index_name, table_name, columns, unique))
+
+    def reverse(self):
+        return DropIndexOnlineOp(self.index_name, self.table_name)
+
+
+@Operations.register_operation("drop_index_online")
+class DropIndexOnlineOp(MigrateOperation):
+    def __init__(self, index_name, table_name):
+        self.index_name = index_name
+        self.table_name = table_name
+
+    @classmethod
+    def drop_index_online(cls, operations, index_name, table_name):
+        """ Drop an index without blocking writes to the table. """
+        return operations.invoke(cls(index_name, table_name))
+
+
+@Operations.register_operation("backfill")
+class BackfillOp(MigrateOperation):
+    def __init__(
+        self,
+        table_name,
+        values,
+        columns=(),
+        where=None,
+        key="id",
+        batch_size=1000,
+        pause=0.0,
+        name=None,
+    ):
+        self.table_name = table_name
+        self.values = values
+        self.columns = list(columns)
+        self.where = where
+        self.key = key
+        self.batch_size = batch_size
+        self.pause = pause
+        self.name = name or "{}:{}".format(
+            table_name, ",".join(sorted(values) if isinstance(values, dict) else [])
+        )
+
+    @classmethod
+    def backfill(cls, operations, table_name, values, **kw):
+        """ Update a table in committed batches; see the module docstring. """
+        return operations.invoke(cls(table_name, values, **kw))
+
+
+@contextmanager
+def _outside_transaction(operations):
+    # Only backends with transactional DDL run the migration in a transaction;
+    # elsewhere every statement already commits on its own.
+    context = operations.get_context()
+    if context.impl.transactional_ddl:
+        with context.autocommit_block():
+            yield
+    else:
+        yield
+
+
+def _quote(operations, name):
+    return operations.get_bind().dialect.identifier_preparer.quote(name)
+
+
+@Operations.implementation_for(CreateIndexOnlineOp)
+def create_index_online(operations, operation):
+    dialect = operations.get_bind().dialect.name
+    if dialect == "postgresql":
+        with _outside_transaction(operations):
+            operations.create_index(
+                operation.index_name,
+                operation.table_name,
+                operation.columns,
+                unique=operation.unique,
+                postgresql_concurrently=True,
+            )
+    elif dialect == "mysql":
+        operations.execute(
+            "CREATE {}INDEX {} ON {} ({}) ALGORITHM=INPLACE LOCK=NONE".format(
+                "UNIQUE " if operation.unique else "",
+                _quote(operations, operation.index_name),
+                _quote(operations, operation.table_name),
+                ", ".join(_quote(operations, c) for c in operation.columns),
+            )
+        )
+    else:
+        operations.create_index(
+            operation.index_name,
+            operation.table_name,
+            operation.columns,
+            unique=operation.unique,
+        )
+
+
+@Operations.implementation_for(DropIndexOnlineOp)
+def drop_index_online(operations, operation):
+    dialect = operations.get_bind().dialect.name
+    if dialect == "postgresql":
+        with _outside_transaction(operations):
+            operations.drop_index(
+                operation.index_name,
+                table_name=operation.table_name,
+                postgresql_concurrently=True,
+            )
+    elif dialect == "mysql":
+        operations.execute(
+            "DROP INDEX {} ON {} ALGORITHM=INPLACE LOCK=NONE".format(
+                _quote(operations, operation.index_name),
+                _quote(operations, operation.table_name),
+            )
+        )
+    else:
+        operations.drop_index(operation.index_name, table_name=operation.table_name)
+
+
+def _progress_table(metadata):
+    return sa.Table(
+        PROGRESS_TABLE,
+        metadata,
+        sa.Column("name", sa.String(200), primary_key=True),
+        sa.Column("last_key", sa.BigInteger),
+        sa.Column("rows", sa.BigInteger),
+        sa.Column("updated_at", sa.DateTime),
+    )
+
+
+def _expression(value):
+    return sa.text(value) if isinstance(value, str) else value
+
+
+@Operations.implementation_for(BackfillOp)
+def backfill(operations, operation):
+    if operations.get_context().as_sql:
+        raise CommandError("Backfills need a database connection")
+    bind = operations.get_bind()
+    metadata = sa.MetaData()
+    table = sa.Table(operation.table_name, metadata, autoload_with=bind)
+    progress = _progress_table(metadata)
+    key = table.c[operation.key]
+    where = _expression(operation.where) if operation.where is not None else None
+
+    with _outside_transaction(operations):
+        progress.create(bind, checkfirst=True)
+        saved = bind.execute(
+            progress.select().where(progress.c.name == operation.name)
+        ).first()
+        last, rows = (saved.last_key, saved.rows) if saved else (None, 0)
+        if saved is None:
+            bind.execute(progress.insert().values(name=operation.name, rows=0))
+        bounds = sa.select([sa.func.min(key), sa.func.max(key)])
+        low, high = bind.execute(bounds).first()
+        if saved is not None:
+            logger.info("%s: resuming after %s", operation.name, last)
+
+        started = time.time()
+        done = 0
+        while True:
+            query = sa.select([key] + [table.c[c] for c in operation.columns])
+            if last is not None:
+                query = query.where(key > last)
+            if where is not None:
+                query = query.where(where)
+            batch = bind.execute(query.order_by(key).limit(operation.batch_size))
+            batch = batch.fetchall()
+            if not batch:
+                break
+            rows += _update_batch(bind, table, key, operation, batch, where)
+            done += len(batch)
+            last = batch[-1][0]
+            bind.execute(
+                progress.update()
+                .where(progress.c.name == operation.name)
+                .values(last_key=last, rows=rows, updated_at=datetime.utcnow())
+            )
+            elapsed = max(time.time() - started, 1e-6)
+            logger.info(
+                "%s: %d rows updated, %s %s of %s-%s (%.0f%%), %.0f rows/s",
+                operation.name,
+                rows,
+                operation.key,
+                last,
+                low,
+                high,
+                100.0 * (last - low + 1) / (high - low + 1),
+                done / elapsed,
+            )
+            if operation.pause:
+                time.sleep(operation.pause)
+        bind.execute(progress.delete().where(progress.c.name == operation.name))
+        logger.info("%s: done, %d rows updated", operation.name, rows)
+
+
+def _update_batch(bind, table, key, operation, batch, where):
+    """ Apply the backfill to the rows of `batch`; returns how many changed. """
+    if isinstance(operation.values, dict):
+        values = {
+            name: _expression(value) for name, value in operation.values.items()
+        }
+        query = table.update().where(key.between(batch[0][0], batch[-1][0]))
+        if where is not None:
+            query = query.where(where)
+        return bind.execute(query.values(values)).rowcount
+
+    updates = []
+    for row in batch:
+        values = operation.values(row)
+        if values:
+            updates.append(dict(values, b_key=row[0]))
+    if updates:
+        names = [name for name in updates[0] if name != "b_key"]
+        bind.execute(
+            table.update()
+            .where(key == sa.bindparam("b_key"))
+            .values({name: sa.bindparam(name) for name in names}),
+            updates,
+        )
+    return len(updates)
@@ -0,0 +1,240 @@
+""" A short-lived cache of hot page data, computed once per miss.
+
+`/discover` and user profile pages cache the posts they list for
+`PAGE_CACHE_SECONDS`. What is cached is the data (`readmodel` pages), never the
+rendered HTML, which depends on the logged-in user.
+
+When an entry expires or is invalidated, every request that arrives before it
+is recomputed would otherwise run the same queries at once. `SingleFlight`
+prevents that: the first request for a key runs the computation and the
+others wait for its result (they are "coalesced").
+
+By default entries and single flight are per worker. With `PAGE_CACHE_DIR`
+set, entries are also pickled into that directory and the computation of a key
+is guarded by a file lock, so across all workers on the host one request
+recomputes an entry and the rest read it from disk when the lock is released.
+Unpickling runs code, so the directory must belong to the app's user and be
+closed to everyone else: it is created with mode 0700, and an existing one
+that others can write to is refused.
+
+Posting, editing or deleting calls `invalidate()`, which drops every entry
+(in all workers, through the mtime of `<PAGE_CACHE_DIR>/generation`).
+
+Per-worker counters are served to admins at `/api/v1/cache`.
+"""
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import Counter
+
+from flask import current_app
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-worker locking
+    fcntl = None
+
+# Local entries kept per worker before they are all dropped.
+MAX_ENTRIES = 10000
+
+
+def _private_directory(path):
+    """ Create `path` for this user only; refuse one others could write to. """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.stat(path)
+    if info.st_uid != os.getuid() or info.st_mode & 0o022:
+        raise RuntimeError(
+            "PAGE_CACHE_DIR {} must be owned by this user and not writable "
+            "by others.".format(path)
+        )
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """ Run at most one call per key at a time; concurrent callers share it.
+
+    With `lock_dir`, calls are also serialized across processes by a file lock
+    per key. A caller that had to wait for the lock runs `recheck()` first and
+    uses its value if it returns `(True, value)`.
+    """
+
+    def __init__(self, lock_dir=None, lock_timeout=10.0):
+        self.lock_dir = lock_dir if fcntl is not None else None
+        self.lock_timeout = lock_timeout
+        self.stats = Counter()
+        self._calls = {}
+        self._lock = threading.Lock()
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, mode=0o700, exist_ok=True)
+
+    def do(self, key, func, recheck=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.stats["leaders"] += 1
+            else:
+                self.stats["coalesced"] += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = self._run(key, func, recheck)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def _run(self, key, func, recheck):
+        if not self.lock_dir:
+            return func()
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest() + ".lock"
+        with open(os.path.join(self.lock_dir, name), "a") as f:
+            waited = self._acquire(f)
+            try:
+                if waited and recheck is not None:
+                    found, value = recheck()
+                    if found:
+                        self.count("coalesced_across_workers")
+                        return value
+                return func()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _acquire(self, f):
+        """ Lock `f`; returns whether another process held it first. """
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return False
+        except BlockingIOError:
+            pass
+        self.count("lock_waits")
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.01)
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                pass
+        # The holder is stuck; computing again beats failing the request.
+        self.count("lock_timeouts")
+        return True
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+
+class PageCache(object):
+    def __init__(self, ttl, directory=None, lock_timeout=10.0):
+        self.ttl = ttl
+        self.directory = directory
+        self._entries = {}
+        self._invalidated_at = 0.0
+        if directory:
+            _private_directory(directory)
+        lock_dir = os.path.join(directory, "locks") if directory else None
+        self.flight = SingleFlight(lock_dir, lock_timeout)
+        self.stats = self.flight.stats
+
+    def _path(self, key):
+        return os.path.join(
+            self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest()
+        )
+
+    def _generation(self):
+        if not self.directory:
+            return self._invalidated_at
+        try:
+            return os.stat(os.path.join(self.directory, "generation")).st_mtime
+        except OSError:
+            return 0.0
+
+    def get(self, key):
+        """ `(True, value)` for a fresh entry, `(False, None)` otherwise. """
+        now, generation = time.time(), self._generation()
+        entry = self._entries.get(key)
+        if entry is None and self.directory:
+            try:
+                with open(self._path(key), "rb") as f:
+                    entry = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                entry = None
+        if entry is None:
+            return False, None
+        created, value = entry
+        if created < generation or now - created > self.ttl:
+            return False, None
+        self._entries[key] = entry
+        return True, value
+
+    def set(self, key, value, created=None):
+        """ Store `value`, computed from data read at `created` (default: now). """
+        entry = (created or time.time(), value)
+        if len(self._entries) >= MAX_ENTRIES:
+            self._entries.clear()
+        self._entries[key] = entry
+        if self.directory:
+            # Written under a temporary name, so readers never see half a file.
+            path = self._path(key)
+            tmp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+            with open(tmp, "wb") as f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+
+    def fetch(self, key, func):
+        """ The cached value of `key`, calling `func()` once on a miss. """
+        if not self.ttl:
+            return func()
+        found, value = self.get(key)
+        if found:
+            self.flight.count("hits")
+            return value
+        self.flight.count("misses")
+        return self.flight.do(
+            key, lambda: self._compute(key, func), lambda: self.get(key)
+        )
+
+    def _compute(self, key, func):
+        # Dated from before the queries, so an invalidation while they run
+        # still makes the entry stale.
+        started = time.time()
+        value = func()
+        self.set(key, value, started)
+        return value
+
+    def invalidate(self):
+        """ Drop every entry, in this and (with a directory) all other workers. """
+        self._entries.clear()
+        self._invalidated_at = time.time()
+        if self.directory:
+            path = os.path.join(self.directory, "generation")
+            with open(path, "a"):
+                pass
+            os.utime(path)
+
+
+def init_app(app):
+    app.extensions["pagecache"] = PageCache(
+        app.config["PAGE_CACHE_SECONDS"], app.config["PAGE_CACHE_DIR"]
+    )
+
+
+def cache():
+    return current_app.extensions["pagecache"]
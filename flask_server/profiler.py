@@ -0,0 +1,206 @@
+""" A sampling profiler that admins can switch on in production.
+
+A sampler thread looks at the Python stacks of the worker's request threads
+every `PROFILER_INTERVAL` seconds (`sys._current_frames()`) and counts each
+distinct stack under the endpoint the thread is serving. Nothing is traced, so
+the profiled code runs at full speed; the cost is the sampler's own work, a few
+microseconds per thread per sample, and it stops after at most
+`PROFILER_MAX_SECONDS`. When no profile runs, the only cost is one attribute
+check per request.
+
+Two ways to use it, both for users listed in `ADMIN_USERNAMES` only:
+
+    GET /feed?profile=1                # or with an `X-Profile: 1` header
+        runs the request under the sampler and answers with its profile
+        instead of the page;
+    POST /admin/profiler  seconds=30&csrf_token=...
+        samples every request this worker serves for 30 seconds and saves the
+        profile in `PROFILE_DIR`, listed at GET /admin/profiler (a page with
+        the form for browsers; JSON with the CSRF token for other clients).
+
+Profiles are in the "collapsed stack" format that `flamegraph.pl` and
+speedscope read, one stack per line, root first, with its sample count:
+
+    main.feed;...;dispatch_request (flask/app.py:1935);feed (routes.py:152) 12
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app, g, request
+from flask_login import current_user
+
+
+class Sampler(object):
+    """ Samples the stacks of registered threads until stopped or out of time. """
+
+    def __init__(self, interval=0.005, max_seconds=60, max_depth=64):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.max_depth = max_depth
+        self.samples = Counter()
+        # {thread id: root label} of the threads to sample.
+        self.threads = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, seconds=None):
+        seconds = min(seconds or self.max_seconds, self.max_seconds)
+        self._thread = threading.Thread(target=self._run, args=(seconds,))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.samples
+
+    def wait(self):
+        self._thread.join()
+        return self.samples
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self, seconds):
+        deadline = time.monotonic() + seconds
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def sample(self):
+        frames = sys._current_frames()
+        for ident, root in list(self.threads.items()):
+            frame = frames.get(ident)
+            if frame is not None:
+                self.samples[self._stack(root, frame)] += 1
+
+    def _stack(self, root, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(
+                "{} ({}:{})".format(
+                    code.co_name, _short_path(code.co_filename), frame.f_lineno
+                )
+            )
+            frame = frame.f_back
+        names.append(root)
+        return ";".join(reversed(names))
+
+
+def _short_path(filename):
+    # "flask/app.py" rather than the full site-packages path.
+    parts = filename.replace("\\", "/").split("/")
+    return "/".join(parts[-2:])
+
+
+def collapsed(samples):
+    """ The samples as collapsed stacks, most frequent first. """
+    return "".join(
+        "{} {}\n".format(stack, count) for stack, count in samples.most_common()
+    )
+
+
+def is_admin(user):
+    admins = current_app.config["ADMIN_USERNAMES"]
+    return user.is_authenticated and user.username in admins
+
+
+def _profiling_requested():
+    flag = request.args.get("profile") or request.headers.get("X-Profile")
+    return flag == "1"
+
+
+def _make_sampler(app):
+    return Sampler(
+        app.config["PROFILER_INTERVAL"],
+        app.config["PROFILER_MAX_SECONDS"],
+        app.config["PROFILER_MAX_DEPTH"],
+    )
+
+
+class Profiler(object):
+    """ The per-worker state: at most one window, any number of requests. """
+
+    def __init__(self, app):
+        self.app = app
+        self.window = None
+        self._lock = threading.Lock()
+
+    def start_window(self, seconds):
+        """ Profile every request for `seconds`; returns the profile's name. """
+        with self._lock:
+            if self.window is not None and self.window.running:
+                return None
+            self.window = _make_sampler(self.app)
+        name = "{}-{}.folded".format(
+            datetime.utcnow().strftime("%Y%m%dT%H%M%S"), os.getpid()
+        )
+        sampler = self.window.start(seconds)
+        saver = threading.Thread(target=self._save, args=(sampler, name))
+        saver.daemon = True
+        saver.start()
+        return name
+
+    def _save(self, sampler, name):
+        samples = sampler.wait()
+        directory = self.app.config["PROFILE_DIR"]
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, name), "w") as f:
+            f.write(collapsed(samples))
+
+    def profiles(self):
+        """ Names of the saved profiles of every worker, newest first. """
+        try:
+            names = os.listdir(self.app.config["PROFILE_DIR"])
+        except OSError:
+            return []
+        return sorted(
+            (name for name in names if name.endswith(".folded")), reverse=True
+        )
+
+    def before_request(self):
+        window = self.window
+        if window is not None and window.running:
+            window.threads[threading.get_ident()] = request.endpoint or request.path
+        if _profiling_requested() and is_admin(current_user):
+            sampler = g.sampler = _make_sampler(self.app)
+            sampler.threads[threading.get_ident()] = request.endpoint or request.path
+            sampler.start()
+
+    def after_request(self, response):
+        sampler = g.pop("sampler", None)
+        if sampler is None:
+            return response
+        response = current_app.response_class(
+            collapsed(sampler.stop()), mimetype="text/plain"
+        )
+        response.headers["Cache-Control"] = "no-store"
+        return response
+
+    def teardown_request(self, exception=None):
+        # A request that failed never reached `after_request`.
+        sampler = g.pop("sampler", None)
+        if sampler is not None:
+            sampler.stop()
+        window = self.window
+        if window is not None:
+            window.threads.pop(threading.get_ident(), None)
+
+
+def init_app(app):
+    profiler = app.extensions["profiler"] = Profiler(app)
+    app.before_request(profiler.before_request)
+    app.after_request(profiler.after_request)
+    app.teardown_request(profiler.teardown_request)
+
+
+def profiler():
+    return current_app.extensions["profiler"]
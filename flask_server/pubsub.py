@@ -0,0 +1,181 @@
+""" In-process publish/subscribe used to push new posts to connected browsers.
+
+`create_post` publishes `{"post_id": ..., "user_id": ...}` on the author's
+topic (their user id); every `/stream` connection subscribes to the topics of
+the users its viewer follows (see `routes.stream`). Each subscription buffers at
+most `SSE_BUFFER_SIZE` messages, dropping the oldest ones (and counting them)
+if the client falls behind, so a slow reader can't grow memory without bound.
+
+An idle connection is one `Subscription` (a deque and a condition variable)
+plus whatever the gunicorn worker class needs to keep a response open: a
+thread on the gthread page workers, which is why `/stream` is served by its
+own gevent process (`gunicorn.stream.conf.py`), where it is a greenlet.
+Streams hold no database connection.
+
+By default messages only reach subscribers in the publishing process. Set
+`PUBSUB_TRANSPORT` to a `redis://` URL to fan them out across workers, hosts
+and the stream process; other transports only need `publish(topic, message)`
+and `start(deliver)`.
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from flask import current_app
+
+log = logging.getLogger(__name__)
+
+
+class Subscription(object):
+    __slots__ = ("topics", "queue", "condition", "dropped", "closed")
+
+    def __init__(self, topics, buffer_size):
+        self.topics = frozenset(topics)
+        self.queue = deque(maxlen=buffer_size)
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, message):
+        with self.condition:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(message)
+            self.condition.notify()
+
+    def get(self, timeout):
+        """ Wait up to `timeout` seconds for messages.
+
+        Returns `(messages, dropped)`: everything buffered so far and how many
+        older messages were discarded since the last call.
+        """
+        with self.condition:
+            if not self.queue and not self.closed:
+                self.condition.wait(timeout)
+            messages = list(self.queue)
+            self.queue.clear()
+            dropped, self.dropped = self.dropped, 0
+        return messages, dropped
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+class LocalTransport(object):
+    """ Delivers straight to the subscribers of this process. """
+
+    def start(self, deliver):
+        self.deliver = deliver
+
+    def publish(self, topic, message):
+        self.deliver(topic, message)
+
+
+class RedisTransport(object):
+    """ Fans messages out through a Redis channel shared by all workers. """
+
+    channel = "argus:pubsub"
+    # Seconds to wait before reconnecting; doubled after each failed attempt.
+    min_backoff, max_backoff = 0.5, 30.0
+
+    def __init__(self, url):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+
+    def _listen(self, deliver):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(self.channel)
+            for item in pubsub.listen():
+                payload = json.loads(item["data"])
+                deliver(payload["topic"], payload["message"])
+        finally:
+            pubsub.close()
+
+    def start(self, deliver):
+        def listen():
+            # Messages published while disconnected are lost; the clients'
+            # heartbeats keep going and the next posts get through again.
+            backoff = self.min_backoff
+            while True:
+                started = time.monotonic()
+                try:
+                    self._listen(deliver)
+                except Exception:
+                    log.exception("Lost the Redis pub/sub connection")
+                if time.monotonic() - started > self.max_backoff:
+                    backoff = self.min_backoff
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+        threading.Thread(target=listen, name="pubsub-redis", daemon=True).start()
+
+    def publish(self, topic, message):
+        payload = json.dumps({"topic": topic, "message": message})
+        self.redis.publish(self.channel, payload)
+
+
+class Broker(object):
+    def __init__(self, transport=None, buffer_size=64):
+        self.transport = transport or LocalTransport()
+        self.buffer_size = buffer_size
+        self._topics = {}
+        self._lock = threading.Lock()
+        self._started = False
+
+    def _start(self):
+        # Started lazily so that transport threads are created in the worker,
+        # never in a gunicorn master that is about to fork.
+        with self._lock:
+            if not self._started:
+                self.transport.start(self.deliver)
+                self._started = True
+
+    def subscribe(self, topics):
+        self._start()
+        subscription = Subscription(topics, self.buffer_size)
+        with self._lock:
+            for topic in subscription.topics:
+                self._topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._topics.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._topics[topic]
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(set().union(*self._topics.values()))
+
+    def publish(self, topic, message):
+        self._start()
+        self.transport.publish(topic, message)
+
+    def deliver(self, topic, message):
+        with self._lock:
+            subscribers = list(self._topics.get(topic, ()))
+        for subscription in subscribers:
+            subscription.put(message)
+
+
+def init_app(app):
+    url = app.config["PUBSUB_TRANSPORT"]
+    transport = None
+    if url.startswith(("redis://", "rediss://")):
+        transport = RedisTransport(url)
+    app.extensions["pubsub"] = Broker(transport, app.config["SSE_BUFFER_SIZE"])
+
+
+def broker():
+    return current_app.extensions["pubsub"]
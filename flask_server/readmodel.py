@@ -0,0 +1,329 @@
+""" Read-only queries for the list pages, returning plain tuples instead of models.
+
+A post card needs seven columns of a post and two of its author. Loading them as
+`Post` and `User` instances also builds instance state, identity-map entries and
+relationship proxies, none of which a page that only renders them uses. The
+functions here select exactly those columns with SQLAlchemy Core and return
+`PostCard` and `Author` named tuples, which have no per-instance `__dict__`.
+
+They mirror the `ShardRouter` methods of the same names (sharding, k-way merge,
+archive continuation) and return the same `Pagination`, so templates don't
+change. Anything that modifies posts still loads models through the router.
+`flask bench pages` compares the two paths.
+
+The `*_after` functions serve infinite scroll: instead of a page number they
+take the opaque cursor of the last card already shown and return the cards
+after it and the next cursor (`None` at the end). Cursors are keyset
+positions, `(timestamp, id)` of the last card, so posts published while
+someone scrolls don't shift the cards they get next.
+"""
+import base64
+import heapq
+import json
+from collections import namedtuple
+from datetime import datetime
+from itertools import islice
+
+from flask_sqlalchemy import Pagination
+from sqlalchemy import and_, func, or_, select, true
+from flask_server.sqlite import reader
+from flask_server.models import User, Post, ArchivedPost, Video, followers
+from flask_server.sharding import shards
+
+Author = namedtuple("Author", ["id", "username"])
+PostCard = namedtuple(
+    "PostCard",
+    [
+        "id",
+        "post_id",
+        "url",
+        "body",
+        "timestamp",
+        "user_id",
+        "video_id",
+        "archived",
+        "author",
+    ],
+)
+
+USERS, HOT, COLD = User.__table__, Post.__table__, ArchivedPost.__table__
+VIDEOS = Video.__table__
+CURSOR_TIME = "%Y-%m-%dT%H:%M:%S.%f"
+# Cursor kinds: a hot post, an archived post, a video of collapsed discover.
+HOT_KIND, COLD_KIND, VIDEO_KIND = "h", "a", "v"
+
+
+def _columns(table):
+    post_id = HOT.c.id.label("post_id") if table is HOT else COLD.c.post_id
+    c = table.c
+    return [c.id, post_id, c.url, c.body, c.timestamp, c.user_id, c.video_id]
+
+
+def _newest(table, where, offset=0, limit=None):
+    query = select(_columns(table)).where(where)
+    query = query.order_by(table.c.timestamp.desc(), table.c.id.desc())
+    return query.offset(offset or None).limit(limit)
+
+
+def _older(table, timestamp, key):
+    """ Rows after `(timestamp, key)` in `_newest` order. """
+    return or_(
+        table.c.timestamp < timestamp,
+        and_(table.c.timestamp == timestamp, table.c.id < key),
+    )
+
+
+def encode_cursor(kind, timestamp, key):
+    value = json.dumps([kind, timestamp.strftime(CURSOR_TIME), key])
+    return base64.urlsafe_b64encode(value.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor, kinds=(HOT_KIND, COLD_KIND, VIDEO_KIND)):
+    """ `(kind, timestamp, key)`; raises `ValueError` for anything malformed.
+
+    So does a cursor whose kind isn't one of `kinds`, the kinds the list being
+    continued hands out: a video cursor can't continue a list of posts.
+    """
+    try:
+        kind, timestamp, key = json.loads(base64.urlsafe_b64decode(cursor))
+        timestamp = datetime.strptime(timestamp, CURSOR_TIME)
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor.") from e
+    # Posts are keyed by their integer id, videos by their YouTube id.
+    key_type = str if kind == VIDEO_KIND else int
+    if kind not in kinds or type(key) is not key_type:
+        raise ValueError("Invalid cursor.")
+    return kind, timestamp, key
+
+
+def card_cursor(card, collapse=False):
+    """ The cursor that continues a list after `card`. """
+    if card.timestamp is None:
+        return None
+    if collapse:
+        return encode_cursor(VIDEO_KIND, card.timestamp, card.video_id)
+    kind = COLD_KIND if card.archived else HOT_KIND
+    return encode_cursor(kind, card.timestamp, card.id)
+
+
+def _count(session, table, where):
+    query = select([func.count()]).select_from(table).where(where)
+    return session.execute(query).scalar()
+
+
+def _newest_first(row):
+    return (row.timestamp or datetime.min, row.id)
+
+
+def _cards(rows):
+    """ Turn hot post rows into `PostCard`s, loading their authors in one query. """
+    ids = {row.user_id for row in rows}
+    authors = {}
+    if ids:
+        query = select([USERS.c.id, USERS.c.username]).where(USERS.c.id.in_(ids))
+        authors = {row.id: Author(*row) for row in reader().execute(query)}
+    return [
+        PostCard(*row, archived=False, author=authors.get(row.user_id))
+        for row in rows
+    ]
+
+
+def _paginate(wheres, page, per_page):
+    """ A page of the hot posts matching `{shard index: where}`, newest first. """
+    sessions = shards.read_sessions()
+    start = (page - 1) * per_page
+    if len(wheres) == 1:
+        [(index, where)] = wheres.items()
+        session = sessions[index]
+        rows = session.execute(_newest(HOT, where, start, per_page)).fetchall()
+        total = _count(session, HOT, where)
+    else:
+        # Same k-way merge as `ShardRouter._merge`.
+        results, total = [], 0
+        for index, where in sorted(wheres.items()):
+            session = sessions[index]
+            query = _newest(HOT, where, limit=page * per_page)
+            results.append(session.execute(query).fetchall())
+            total += _count(session, HOT, where)
+        merged = heapq.merge(*results, key=_newest_first, reverse=True)
+        rows = list(islice(merged, start, page * per_page))
+    return Pagination(None, page, per_page, total, _cards(rows))
+
+
+def discover(page, per_page, collapse=False):
+    """ The newest posts of everyone; with `collapse`, one per video.
+
+    Collapsed pages list videos by their latest post (`video.last_posted_at`)
+    and show that post, so each video appears once however often it was
+    posted. Posts without a recognized video are left out.
+    """
+    if collapse:
+        return _discover_videos(page, per_page)
+    return _paginate(_everyone(), page, per_page)
+
+
+def discover_after(cursor, limit, collapse=False):
+    if collapse:
+        return _discover_videos_after(cursor, limit)
+    return _cards_after(_everyone(), cursor, limit)
+
+
+def _everyone():
+    return {index: true() for index in range(len(shards.read_sessions()))}
+
+
+_LISTED = VIDEOS.c.last_post_id.isnot(None)
+
+
+def _latest_videos(where):
+    return (
+        select([VIDEOS.c.last_poster_id, VIDEOS.c.last_post_id])
+        .where(where)
+        .order_by(VIDEOS.c.last_posted_at.desc(), VIDEOS.c.id)
+    )
+
+
+def _discover_videos(page, per_page):
+    query = _latest_videos(_LISTED).offset((page - 1) * per_page).limit(per_page)
+    keys = [tuple(row) for row in reader().execute(query)]
+    total = _count(reader(), VIDEOS, _LISTED)
+    return Pagination(None, page, per_page, total, _video_cards(keys))
+
+
+def _discover_videos_after(cursor, limit):
+    where = _LISTED
+    if cursor is not None:
+        kind, timestamp, key = cursor
+        where = and_(
+            where,
+            or_(
+                VIDEOS.c.last_posted_at < timestamp,
+                and_(VIDEOS.c.last_posted_at == timestamp, VIDEOS.c.id > key),
+            ),
+        )
+    query = _latest_videos(where).column(VIDEOS.c.last_posted_at)
+    query = query.column(VIDEOS.c.id.label("video_id")).limit(limit + 1)
+    rows = reader().execute(query).fetchall()
+    items = _video_cards([tuple(row)[:2] for row in rows[:limit]])
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(VIDEO_KIND, last.last_posted_at, last.video_id)
+    return items, next_cursor
+
+
+def _video_cards(keys):
+    """ Cards of the `(user id, post id)` latest posts of videos, in order. """
+    by_shard = {}
+    for user_id, post_id in keys:
+        by_shard.setdefault(shards.index_for(user_id), []).append(post_id)
+    rows = {}
+    for index, ids in by_shard.items():
+        query = select(_columns(HOT)).where(HOT.c.id.in_(ids))
+        for row in shards.read_sessions()[index].execute(query):
+            rows[row.user_id, row.id] = row
+    # A post deleted since the video was last updated is skipped.
+    return _cards([rows[key] for key in keys if key in rows])
+
+
+def _cards_after(wheres, cursor, limit):
+    """ Up to `limit` hot posts matching `{shard index: where}` after `cursor`. """
+    if cursor is not None:
+        kind, timestamp, key = cursor
+        older = _older(HOT, timestamp, key)
+        wheres = {index: and_(where, older) for index, where in wheres.items()}
+    sessions = shards.read_sessions()
+    results = [
+        sessions[index].execute(_newest(HOT, where, limit=limit + 1)).fetchall()
+        for index, where in sorted(wheres.items())
+    ]
+    merged = heapq.merge(*results, key=_newest_first, reverse=True)
+    rows = list(islice(merged, limit + 1))
+    items = _cards(rows[:limit])
+    return items, card_cursor(items[-1]) if len(rows) > limit else None
+
+
+def _feed_wheres(user):
+    if not shards.enabled:
+        followed = select([followers.c.followed_id]).where(
+            followers.c.follower_id == user.id
+        )
+        return {0: HOT.c.user_id.in_(followed) | (HOT.c.user_id == user.id)}
+    by_shard = {}
+    for user_id in shards.followed_ids(user) | {user.id}:
+        by_shard.setdefault(shards.index_for(user_id), []).append(user_id)
+    return {index: HOT.c.user_id.in_(ids) for index, ids in by_shard.items()}
+
+
+def feed(user, page, per_page):
+    return _paginate(_feed_wheres(user), page, per_page)
+
+
+def feed_after(user, cursor, limit):
+    return _cards_after(_feed_wheres(user), cursor, limit)
+
+
+def user_posts(user, page, per_page):
+    """ A user's posts, continuing into the archive like `ShardRouter.user_posts`. """
+    session = shards.read_sessions()[shards.index_for(user.id)]
+    hot_where, cold_where = HOT.c.user_id == user.id, COLD.c.user_id == user.id
+    start = (page - 1) * per_page
+    hot_total = _count(session, HOT, hot_where)
+    # Every card has the same author, who is already loaded.
+    author = Author(user.id, user.username)
+    items = []
+    if start < hot_total:
+        query = _newest(HOT, hot_where, start, per_page)
+        items = [
+            PostCard(*row, archived=False, author=author)
+            for row in session.execute(query)
+        ]
+    if len(items) < per_page:
+        query = _newest(
+            COLD, cold_where, max(start - hot_total, 0), per_page - len(items)
+        )
+        items += [
+            PostCard(*row, archived=True, author=author)
+            for row in session.execute(query)
+        ]
+    total = hot_total + _count(session, COLD, cold_where)
+    return Pagination(None, page, per_page, total, items)
+
+
+def user_posts_after(user, cursor, limit):
+    """ `user_posts` by cursor: the hot posts, then the archive from its start. """
+    session = shards.read_sessions()[shards.index_for(user.id)]
+    kind, timestamp, key = cursor or (HOT_KIND, None, None)
+    author = Author(user.id, user.username)
+    rows = []
+    if kind == HOT_KIND:
+        where = HOT.c.user_id == user.id
+        if timestamp is not None:
+            where = and_(where, _older(HOT, timestamp, key))
+        query = _newest(HOT, where, limit=limit + 1)
+        rows = [(row, False) for row in session.execute(query)]
+        timestamp = None
+    if len(rows) <= limit:
+        where = COLD.c.user_id == user.id
+        if timestamp is not None:
+            where = and_(where, _older(COLD, timestamp, key))
+        query = _newest(COLD, where, limit=limit + 1 - len(rows))
+        rows += [(row, True) for row in session.execute(query)]
+    items = [
+        PostCard(*row, archived=archived, author=author)
+        for row, archived in rows[:limit]
+    ]
+    return items, card_cursor(items[-1]) if len(rows) > limit else None
+
+
+def followed_users(user):
+    """ The users `user` follows, as `Author`s ordered by username. """
+    ids = shards.followed_ids(user)
+    if not ids:
+        return []
+    query = (
+        select([USERS.c.id, USERS.c.username])
+        .where(USERS.c.id.in_(ids))
+        .order_by(USERS.c.username)
+    )
+    return [Author(*row) for row in reader().execute(query)]
@@ -1,7 +1,24 @@
-from flask import g, render_template, flash, redirect, url_for, request
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    current_app,
+    g,
+    render_template,
+    flash,
+    make_response,
+    redirect,
+    send_file,
+    url_for,
+    request,
+)
 from flask_login import login_user, logout_user, current_user, login_required
+from sqlalchemy.exc import IntegrityError
 from werkzeug.urls import url_parse
-from flask_server import flask_server, db
+from flask_server import db, readmodel, tokens, videos
+from flask_server.bloom import usernames
+from flask_server.breaker import breaker, serve_stale, writes
+from flask_server.pagecache import cache
 from flask_server.forms import (
     LoginForm,
     RegistrationForm,
@@ -10,36 +27,88 @@ from flask_server.forms import (
     ResetPWForm,
     EditProfileForm,
 )
-from flask_server.models import User, Post
+from flask_server.models import User, Post, PostStats
+from flask_server.pubsub import broker
+from flask_server.sharding import shards
+from flask_server.videos import video_id
 from datetime import datetime
 from functools import wraps
+import json
 
+bp = Blueprint("main", __name__)
 methods = ["GET", "POST"]
 
 
-@flask_server.route("/")
+@bp.route("/")
 def index():
-    return redirect(url_for("discover"))
+    return redirect(url_for("main.discover"))
 
 
-@flask_server.route("/discover")
+@bp.route("/discover")
+@serve_stale
 def discover():
     page = request.args.get("page", 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, flask_server.config["POSTS_PER_PAGE"], False
+    per_page = current_app.config["POSTS_PER_PAGE"]
+    collapse = current_app.config["DISCOVER_COLLAPSE_VIDEOS"]
+    posts = cache().fetch(
+        "discover:{}:{}:{}".format(page, per_page, collapse),
+        lambda: readmodel.discover(page, per_page, collapse),
     )
-    next_url = url_for("discover", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("discover", page=posts.prev_num) if posts.has_prev else None
+    next_url = url_for("main.discover", page=posts.next_num) if posts.has_next else None
+    prev_url = url_for("main.discover", page=posts.prev_num) if posts.has_prev else None
     return render_template(
         "discover.html",
         title="Argus",
         posts=posts.items,
         next_url=next_url,
         prev_url=prev_url,
+        cards_url=url_for("main.discover_cards"),
+        cursor=_next_cursor(posts, collapse),
     )
 
 
-@flask_server.route("/login", methods=methods)
+@bp.route("/discover/cards")
+def discover_cards():
+    collapse = current_app.config["DISCOVER_COLLAPSE_VIDEOS"]
+    cursor = _cursor_arg(readmodel.VIDEO_KIND if collapse else readmodel.HOT_KIND)
+    limit = current_app.config["POSTS_PER_FRAGMENT"]
+    key = "discover-cards:{}:{}:{}".format(request.args.get("cursor"), limit, collapse)
+    items, next_cursor = cache().fetch(
+        key, lambda: readmodel.discover_after(cursor, limit, collapse)
+    )
+    return _cards(items, next_cursor)
+
+
+def _next_cursor(posts, collapse=False):
+    """ Where infinite scroll continues after a page, if there is more. """
+    if not posts.has_next or not posts.items:
+        return None
+    return readmodel.card_cursor(posts.items[-1], collapse)
+
+
+def _cursor_arg(*kinds):
+    try:
+        return readmodel.decode_cursor(request.args["cursor"], kinds)
+    except KeyError:
+        return None
+    except ValueError:
+        abort(400)
+
+
+def _cards(items, next_cursor):
+    """ Just the post cards, which `script.js` appends to the list on the page.
+
+    The cursor of the following cards is in the `X-Next-Cursor` header, which is
+    missing after the last card.
+    """
+    response = make_response(render_template("_cards.html", posts=items))
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
+
+
+@bp.route("/login", methods=methods)
+@writes
 def login():
     """ The controller to handle incoming GET and POST requests to the `/login` URL of the Flask web server.
 
@@ -76,22 +145,23 @@ def login():
         The login/signup page of the app, as generated by the `templates/login` Jinja2 template.
     """
     if current_user.is_authenticated:
-        return redirect(url_for("feed"))
+        return redirect(url_for("main.feed"))
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
         if user is None or not user.check_password(form.password.data):
             flash("Invalid username or password")
-            return redirect(url_for("login"))
+            return redirect(url_for("main.login"))
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get("next")
         if not next_page or url_parse(next_page).netloc != "":
-            next_page = url_for("feed")
+            next_page = url_for("main.feed")
         return redirect(next_page)
     return render_template("login.html", title="Log In", form=form)
 
 
-@flask_server.route("/feed")
+@bp.route("/feed")
+@serve_stale
 @login_required
 def feed():
     """ The controller to handle incoming GET requests to the root and `/index` URLs of the Flask web server.
@@ -128,21 +198,69 @@ def feed():
         The index page of the app, as generated by the `templates/index` Jinja2 template.
     """
     page = request.args.get("page", 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page, flask_server.config["POSTS_PER_PAGE"], False
-    )
-    next_url = url_for("feed", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("feed", page=posts.prev_num) if posts.has_prev else None
+    posts = readmodel.feed(current_user, page, current_app.config["POSTS_PER_PAGE"])
+    next_url = url_for("main.feed", page=posts.next_num) if posts.has_next else None
+    prev_url = url_for("main.feed", page=posts.prev_num) if posts.has_prev else None
     return render_template(
         "feed.html",
         title="My Feed",
         posts=posts.items,
         next_url=next_url,
         prev_url=prev_url,
+        cards_url=url_for("main.feed_cards"),
+        cursor=_next_cursor(posts),
     )
 
 
-@flask_server.route("/logout")
+@bp.route("/feed/cards")
+@login_required
+def feed_cards():
+    cursor = _cursor_arg(readmodel.HOT_KIND)
+    limit = current_app.config["POSTS_PER_FRAGMENT"]
+    return _cards(*readmodel.feed_after(current_user, cursor, limit))
+
+
+@bp.route("/stream")
+@login_required
+def stream():
+    """ Server-Sent Events stream of new posts by the users the viewer follows.
+
+    Every new post is sent as a `post` event whose data is
+    `{"post_id": ..., "user_id": ...}`. A comment line goes out every
+    `SSE_HEARTBEAT_SECONDS` to keep proxies from closing an idle connection and
+    to notice clients that went away. If the client fell so far behind that
+    buffered events were dropped, a `reload` event tells it to refetch the feed.
+
+    The topics are looked up before streaming starts; the generator itself
+    touches neither the database nor the request context.
+    """
+    topics = shards.followed_ids(current_user) | {current_user.id}
+    heartbeat = current_app.config["SSE_HEARTBEAT_SECONDS"]
+    posts = broker()
+
+    def events():
+        subscription = posts.subscribe(topics)
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                messages, dropped = subscription.get(heartbeat)
+                if dropped:
+                    yield "event: reload\ndata: {}\n\n".format(dropped)
+                for message in messages:
+                    yield "event: post\ndata: {}\n\n".format(json.dumps(message))
+                if not messages and not dropped:
+                    yield ": heartbeat\n\n"
+        finally:
+            posts.unsubscribe(subscription)
+
+    return Response(
+        events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@bp.route("/logout")
 def logout():
     """ The controller to handle incoming GET requests to the `/logout` URL of the Flask web server.
 
@@ -161,10 +279,11 @@ def logout():
     """
     logout_user()
     flash("Logged out!")
-    return redirect(url_for("discover"))
+    return redirect(url_for("main.discover"))
 
 
-@flask_server.route("/create", methods=methods)
+@bp.route("/create", methods=methods)
+@writes
 @login_required
 def create_post():
     """ The controller to handle incoming GET and POST requests to the `/create` URL of the Flask web server.
@@ -190,24 +309,43 @@ def create_post():
     form = PostForm()
     time = datetime.utcnow()
     if form.validate_on_submit():
+        session = shards.session_for(current_user.id)
         try:
-            post = Post(user_id=current_user.id, url=form.url.data, body=form.body.data)
-            db.session.add(post)
+            video = video_id(form.url.data)
+            videos.ensure(db.session, video)
+            post = Post(
+                user_id=current_user.id,
+                url=form.url.data,
+                video_id=video,
+                body=form.body.data,
+            )
+            session.add(post)
+            session.flush()
+            videos.post_added(db.session, post)
+            # One transaction unless the post went to a shard: then the video
+            # follows right after it (`flask videos recount` repairs a gap).
+            session.commit()
             db.session.commit()
+            cache().invalidate()
+            message = {"post_id": post.id, "user_id": post.user_id}
+            broker().publish(current_user.id, message)
             flash("Congratulations, you have successfully created a post!")
-            return redirect(url_for("index"))
+            return redirect(url_for("main.index"))
         except:
+            session.rollback()
+            db.session.rollback()
             flash("Sorry, there was an error creating your post!")
-            return redirect(url_for("index"))
+            return redirect(url_for("main.index"))
     return render_template("create.html", title="Create Post", form=form)
 
 
-@flask_server.route("/delete/<int:id>")
+@bp.route("/delete/<int:id>")
+@writes
 @login_required
 def delete(id):
     """ The controller to handle incoming GET requests to the `/delete` URL of the web server.
     
-    1. Queries the SQL datatbase for the post with the specified `id`. 
+    1. Queries the logged-in user's shard for the post with the specified `id`. 
     
     2. If the post was created by the logged-in user, then a row is deleted from the Posts table in the SQL database.
         
@@ -223,25 +361,35 @@ def delete(id):
     str
         The index page generated by the Jinja2 template.
     """
-    post_to_delete = Post.query.get_or_404(id)
-    if post_to_delete.user_id is not current_user.id:
+    session = shards.session_for(current_user.id)
+    post_to_delete = shards.get_post(current_user.id, id)
+    if post_to_delete is None:
+        abort(404)
+    if post_to_delete.user_id != current_user.id:
         flash("Sorry, you are not authorized to delete that post!")
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
     try:
-        db.session.delete(post_to_delete)
-        db.session.commit()
+        session.delete(post_to_delete)
+        stats = session.query(PostStats).filter_by(author_id=current_user.id, post_id=id)
+        stats.delete()
+        session.commit()
+        videos.refresh(db.session, [post_to_delete.video_id])
+        cache().invalidate()
         flash("Congratulations, you have successfully deleted a post!")
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
     except:
+        session.rollback()
         flash("Sorry, there was an error deleting your post.")
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
 
 
-@flask_server.route("/update/<int:id>", methods=methods)
+@bp.route("/update/<int:id>", methods=methods)
+@writes
+@login_required
 def update(id):
     """ The controller to handle incoming GET and POST requests to the `/update` URL of the web server.
     
-    1. Queries the SQL datatbase for the post with the specified `id`. 
+    1. Queries the logged-in user's shard for the post with the specified `id`. 
     
     2. If the post was created by the logged-in user, then the controller makes the `UpdatePostForm` created using Flask-WTF available to the `templates/update` view by passing the view and the form as parameters to Flask's built-in `render_template()` function.
     
@@ -259,29 +407,40 @@ def update(id):
     str
         The update page, as generated by the `templates/update` Jinja2 template.
     """
-    post_to_update = Post.query.get_or_404(id)
-    if post_to_update.user_id is not current_user.id:
+    session = shards.session_for(current_user.id)
+    post_to_update = shards.get_post(current_user.id, id)
+    if post_to_update is None:
+        abort(404)
+    if post_to_update.user_id != current_user.id:
         flash("Sorry, you are not authorized to update that post!")
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
     form = UpdateForm()
     time = datetime.utcnow()
     if form.validate_on_submit():
         try:
+            old_video, new_video = post_to_update.video_id, video_id(form.url.data)
+            if new_video != old_video:
+                videos.ensure(db.session, new_video)
             post_to_update.url = form.url.data
+            post_to_update.video_id = new_video
             post_to_update.body = form.body.data
-            db.session.add(post_to_update)
-            db.session.commit()
+            session.commit()
+            if new_video != old_video:
+                videos.refresh(db.session, [old_video, new_video])
+            cache().invalidate()
             flash("Congratulations, you have successfully updated a post!")
-            return redirect(url_for("index"))
+            return redirect(url_for("main.index"))
         except:
+            session.rollback()
             flash("Sorry, there was an error updating your post!")
-            return redirect(url_for("index"))
+            return redirect(url_for("main.index"))
     return render_template(
         "update.html", title="Update Post", form=form, post=post_to_update
     )
 
 
-@flask_server.route("/register", methods=methods)
+@bp.route("/register", methods=methods)
+@writes
 def register():
     """ The controller to handle incoming GET and POST requests to the `/register` URL of the Flask web server.
 
@@ -293,6 +452,7 @@ def register():
             - Results from a GET request from an unauthenticated user.
 
     2. If a valid username/pw/email combo is submitted, then an HTTP request is made to the remote SQL database requesting to insert a new row into the Users table. 
+        - Taken usernames and emails are not looked up beforehand: the unique indexes reject the INSERT, and only then is the database asked which of the two was taken.
 
     4. The user is redirected to the `login` view. 
 
@@ -307,7 +467,7 @@ def register():
         The register page generated by the Jinja2 template.
     """
     if current_user.is_authenticated:
-        return redirect(url_for("feed"))
+        return redirect(url_for("main.feed"))
     form = RegistrationForm()
     if form.validate_on_submit():
         try:
@@ -315,15 +475,24 @@ def register():
             user.set_password(form.password.data)
             db.session.add(user)
             db.session.commit()
+            usernames().add(user)
             flash("Congratulations, you are now a registered user!")
-            return redirect(url_for("login"))
+            return redirect(url_for("main.login"))
+        except IntegrityError:
+            db.session.rollback()
+            if User.query.filter_by(username=form.username.data).first() is not None:
+                form.username.errors.append("Please use a different username.")
+            else:
+                form.email.errors.append("Please use a different email address.")
         except:
+            db.session.rollback()
             flash("Sorry, there was an error registering your account!")
-            return redirect(url_for("register"))
+            return redirect(url_for("main.register"))
     return render_template("register.html", title="Register", form=form)
 
 
-@flask_server.route("/reset-pw", methods=methods)
+@bp.route("/reset-pw", methods=methods)
+@writes
 @login_required
 def reset_pw():
     """ The controller to handle incoming GET and POST requests to the `/reset-pw` URL of the Flask web server.
@@ -357,31 +526,40 @@ def reset_pw():
             db.session.commit()
             flash("Congratulations, you have updated your password!")
             logout_user()
-            return redirect(url_for("login"))
+            return redirect(url_for("main.login"))
         except:
             flash("Sorry, there was an error updating your password!")
-            return redirect(url_for("reset-pw"))
+            return redirect(url_for("main.reset_pw"))
     return render_template("reset-pw.html", title="Reset Password", form=form)
 
 
-@flask_server.route("/user/<username>")
+@bp.route("/user/<username>")
+@serve_stale
 @login_required
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
     page = request.args.get("page", 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, flask_server.config["POSTS_PER_PAGE"], False
+    per_page = current_app.config["POSTS_PER_PAGE"]
+    posts = cache().fetch(
+        "user:{}:{}:{}".format(user.id, page, per_page),
+        lambda: readmodel.user_posts(user, page, per_page),
     )
     next_url = (
         url_for(
-            "user", title="User Profile", username=user.username, page=posts.next_num
+            "main.user",
+            title="User Profile",
+            username=user.username,
+            page=posts.next_num,
         )
         if posts.has_next
         else None
     )
     prev_url = (
         url_for(
-            "user", title="User Profile", username=user.username, page=posts.prev_num
+            "main.user",
+            title="User Profile",
+            username=user.username,
+            page=posts.prev_num,
         )
         if posts.has_prev
         else None
@@ -390,30 +568,80 @@ def user(username):
         "user.html",
         title="User Profile",
         user=user,
+        following_count=len(shards.followed_ids(user)),
+        is_following=shards.is_following(current_user, user),
         posts=posts.items,
         next_url=next_url,
         prev_url=prev_url,
+        cards_url=url_for("main.user_cards", username=user.username),
+        cursor=_next_cursor(posts),
     )
 
 
-@flask_server.route("/user/<username>/following")
+@bp.route("/user/<username>/cards")
+@login_required
+def user_cards(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    cursor = _cursor_arg(readmodel.HOT_KIND, readmodel.COLD_KIND)
+    limit = current_app.config["POSTS_PER_FRAGMENT"]
+    key = "user-cards:{}:{}:{}".format(user.id, request.args.get("cursor"), limit)
+    items, next_cursor = cache().fetch(
+        key, lambda: readmodel.user_posts_after(user, cursor, limit)
+    )
+    return _cards(items, next_cursor)
+
+
+@bp.route("/user/<username>/following")
+@serve_stale
 @login_required
 def following(username):
     user = User.query.filter_by(username=username).first_or_404()
-    usernames = user.followed_users()
+    usernames = readmodel.followed_users(user)
     return render_template(
         "following.html", title="Following", user=user, usernames=usernames
     )
 
 
-@flask_server.route("/edit_profile", methods=["GET", "POST"])
+@bp.route("/avatar/<int:user_id>/<int:size>")
+def avatar(user_id, size):
+    """ Serve a user's avatar from the local cache (see `flask_server/avatars.py`).
+
+    The `v` query argument is the user's email digest, so the URL changes with
+    the email address and the image can be cached forever by browsers.
+    """
+    if size not in current_app.config["AVATAR_SIZES"]:
+        abort(404)
+    user = User.query.get_or_404(user_id)
+    digest = user.avatar_digest()
+    if request.args.get("v") != digest:
+        return redirect(url_for("main.avatar", user_id=user_id, size=size, v=digest))
+    avatar = current_app.extensions["avatars"].get(user, size)
+    response = send_file(avatar.path, mimetype=avatar.mimetype, add_etags=False)
+    response.set_etag(avatar.sha)
+    if avatar.fallback:
+        # Only until the real avatar can be fetched again.
+        response.headers["Cache-Control"] = "public, max-age=300"
+    else:
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response.make_conditional(request)
+
+
+@bp.route("/edit_profile", methods=["GET", "POST"])
+@writes
 @login_required
 def edit_profile():
     form = EditProfileForm(current_user.username)
     if form.validate_on_submit():
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Taken since the form was validated, e.g. through another worker.
+            db.session.rollback()
+            form.username.errors.append("Please use a different username.")
+            return render_template("edit_profile.html", title="Edit Profile", form=form)
+        usernames().add(current_user)
         flash("Your changes have been saved.")
         return redirect("/user/" + current_user.username)
     elif request.method == "GET":
@@ -422,39 +650,44 @@ def edit_profile():
     return render_template("edit_profile.html", title="Edit Profile", form=form)
 
 
-@flask_server.before_request
+@bp.before_app_request
 def before_request():
+    # API token requests don't load the user at all.
+    if breaker().is_open or tokens.bearer_token() is not None:
+        return
     if current_user.is_authenticated:
         current_user.last_seen = datetime.utcnow()
 
 
-@flask_server.route("/follow/<username>")
+@bp.route("/follow/<username>")
+@writes
 @login_required
 def follow(username):
     user = User.query.filter_by(username=username).first()
     if user is None:
         flash("User {} not found.".format(username))
-        return redirect(url_for("feed"))
+        return redirect(url_for("main.feed"))
     if user == current_user:
         flash("You cannot follow yourself!")
-        return redirect(url_for("user", username=username))
-    current_user.follow(user)
-    db.session.commit()
+        return redirect(url_for("main.user", username=username))
+    shards.follow(current_user, user)
+    shards.session_for(current_user.id).commit()
     flash("You are following {}!".format(username))
-    return redirect(url_for("user", title="User Profile", username=username))
+    return redirect(url_for("main.user", title="User Profile", username=username))
 
 
-@flask_server.route("/unfollow/<username>")
+@bp.route("/unfollow/<username>")
+@writes
 @login_required
 def unfollow(username):
     user = User.query.filter_by(username=username).first()
     if user is None:
         flash("User {} not found.".format(username))
-        return redirect(url_for("feed"))
+        return redirect(url_for("main.feed"))
     if user == current_user:
         flash("You cannot unfollow yourself!")
-        return redirect(url_for("user", title="User Profile", username=username))
-    current_user.unfollow(user)
-    db.session.commit()
+        return redirect(url_for("main.user", title="User Profile", username=username))
+    shards.unfollow(current_user, user)
+    shards.session_for(current_user.id).commit()
     flash("You are not following {}.".format(username))
-    return redirect(url_for("user", title="User Profile", username=username))
+    return redirect(url_for("main.user", title="User Profile", username=username))
@@ -0,0 +1,517 @@
+""" Horizontal sharding of posts and follow edges by user id.
+
+Users stay in the main database (`SQLALCHEMY_DATABASE_URI`). When
+`SHARD_DATABASE_URIS` lists N databases, the `post` and `followers` rows owned
+by a user live on shard `user_id % N`: a user's posts on their shard, and the
+edges *from* a user (whom they follow) on theirs. Every route that touches
+posts or follow edges goes through `shards`:
+
+    - writes and single-user reads (`create_post`, `update`, `delete`, `user`,
+      follow/unfollow) go to the owning shard only;
+    - `discover` and `feed` query the shards involved and k-way merge the
+      results by timestamp.
+
+Without `SHARD_DATABASE_URIS` there is a single "shard", the main database and
+`db.session`, so the app behaves exactly as before.
+
+Shard schemas are created with `flask shards init` and brought up to date with
+`flask shards upgrade` (`flask db upgrade` only migrates the main database);
+`flask shards rebalance` moves rows into a new set of shards.
+"""
+import heapq
+from datetime import datetime
+from itertools import islice
+
+import click
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from flask import current_app
+from flask.cli import AppGroup
+from flask_sqlalchemy import BaseQuery, Pagination
+from sqlalchemy import (
+    Column,
+    Index,
+    MetaData,
+    Table,
+    create_engine,
+    func,
+    inspect,
+    select,
+    text,
+)
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
+from flask_server import db
+from flask_server.models import User, Post, ArchivedPost, PostStats, followers
+from flask_server.sqlite import reader
+
+SHARDED_TABLES = [
+    Post.__table__,
+    ArchivedPost.__table__,
+    PostStats.__table__,
+    followers,
+]
+# The column holding the user whose shard a row lives on.
+OWNER_COLUMNS = {
+    "post": "user_id",
+    "post_archive": "user_id",
+    "post_stats": "author_id",
+    "followers": "follower_id",
+}
+
+
+def shard_metadata():
+    """ Copies of the sharded tables without their foreign keys.
+
+    The `user` table they point at lives in the main database, so the
+    constraints can't be enforced on a shard; the columns get plain indexes
+    instead.
+    """
+    metadata = MetaData()
+    for table in SHARDED_TABLES:
+        copy = Table(
+            table.name,
+            metadata,
+            *[
+                Column(
+                    column.name,
+                    column.type,
+                    primary_key=column.primary_key,
+                    nullable=column.nullable,
+                )
+                for column in table.columns
+            ],
+            **table.dialect_kwargs
+        )
+        # A composite primary key already indexes its first column.
+        indexed = {column.name for column in list(table.primary_key.columns)[:1]}
+        for index in table.indexes:
+            columns = [copy.c[column.name] for column in index.columns]
+            Index(index.name, *columns, unique=index.unique)
+            indexed.add(columns[0].name)
+        for column in table.columns:
+            if column.foreign_keys and column.name not in indexed:
+                Index("ix_{}_{}".format(table.name, column.name), copy.c[column.name])
+    return metadata
+
+
+def reuses_post_ids(engine):
+    """ Whether `post` on `engine` may give a new post the id of a deleted one.
+
+    SQLite does, unless the table was created with AUTOINCREMENT.
+    """
+    if engine.dialect.name != "sqlite":
+        return False
+    query = text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'post'")
+    with engine.connect() as connection:
+        sql = connection.execute(query).scalar()
+    return sql is not None and "AUTOINCREMENT" not in sql.upper()
+
+
+def _add_missing_columns(engine, metadata):
+    # Columns added to the models since the shard was created are all
+    # nullable, so they can be added as they are, with their indexes.
+    added = []
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        operations = Operations(MigrationContext.configure(connection))
+        for table in metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    operations.add_column(table.name, column.copy())
+                    added.append("{}.{}".format(table.name, column.name))
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+    return added
+
+
+def upgrade_schema(engine):
+    """ Bring a shard created by an earlier version up to `shard_metadata()`.
+
+    Returns the `table.column` names that were added.
+    """
+    metadata = shard_metadata()
+    metadata.create_all(engine)
+    added = _add_missing_columns(engine, metadata)
+    if reuses_post_ids(engine):
+        _autoincrement_post_ids(engine)
+    return added
+
+
+def _autoincrement_post_ids(engine):
+    with engine.begin() as connection:
+        operations = Operations(MigrationContext.configure(connection))
+        with operations.batch_alter_table(
+            "post", recreate="always", table_kwargs={"sqlite_autoincrement": True}
+        ):
+            pass
+        seed_post_ids(connection)
+
+
+def seed_post_ids(connection):
+    """ Make new posts' ids higher than every id a post has had.
+
+    Archived posts and stats included, which keep the ids of posts that are
+    gone from `post`, so the database's own counter may be behind them.
+    """
+    last = max(
+        connection.execute(select([func.max(column)])).scalar() or 0
+        for column in (
+            Post.__table__.c.id,
+            ArchivedPost.__table__.c.post_id,
+            PostStats.__table__.c.post_id,
+        )
+    )
+    dialect = connection.dialect.name
+    if dialect == "sqlite":
+        connection.execute(text("DELETE FROM sqlite_sequence WHERE name = 'post'"))
+        connection.execute(
+            text("INSERT INTO sqlite_sequence (name, seq) VALUES ('post', :seq)"),
+            seq=last,
+        )
+    elif dialect == "postgresql":
+        connection.execute(
+            text("SELECT setval(pg_get_serial_sequence('post', 'id'), :seq, false)"),
+            seq=last + 1,
+        )
+    elif dialect == "mysql":
+        connection.execute(
+            text("ALTER TABLE post AUTO_INCREMENT = {}".format(last + 1))
+        )
+
+
+def _newest_first(post):
+    return (post.timestamp or datetime.min, post.id)
+
+
+class _ShardState(object):
+    def __init__(self, uris):
+        self.engines = [create_engine(uri) for uri in uris]
+        self.sessions = [
+            scoped_session(sessionmaker(bind=engine, query_cls=BaseQuery))
+            for engine in self.engines
+        ]
+
+
+class ShardRouter(object):
+    def init_app(self, app):
+        app.extensions["shards"] = _ShardState(app.config["SHARD_DATABASE_URIS"])
+        app.teardown_appcontext(self._remove_sessions)
+        app.cli.add_command(shards_cli)
+
+    @property
+    def _state(self):
+        return current_app.extensions["shards"]
+
+    def _remove_sessions(self, exception=None):
+        for session in self._state.sessions:
+            session.remove()
+
+    @property
+    def enabled(self):
+        return bool(self._state.engines)
+
+    def engines(self):
+        return self._state.engines or [db.engine]
+
+    def sessions(self):
+        return self._state.sessions or [db.session]
+
+    def read_sessions(self):
+        """ Like `sessions()`, through the SQLite reader pool if there is one. """
+        return self._state.sessions or [reader()]
+
+    def index_for(self, user_id):
+        return user_id % len(self.sessions())
+
+    def session_for(self, user_id):
+        return self.sessions()[self.index_for(user_id)]
+
+    def dispose(self, app):
+        for engine in app.extensions["shards"].engines:
+            engine.dispose()
+
+    def create_schema(self):
+        if not self.enabled:
+            return
+        metadata = shard_metadata()
+        for engine in self.engines():
+            metadata.create_all(engine)
+
+    def attach_authors(self, posts):
+        """ Load the authors of `posts` from the main database in one query.
+
+        Posts read from a shard can't lazy-load `post.author` (the `user` table
+        isn't there), and for the main database this saves one query per card.
+        """
+        ids = {post.user_id for post in posts}
+        if not ids:
+            return posts
+        authors = {user.id: user for user in User.query.filter(User.id.in_(ids))}
+        for post in posts:
+            set_committed_value(post, "author", authors.get(post.user_id))
+        return posts
+
+    def _merge(self, queries, page, per_page):
+        """ Paginate the union of `queries` (all newest first) by k-way merge.
+
+        Each shard returns at most `page * per_page` rows, so the cost grows with
+        the page number; the first pages, which get nearly all the traffic, stay
+        cheap.
+        """
+        window = page * per_page
+        results = [query.limit(window).all() for query in queries]
+        total = sum(query.order_by(None).count() for query in queries)
+        merged = heapq.merge(*results, key=_newest_first, reverse=True)
+        items = list(islice(merged, (page - 1) * per_page, window))
+        return Pagination(None, page, per_page, total, items)
+
+    def _newest(self, query):
+        return query.order_by(Post.timestamp.desc(), Post.id.desc())
+
+    def get_post(self, owner_id, post_id):
+        """ Return post `post_id` if it is stored on `owner_id`'s shard. """
+        return self.session_for(owner_id).query(Post).get(post_id)
+
+    def user_posts(self, user, page, per_page):
+        """ A user's posts, newest first, continuing into their archived posts.
+
+        The archive is only read once the hot posts on the page run out.
+        """
+        session = self.session_for(user.id)
+        hot = self._newest(session.query(Post).filter_by(user_id=user.id))
+        cold = session.query(ArchivedPost).filter_by(user_id=user.id)
+        cold = cold.order_by(ArchivedPost.timestamp.desc(), ArchivedPost.id.desc())
+
+        start = (page - 1) * per_page
+        hot_total = hot.order_by(None).count()
+        items = hot.offset(start).limit(per_page).all() if start < hot_total else []
+        if len(items) < per_page:
+            items += (
+                cold.offset(max(start - hot_total, 0))
+                .limit(per_page - len(items))
+                .all()
+            )
+        total = hot_total + cold.order_by(None).count()
+        posts = Pagination(None, page, per_page, total, items)
+        self.attach_authors(posts.items)
+        return posts
+
+    def discover(self, page, per_page):
+        queries = [self._newest(session.query(Post)) for session in self.sessions()]
+        if len(queries) == 1:
+            posts = queries[0].paginate(page, per_page, False)
+        else:
+            posts = self._merge(queries, page, per_page)
+        self.attach_authors(posts.items)
+        return posts
+
+    def feed(self, user, page, per_page):
+        if not self.enabled:
+            posts = user.followed_posts().paginate(page, per_page, False)
+        else:
+            by_shard = {}
+            for user_id in self.followed_ids(user) | {user.id}:
+                by_shard.setdefault(self.index_for(user_id), []).append(user_id)
+            queries = [
+                self._newest(
+                    self.sessions()[index].query(Post).filter(Post.user_id.in_(ids))
+                )
+                for index, ids in sorted(by_shard.items())
+            ]
+            posts = self._merge(queries, page, per_page)
+        self.attach_authors(posts.items)
+        return posts
+
+    def followed_ids(self, user):
+        query = select([followers.c.followed_id]).where(
+            followers.c.follower_id == user.id
+        )
+        return {row[0] for row in self.session_for(user.id).execute(query)}
+
+    def is_following(self, user, other):
+        query = select([func.count()]).where(
+            (followers.c.follower_id == user.id)
+            & (followers.c.followed_id == other.id)
+        )
+        return self.session_for(user.id).execute(query).scalar() > 0
+
+    def follow(self, user, other):
+        """ Add the edge user -> other on `user`'s shard; the caller commits. """
+        if not self.is_following(user, other):
+            self.session_for(user.id).execute(
+                followers.insert().values(follower_id=user.id, followed_id=other.id)
+            )
+
+    def unfollow(self, user, other):
+        self.session_for(user.id).execute(
+            followers.delete().where(
+                (followers.c.follower_id == user.id)
+                & (followers.c.followed_id == other.id)
+            )
+        )
+
+
+shards = ShardRouter()
+shards_cli = AppGroup("shards", help="Manage the post and follow shards.")
+
+
+@shards_cli.command("init")
+def init_command():
+    """Create the sharded tables on every shard."""
+    shards.create_schema()
+    click.echo("Initialized {} shard(s)".format(len(shards.engines())))
+
+
+@shards_cli.command("upgrade")
+def upgrade_command():
+    """Bring the schema of every shard up to date."""
+    if not shards.enabled:
+        click.echo("No shards configured; `flask db upgrade` covers the database.")
+        return
+    added = set()
+    for engine in shards.engines():
+        added.update(upgrade_schema(engine))
+    click.echo("Upgraded {} shard(s)".format(len(shards.engines())))
+    if {"post.video_id", "post_archive.video_id"} & added:
+        click.echo("Run `flask videos backfill` to link the existing posts.")
+
+
+def _owned(table):
+    return table.c[OWNER_COLUMNS[table.name]]
+
+
+def _count_owned(connection, user_id):
+    return {
+        table.name: connection.execute(
+            select([func.count()]).select_from(table).where(_owned(table) == user_id)
+        ).scalar()
+        for table in SHARDED_TABLES
+    }
+
+
+def _move_user(user_id, source, target):
+    """ Move every sharded row owned by `user_id` from `source` to `target`.
+
+    The rows are copied in one transaction on `target`, counted there before
+    it commits, and only then deleted from `source`; nothing is ever deleted
+    from `target`. That makes the move safe to repeat: a user without rows on
+    `source` is skipped, and a user whose rows a run interrupted after the
+    copy already has on `target` is checked and removed from `source`.
+    Returns the number of rows moved per table.
+    """
+    with source.connect() as connection:
+        rows = {
+            table.name: [
+                dict(row)
+                for row in connection.execute(
+                    table.select().where(_owned(table) == user_id)
+                )
+            ]
+            for table in SHARDED_TABLES
+        }
+    if not any(rows.values()):
+        return {name: 0 for name in rows}
+    rows["post_stats"] = _stats_of_existing_posts(rows)
+    expected = {name: len(moved) for name, moved in rows.items()}
+
+    with target.begin() as connection:
+        copied = _count_owned(connection, user_id)
+        if not any(copied.values()):
+            _copy_rows(connection, rows)
+            copied = _count_owned(connection, user_id)
+        if copied != expected:
+            # Rolls the copy back, if there was one.
+            raise click.ClickException(
+                "User {}: expected {} on {}, found {}; nothing was deleted.".format(
+                    user_id, expected, target.url, copied
+                )
+            )
+    with source.begin() as connection:
+        for table in SHARDED_TABLES:
+            connection.execute(table.delete().where(_owned(table) == user_id))
+    return expected
+
+
+def _stats_of_existing_posts(rows):
+    # Stats left behind by deleted posts have nothing to follow to `target`.
+    post_ids = {row["id"] for row in rows["post"]}
+    post_ids.update(row["post_id"] for row in rows["post_archive"])
+    return [row for row in rows["post_stats"] if row["post_id"] in post_ids]
+
+
+def _copy_rows(connection, rows):
+    """ Insert a user's `rows` on a new shard, where their post ids may be taken.
+
+    Every post gets a new id, hot posts by inserting them and archived ones
+    (`post_archive.post_id`) by inserting and deleting a placeholder post,
+    which `post`'s AUTOINCREMENT never hands out again. `post_stats` follows
+    the new ids; `flask shards rebalance` recounts the videos afterwards.
+    """
+    hot, archived = Post.__table__, ArchivedPost.__table__
+    new_post_ids = {}
+    for row in rows["post"]:
+        values = {key: value for key, value in row.items() if key != "id"}
+        result = connection.execute(hot.insert(), values)
+        new_post_ids[row["id"]] = result.inserted_primary_key[0]
+    archived_rows = []
+    for row in rows["post_archive"]:
+        placeholder = connection.execute(hot.insert(), {"user_id": row["user_id"]})
+        post_id = placeholder.inserted_primary_key[0]
+        connection.execute(hot.delete().where(hot.c.id == post_id))
+        new_post_ids.setdefault(row["post_id"], post_id)
+        values = {key: value for key, value in row.items() if key != "id"}
+        archived_rows.append(dict(values, post_id=post_id))
+    if archived_rows:
+        connection.execute(archived.insert(), archived_rows)
+    stats = [
+        dict(row, post_id=new_post_ids[row["post_id"]]) for row in rows["post_stats"]
+    ]
+    for table, values in ((PostStats.__table__, stats), (followers, rows["followers"])):
+        if values:
+            connection.execute(table.insert(), values)
+
+
+@shards_cli.command("rebalance")
+@click.argument("uris", nargs=-1, required=True)
+def rebalance_command(uris):
+    """Move posts and follows from the current shards onto URIS.
+
+    Afterwards set SHARD_DATABASE_URIS to URIS. The move is per user and can
+    be re-run after an interruption, or to check that it completed.
+    """
+    from flask_server.videos import recount
+
+    sources = shards.engines()
+    targets = [create_engine(uri) for uri in uris]
+    for engine in targets:
+        upgrade_schema(engine)
+
+    moved_users, moved = 0, {table.name: 0 for table in SHARDED_TABLES}
+    user_ids = [row[0] for row in db.session.query(User.id).order_by(User.id)]
+    for user_id in user_ids:
+        source = sources[user_id % len(sources)]
+        target = targets[user_id % len(targets)]
+        if str(source.url) == str(target.url):
+            continue
+        counts = _move_user(user_id, source, target)
+        if not any(counts.values()):
+            continue
+        for name, count in counts.items():
+            moved[name] += count
+        moved_users += 1
+        if moved_users % 1000 == 0:
+            click.echo("moved {} users".format(moved_users))
+    click.echo(
+        "Moved rows of {} users: {}".format(
+            moved_users,
+            ", ".join("{} {}".format(count, name) for name, count in moved.items()),
+        )
+    )
+    # Moved posts have new ids, which the videos' first and latest posts name.
+    click.echo("Recounted {} videos".format(recount(targets)))
+    if any(moved.values()):
+        click.echo("Run `flask analytics refresh --rebuild`: moved posts got new ids.")
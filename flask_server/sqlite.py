@@ -0,0 +1,94 @@
+""" Running on a single SQLite file in production.
+
+SQLite's defaults suit a library, not a web app: the rollback journal blocks
+readers while anyone writes, every commit is fsynced twice, and a busy
+database raises "database is locked" at once. With `SQLITE_WAL` set and a file
+`SQLALCHEMY_DATABASE_URI`, every connection is opened with `SQLITE_PRAGMAS`:
+
+    journal_mode=WAL      readers and the writer no longer block each other
+    synchronous=NORMAL    fsync at checkpoints only; a power cut can lose the
+                          last commits, but never corrupts the database
+    busy_timeout          wait this many ms for another writer instead of failing
+    cache_size, mmap_size page cache per connection, and reads through mmap
+    temp_store=MEMORY     sorts and temporary indexes off disk
+
+Writes still go through `db.engine`, and SQLite still allows one writer at a
+time across all workers; `busy_timeout` makes them queue. The list pages
+(`readmodel`) read through a separate pool of reader connections instead
+(`reader()`), opened with `query_only`, so reads never wait for a connection
+a writer holds and can't write by mistake.
+
+    flask bench sqlite --workers 4 --seconds 10
+
+measures mixed `/create` and `/feed` traffic from several worker processes on
+a scratch copy, with and without these settings.
+"""
+from flask import current_app
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from flask_server import db
+
+
+def is_file_database(uri):
+    if not uri:
+        return False
+    url = make_url(uri)
+    in_memory = url.database in (None, "", ":memory:")
+    return url.get_backend_name() == "sqlite" and not in_memory
+
+
+def _engine_options(app, pool_size):
+    busy_ms = app.config["SQLITE_PRAGMAS"].get("busy_timeout", 5000)
+    return {
+        # Without a pool size, a new connection (and pragmas) per checkout.
+        "poolclass": QueuePool,
+        "pool_size": pool_size,
+        "connect_args": {"check_same_thread": False, "timeout": busy_ms / 1000.0},
+    }
+
+
+def _apply_pragmas(engine, pragmas):
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA {} = {}".format(name, value))
+        cursor.close()
+
+
+def init_app(app):
+    """ Configure the engines; must run before anything connects. """
+    uri = app.config["SQLALCHEMY_DATABASE_URI"]
+    if not app.config["SQLITE_WAL"] or not is_file_database(uri):
+        return
+    options = _engine_options(app, app.config["SQLITE_WRITERS"])
+    options.update(app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+    pragmas = app.config["SQLITE_PRAGMAS"]
+    writer = db.get_engine(app)
+    _apply_pragmas(writer, pragmas)
+
+    readers = create_engine(
+        writer.url, **_engine_options(app, app.config["SQLITE_READERS"])
+    )
+    _apply_pragmas(readers, dict(pragmas, query_only="ON"))
+    app.extensions["sqlite_reader"] = scoped_session(sessionmaker(bind=readers))
+    app.teardown_appcontext(_remove_reader)
+
+
+def _remove_reader(exception=None):
+    current_app.extensions["sqlite_reader"].remove()
+
+
+def reader():
+    """ The session read-only queries should use: the reader pool if there is one. """
+    return current_app.extensions.get("sqlite_reader") or db.session
+
+
+def dispose(app):
+    session = app.extensions.get("sqlite_reader")
+    if session is not None:
+        session.remove()
+        session.bind.dispose()
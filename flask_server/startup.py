@@ -0,0 +1,186 @@
+""" Startup helpers for running the app under gunicorn with `--preload`.
+
+With `preload_app = True` (see `gunicorn.conf.py`) the master process builds the
+app once and forks its workers from it, so everything done before the fork is
+shared copy-on-write instead of being repeated per worker:
+
+    1. `warmup()` compiles every template (from the bytecode cache, see
+       `flask_server/templating.py`) and configures the SQLAlchemy mappers;
+       `warmup_data()` loads in-memory indexes such as the username filter.
+    2. `before_fork()` drops pooled database connections, which must never be
+       shared between processes, and moves every surviving object into the
+       permanent GC generation with `gc.freeze()` so collections in the workers
+       don't write to (and thereby copy) the master's pages.
+    3. A pool listener refuses any connection checked out in a different
+       process than the one that opened it, in case one slips through anyway.
+
+`flask startup-report` prints how long startup took and how much memory each
+forked worker shares with the master.
+"""
+import gc
+import json
+import os
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, exc
+from sqlalchemy.orm import configure_mappers
+from sqlalchemy.pool import Pool
+from flask_server import db
+
+MEMORY_FIELDS = ["Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Dirty"]
+
+
+def init_app(app, started):
+    _install_fork_guard()
+    app.extensions["startup"] = {"warmup": 0.0}
+    if app.config["WARMUP_ON_STARTUP"]:
+        warmup(app)
+    app.extensions["startup"]["create_app"] = time.perf_counter() - started
+    app.cli.add_command(startup_report)
+
+
+def warmup(app):
+    """ Do the lazy first-request work up front: mappers and templates.
+
+    Configures the SQLAlchemy mappers and compiles every template; raises if a
+    template doesn't compile, so a broken deploy fails at startup. The engine
+    is not warmed, only disposed, so no connection made here outlives a fork.
+    """
+    from flask_server import templating
+
+    started = time.perf_counter()
+    configure_mappers()
+    templating.compile_all(app)
+    db.get_engine(app).dispose()
+    app.extensions["startup"]["warmup"] = time.perf_counter() - started
+
+
+def warmup_data(app):
+    """ Build the in-memory indexes that are loaded from the database.
+
+    Kept out of `warmup()` so CLI commands don't pay for it; gunicorn calls it
+    once in the master (`when_ready`), and the result is shared by all workers.
+    """
+    from flask_server import bloom
+
+    with app.app_context():
+        bloom.warmup(app)
+
+
+def before_fork(app):
+    """ Called in the master right before each worker is forked. """
+    from flask_server import sqlite
+    from flask_server.sharding import shards
+
+    db.get_engine(app).dispose()
+    sqlite.dispose(app)
+    shards.dispose(app)
+    gc.freeze()
+
+
+def before_exit(app):
+    """ Called in a worker that is shutting down. """
+    with app.app_context():
+        app.extensions["views"].flush()
+
+
+def _install_fork_guard():
+    if event.contains(Pool, "connect", _remember_pid):
+        return
+    event.listen(Pool, "connect", _remember_pid)
+    event.listen(Pool, "checkout", _check_pid)
+
+
+def _remember_pid(dbapi_connection, connection_record):
+    connection_record.info["pid"] = os.getpid()
+
+
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info["pid"] != pid:
+        # Discard without closing: the socket still belongs to the parent.
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            "Connection record belongs to pid {}, "
+            "attempting to check out in pid {}".format(
+                connection_record.info["pid"], pid
+            )
+        )
+
+
+def memory_usage():
+    """ Memory of the current process in kB, split by how much of it is shared.
+
+    Reads `/proc/self/smaps_rollup` on Linux; elsewhere only the peak RSS is
+    available.
+    """
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            lines = f.readlines()
+    except OSError:
+        import resource
+
+        return {"Rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    usage = {}
+    for line in lines:
+        name, _, value = line.partition(":")
+        if name in MEMORY_FIELDS:
+            usage[name] = int(value.split()[0])
+    return usage
+
+
+def format_memory(usage):
+    return ", ".join(
+        "{}={:.1f}MB".format(name, usage[name] / 1024.0)
+        for name in MEMORY_FIELDS
+        if name in usage
+    )
+
+
+def _measure_worker(write_fd):
+    # What a worker does soon after starting: re-enable and run the GC, which
+    # touches every tracked object that was not frozen before the fork.
+    gc.enable()
+    gc.collect()
+    os.write(write_fd, json.dumps(memory_usage()).encode("utf-8"))
+    os.close(write_fd)
+
+
+@click.command("startup-report")
+@click.option("--workers", default=2, show_default=True)
+@click.option("--freeze/--no-freeze", default=True, show_default=True)
+@with_appcontext
+def startup_report(workers, freeze):
+    """Report startup time and the memory of forked workers."""
+    app = current_app._get_current_object()
+    timings = app.extensions["startup"]
+    click.echo("create_app: {:.1f}ms".format(timings["create_app"] * 1000))
+    click.echo("warmup:     {:.1f}ms".format(timings["warmup"] * 1000))
+    click.echo("master:     {}".format(format_memory(memory_usage())))
+    if not hasattr(os, "fork"):
+        click.echo("os.fork() is not available, skipping the worker report")
+        return
+
+    gc.disable()
+    if freeze:
+        before_fork(app)
+    for i in range(workers):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                _measure_worker(write_fd)
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as f:
+            usage = json.loads(f.read() or "{}")
+        os.waitpid(pid, 0)
+        click.echo("worker {}:   {}".format(i + 1, format_memory(usage)))
+    if freeze:
+        gc.unfreeze()
+    gc.enable()
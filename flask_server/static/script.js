@@ -1,47 +1,102 @@
 'use strict';
 function r(f){/in/.test(document.readyState)?setTimeout('r('+f+')',9):f()}
 r(function(){
-    if (!document.getElementsByClassName) {
-        // IE8 support
-        var getElementsByClassName = function(node, classname) {
-            var a = [];
-            var re = new RegExp('(^| )'+classname+'( |$)');
-            var els = node.getElementsByTagName("*");
-            for(var i=0,j=els.length; i<j; i++)
-                if(re.test(els[i].className))a.push(els[i]);
-            return a;
+    // Swap YouTube embeds for their thumbnails until clicked, in `root` only
+    function setUpVideos(root) {
+        if (!root.getElementsByClassName) {
+            // IE8 support
+            var getElementsByClassName = function(node, classname) {
+                var a = [];
+                var re = new RegExp('(^| )'+classname+'( |$)');
+                var els = node.getElementsByTagName("*");
+                for(var i=0,j=els.length; i<j; i++)
+                    if(re.test(els[i].className))a.push(els[i]);
+                return a;
+            }
+            var videos = getElementsByClassName(root,"youtube");
+        } else {
+            var videos = root.getElementsByClassName("youtube");
         }
-        var videos = getElementsByClassName(document.body,"youtube");
-    } else {
-        var videos = document.getElementsByClassName("youtube");
-    }
 
-    var nb_videos = videos.length;
-    for (var i=0; i<nb_videos; i++) {
-        // Based on the YouTube ID, we can easily find the thumbnail image
-        videos[i].style.backgroundImage = 'url(https://img.youtube.com/vi/' + videos[i].id + '/default.jpg)';
-
-        // Overlay the Play icon to make it look like a video player
-        var play = document.createElement("div");
-        play.setAttribute("class","play");
-        videos[i].appendChild(play);
-
-        videos[i].onclick = function() {
-            // Create an iFrame 
-            var iframe = document.createElement("iframe");
-            var iframe_url = "https://www.youtube-nocookie.com/embed/" + this.id;
-            if (this.getAttribute("data-params")) iframe_url+='&'+this.getAttribute("data-params");
-            iframe.setAttribute("src",iframe_url);
-            iframe.setAttribute("frameborder",'0');
-
-            // The height and width of the iFrame should be the same as parent
-            iframe.style.width  = this.style.width;
-            iframe.style.height = this.style.height;
-
-            // Replace the YouTube thumbnail with YouTube Player
-            this.parentNode.replaceChild(iframe, this);
+        var nb_videos = videos.length;
+        for (var i=0; i<nb_videos; i++) {
+            // Based on the YouTube ID, we can easily find the thumbnail image
+            videos[i].style.backgroundImage = 'url(https://img.youtube.com/vi/' + videos[i].id + '/default.jpg)';
+
+            // Overlay the Play icon to make it look like a video player
+            var play = document.createElement("div");
+            play.setAttribute("class","play");
+            videos[i].appendChild(play);
+
+            videos[i].onclick = function() {
+                // Create an iFrame 
+                var iframe = document.createElement("iframe");
+                var iframe_url = "https://www.youtube-nocookie.com/embed/" + this.id;
+                if (this.getAttribute("data-params")) iframe_url+='&'+this.getAttribute("data-params");
+                iframe.setAttribute("src",iframe_url);
+                iframe.setAttribute("frameborder",'0');
+
+                // The height and width of the iFrame should be the same as parent
+                iframe.style.width  = this.style.width;
+                iframe.style.height = this.style.height;
+
+                // Replace the YouTube thumbnail with YouTube Player
+                this.parentNode.replaceChild(iframe, this);
+            }
         }
     }
+    setUpVideos(document.body);
+
+    // Append older cards while scrolling, instead of loading the next page (see /discover/cards)
+    var cards = document.getElementById("cards");
+    if (cards && cards.getAttribute("data-cursor") && window.fetch) {
+        var older = document.getElementById("older");
+        if (older) older.style.display = "none";
+        var loading = false;
+        var loadMore = function() {
+            var cursor = cards.getAttribute("data-cursor");
+            // Start fetching when the end of the list is less than a screen away
+            if (loading || !cursor || cards.getBoundingClientRect().bottom > 2 * window.innerHeight) return;
+            loading = true;
+            var url = cards.getAttribute("data-cards") + "?cursor=" + encodeURIComponent(cursor);
+            fetch(url, {credentials: "same-origin"}).then(function(response) {
+                if (!response.ok) throw new Error(response.statusText);
+                cards.setAttribute("data-cursor", response.headers.get("X-Next-Cursor") || "");
+                return response.text();
+            }).then(function(html) {
+                var fragment = document.createElement("div");
+                fragment.innerHTML = html;
+                setUpVideos(fragment);
+                while (fragment.firstChild) cards.appendChild(fragment.firstChild);
+                loading = false;
+                loadMore();
+            }).catch(function() {
+                // Give up and leave paging to the link
+                cards.setAttribute("data-cursor", "");
+                if (older) older.style.display = "";
+            });
+        };
+        window.addEventListener("scroll", loadMore);
+        loadMore();
+    }
+
+    // Announce new posts from followed users as they are published (see /stream)
+    var newPosts = document.getElementById("new-posts");
+    if (newPosts && window.EventSource) {
+        var count = 0;
+        var showNewPosts = function(text) {
+            newPosts.firstElementChild.textContent = text;
+            newPosts.style.display = "block";
+        };
+        var source = new EventSource(newPosts.getAttribute("data-stream"));
+        source.addEventListener("post", function() {
+            count += 1;
+            showNewPosts(count + (count > 1 ? " new posts" : " new post") + " - click to refresh");
+        });
+        source.addEventListener("reload", function() {
+            showNewPosts("Many new posts - click to refresh");
+        });
+    }
 
     document.getElementById("hide").addEventListener("click", hidePost); 
 
@@ -0,0 +1,76 @@
+""" Compiled Jinja templates that survive restarts.
+
+Jinja compiles a template to Python source and then to bytecode on first use,
+once per process. With `TEMPLATE_CACHE_DIR` set, the bytecode is also written
+to that directory (`jinja2.FileSystemBytecodeCache`) and later processes only
+unmarshal it. Entries are keyed by template name and checked against a
+checksum of the source, so an edited template is recompiled, never served
+stale.
+
+    flask templates compile      # at build time, e.g. in the release phase
+    flask bench templates        # first-request latency, cold vs cached
+
+`compile_all()` is also what `startup.warmup()` runs, so a template with a
+syntax error stops the app from starting instead of failing the first request
+that renders it.
+"""
+import os
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from jinja2 import FileSystemBytecodeCache, TemplateSyntaxError
+
+templates_cli = AppGroup("templates", help="Manage compiled templates.")
+
+
+def init_app(app):
+    directory = app.config["TEMPLATE_CACHE_DIR"]
+    if not directory:
+        return
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        app.logger.warning("Can't create %s, templates won't be cached", directory)
+        return
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+
+def compile_all(app):
+    """ Load every template, raising one error that lists all broken ones.
+
+    Returns the number of templates loaded.
+    """
+    names = app.jinja_env.list_templates()
+    errors = []
+    for name in names:
+        try:
+            app.jinja_env.get_template(name)
+        except TemplateSyntaxError as e:
+            errors.append("{}:{}: {}".format(name, e.lineno, e.message))
+    if errors:
+        raise RuntimeError(
+            "{} templates failed to compile:\n  {}".format(
+                len(errors), "\n  ".join(errors)
+            )
+        )
+    return len(names)
+
+
+@templates_cli.command("compile")
+@click.option("--clear", is_flag=True, help="Remove cached bytecode first.")
+def compile_command(clear):
+    """Compile every template into TEMPLATE_CACHE_DIR."""
+    app = current_app._get_current_object()
+    cache = app.jinja_env.bytecode_cache
+    if cache is None:
+        raise click.ClickException("TEMPLATE_CACHE_DIR is not set.")
+    if clear:
+        cache.clear()
+    # Templates loaded during startup are only in memory; load them again.
+    app.jinja_env.cache.clear()
+    try:
+        count = compile_all(app)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo("{} templates in {}".format(count, app.config["TEMPLATE_CACHE_DIR"]))
@@ -0,0 +1,278 @@
+""" Test fixtures: one schema per test class, one rolled-back transaction per test.
+
+`DatabaseTestCase` builds the app and its in-memory SQLite schema once per class
+(`setUpClass`). Every test then runs inside a transaction on that database that
+is rolled back in `tearDown`, so tests never pay for `create_all()`/`drop_all()`
+and can't see each other's rows. `db.session` is bound to the test's connection
+and wrapped in a SAVEPOINT that is restarted after every commit or rollback, so
+code under test can `commit()` and `rollback()` as usual.
+
+A class that sets `snapshot = "medium"` starts from a seeded database instead of
+an empty one. Snapshots are generated once (deterministically, see `SNAPSHOTS`)
+into SQLite files under `TEST_SNAPSHOT_DIR` and copied into memory with the
+SQLite backup API, which takes milliseconds even for the large one. The file
+name includes a hash of the schema and `SEED_VERSION`, so model or seed
+changes rebuild them.
+
+Code that opens its own transactions on `db.engine` (`engine.begin()`, as in
+the bulk import and archive jobs) can't run inside the test transaction; test
+it with a plain `unittest.TestCase` and `create_all()` instead.
+
+For performance regression tests:
+
+    with self.assertMaxQueries(3):
+        self.client.get("/discover")
+    self.assertFasterThan(0.05, lambda: self.client.get("/discover"))
+
+Latency budgets are multiplied by `PERF_BUDGET_SCALE` (default 1) for slow CI
+machines.
+"""
+import hashlib
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import unittest
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects.sqlite import dialect as sqlite_dialect
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.schema import CreateIndex, CreateTable
+from werkzeug.security import generate_password_hash
+from flask_server import create_app, db, videos
+from flask_server.models import User, Post, followers
+
+# name: (users, posts per user, follows per user)
+SNAPSHOTS = {
+    "small": (10, 5, 3),
+    "medium": (200, 20, 10),
+    "large": (2000, 20, 20),
+}
+SNAPSHOT_DIR = os.environ.get("TEST_SNAPSHOT_DIR") or os.path.join(
+    tempfile.gettempdir(), "argus-snapshots"
+)
+# Every seeded user can log in with this password.
+SNAPSHOT_PASSWORD = "password"
+SNAPSHOT_EPOCH = datetime(2020, 1, 1)
+# Bump when `seed()` changes, so stale snapshots get rebuilt.
+SEED_VERSION = 2
+
+
+def _schema_hash():
+    # Compile for SQLite, so table options like AUTOINCREMENT count, and sort
+    # the indexes, which SQLAlchemy keeps in a set.
+    dialect = sqlite_dialect()
+    ddl = []
+    for table in db.metadata.sorted_tables:
+        ddl.append(str(CreateTable(table).compile(dialect=dialect)))
+        ddl.extend(
+            str(CreateIndex(index).compile(dialect=dialect))
+            for index in sorted(table.indexes, key=lambda index: index.name)
+        )
+    return hashlib.sha1("".join(ddl).encode("utf-8")).hexdigest()[:12]
+
+
+def seed(engine, users, posts_per_user, follows_per_user, random_seed=0):
+    """ Fill an empty schema with a deterministic social graph.
+
+    User `i` is called `user<i>`; posts are spread over the year after
+    `SNAPSHOT_EPOCH` and link to half as many videos as there are posts, in
+    the various URL forms people paste. Rows are inserted with one
+    `executemany` per table.
+    """
+    rng = random.Random(random_seed)
+    video_count = max(users * posts_per_user // 2, 1)
+    url_forms = [
+        "{}",
+        "https://www.youtube.com/watch?v={}",
+        "https://youtu.be/{}?t=10",
+        "youtube.com/embed/{}",
+    ]
+    password_hash = generate_password_hash(SNAPSHOT_PASSWORD)
+    user_rows = [
+        {
+            "id": i,
+            "username": "user{}".format(i),
+            "email": "user{}@example.com".format(i),
+            "password_hash": password_hash,
+            "poster": True,
+            "last_seen": SNAPSHOT_EPOCH,
+        }
+        for i in range(1, users + 1)
+    ]
+    post_rows = []
+    for user_id in range(1, users + 1):
+        for n in range(posts_per_user):
+            video = "{:011d}".format(rng.randrange(video_count))
+            seconds = rng.randrange(365 * 24 * 3600)
+            post_rows.append(
+                {
+                    "user_id": user_id,
+                    "url": rng.choice(url_forms).format(video),
+                    "video_id": video,
+                    "body": "post {} of user{}".format(n, user_id),
+                    "timestamp": SNAPSHOT_EPOCH + timedelta(seconds=seconds),
+                }
+            )
+    edges = []
+    for follower_id in range(1, users + 1):
+        others = [i for i in range(1, users + 1) if i != follower_id]
+        for followed_id in rng.sample(others, min(follows_per_user, len(others))):
+            edges.append({"follower_id": follower_id, "followed_id": followed_id})
+
+    with engine.begin() as connection:
+        for table, rows in (
+            (User.__table__, user_rows),
+            (Post.__table__, post_rows),
+            (followers, edges),
+        ):
+            if rows:
+                connection.execute(table.insert(), rows)
+        videos.store(connection, videos.aggregate([connection]))
+
+
+def snapshot_path(name):
+    """ The SQLite file holding snapshot `name`, generated if missing. """
+    key = "{}-{}-{}".format(name, SEED_VERSION, _schema_hash())
+    path = os.path.join(SNAPSHOT_DIR, key + ".db")
+    if not os.path.exists(path):
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        partial = "{}.{}.tmp".format(path, os.getpid())
+        engine = create_engine("sqlite:///" + partial)
+        db.metadata.create_all(engine)
+        seed(engine, *SNAPSHOTS[name])
+        engine.dispose()
+        os.replace(partial, path)
+    return path
+
+
+def load_snapshot(engine, name):
+    """ Replace the contents of the SQLite database behind `engine` with `name`. """
+    source = sqlite3.connect(snapshot_path(name))
+    connection = engine.raw_connection()
+    try:
+        source.backup(connection.connection)
+    finally:
+        connection.close()
+        source.close()
+
+
+def _sqlite_savepoints(engine):
+    # pysqlite issues BEGIN lazily and breaks SAVEPOINT; let SQLAlchemy do it.
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def begin(connection):
+        connection.execute("BEGIN")
+
+
+class _NestedSession(SignallingSession):
+    """ A session whose work happens in a SAVEPOINT of the test transaction. """
+
+    def __init__(self, db, **options):
+        super(_NestedSession, self).__init__(db, **options)
+        self.begin_nested()
+
+
+@event.listens_for(_NestedSession, "after_transaction_end")
+def _restart_savepoint(session, transaction):
+    if transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """ Base class for tests that need an app and a database. """
+
+    #: The config class to build the app with; must use "sqlite://".
+    config = None
+    #: The name of a snapshot in `SNAPSHOTS` to start from, or None.
+    snapshot = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(cls.config)
+        cls.app_context = cls.app.app_context()
+        cls.app_context.push()
+        cls.engine = db.engine
+        _sqlite_savepoints(cls.engine)
+        cls.engine.dispose()
+        if cls.snapshot:
+            load_snapshot(cls.engine, cls.snapshot)
+        else:
+            db.create_all()
+        cls._session = db.session
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session = cls._session
+        db.session.remove()
+        db.drop_all()
+        cls.engine.dispose()
+        cls.app_context.pop()
+
+    def setUp(self):
+        self.connection = self.engine.connect()
+        self.transaction = self.connection.begin()
+        factory = sessionmaker(
+            class_=_NestedSession,
+            db=db,
+            bind=self.connection,
+            binds={},
+            query_cls=db.Query,
+        )
+        scopefunc = self._session.registry.scopefunc
+        db.session = scoped_session(factory, scopefunc=scopefunc)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.session = self._session
+        self.transaction.rollback()
+        self.connection.close()
+
+    @contextmanager
+    def assertMaxQueries(self, limit):
+        """ Fail if the block runs more than `limit` SQL statements. """
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if not statement.startswith(("BEGIN", "SAVEPOINT", "RELEASE", "ROLLBACK")):
+                statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", record)
+        try:
+            yield statements
+        finally:
+            event.remove(self.engine, "before_cursor_execute", record)
+        if len(statements) > limit:
+            self.fail(
+                "{} queries, expected at most {}:\n{}".format(
+                    len(statements), limit, "\n".join(statements)
+                )
+            )
+
+    def assertFasterThan(self, seconds, func, repeat=5):
+        """ Fail if the fastest of `repeat` calls to `func` takes over `seconds`. """
+        budget = seconds * float(os.environ.get("PERF_BUDGET_SCALE", "1"))
+        func()  # warm caches
+        best = float("inf")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - started)
+        if best > budget:
+            self.fail(
+                "took {:.1f}ms, budget {:.1f}ms".format(best * 1000, budget * 1000)
+            )
+
+    def login(self, username, password=SNAPSHOT_PASSWORD):
+        return self.client.post(
+            "/login", data={"username": username, "password": password}
+        )
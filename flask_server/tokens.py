@@ -0,0 +1,150 @@
+""" Signed, expiring bearer tokens for the JSON API.
+
+A client trades a username and password for a token once:
+
+    POST /api/v1/tokens   (HTTP basic auth, optional `scope=read write`)
+        {"token": "...", "expires_in": 3600, "scopes": ["read"]}
+
+and sends it as `Authorization: Bearer <token>` to the `/api/v1` endpoints.
+The token is the user id, the user's `token_version` and the granted scopes,
+signed with `SECRET_KEY` and timestamped, so checking it needs neither the
+session cookie nor a `User` row: requests with a token skip Flask-Login's user
+loader and the `last_seen` update.
+
+`DELETE /api/v1/tokens` bumps `user.token_version`, which revokes every token
+issued before. Each worker keeps the versions it has seen for
+`API_TOKEN_VERSION_SECONDS` and only rereads a user's version (one indexed
+primary key lookup) after that, so a revocation reaches the other workers
+within that many seconds; tokens also expire `API_TOKEN_SECONDS` after they
+were issued.
+"""
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+
+from flask import current_app, g, jsonify, request
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+from sqlalchemy import select
+from flask_server import db
+from flask_server.models import User
+from flask_server.sqlite import reader
+
+SCOPES = ("read", "write")
+# Who a request's token was issued to; `id` is all the read model needs.
+TokenUser = namedtuple("TokenUser", ["id", "scopes"])
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class TokenVersions(object):
+    """ This worker's copy of `user.token_version`, reread after `ttl` seconds. """
+
+    def __init__(self, ttl=30.0):
+        self.ttl = ttl
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """ The user's current version, or `None` if there is no such user. """
+        now = time.monotonic()
+        entry = self._versions.get(user_id)
+        if entry is None or now - entry[1] > self.ttl:
+            users = User.__table__
+            query = select([users.c.token_version]).where(users.c.id == user_id)
+            entry = (reader().execute(query).scalar(), now)
+            with self._lock:
+                self._versions[user_id] = entry
+        return entry[0]
+
+    def set(self, user_id, version):
+        with self._lock:
+            self._versions[user_id] = (version, time.monotonic())
+
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt="api-token")
+
+
+def issue(user, scopes=("read",)):
+    """ A token for `user` with `scopes`, valid until revoked or expired. """
+    claims = {"uid": user.id, "v": user.token_version, "s": list(scopes)}
+    return _serializer().dumps(claims)
+
+
+def verify(token):
+    """ The `TokenUser` of a valid token; raises `InvalidToken` otherwise. """
+    try:
+        claims = _serializer().loads(
+            token, max_age=current_app.config["API_TOKEN_SECONDS"]
+        )
+    except SignatureExpired:
+        raise InvalidToken("The token has expired.")
+    except BadSignature:
+        raise InvalidToken("The token is invalid.")
+    if claims["v"] != versions().get(claims["uid"]):
+        raise InvalidToken("The token has been revoked.")
+    return TokenUser(claims["uid"], tuple(claims["s"]))
+
+
+def revoke(user):
+    """ Invalidate every token issued to `user` so far. """
+    user.token_version += 1
+    db.session.commit()
+    versions().set(user.id, user.token_version)
+
+
+def bearer_token():
+    header = request.headers.get("Authorization", "")
+    scheme, _, token = header.partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return token.strip()
+
+
+def unauthorized(message):
+    response = jsonify(error=message)
+    response.status_code = 401
+    response.headers["WWW-Authenticate"] = 'Bearer error="invalid_token"'
+    return response
+
+
+def authenticate():
+    """ `before_request` of the API: check the bearer token, if there is one. """
+    token = bearer_token()
+    if token is None:
+        return None
+    try:
+        g.api_user = verify(token)
+    except InvalidToken as e:
+        return unauthorized(str(e))
+
+
+def token_required(scope="read"):
+    """ Only let through requests with a valid token granting `scope`. """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            user = g.get("api_user")
+            if user is None:
+                return unauthorized("A bearer token is required.")
+            if scope not in user.scopes:
+                return jsonify(error="The token lacks the {} scope.".format(scope)), 403
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def init_app(app):
+    app.extensions["token_versions"] = TokenVersions(
+        app.config["API_TOKEN_VERSION_SECONDS"]
+    )
+
+
+def versions():
+    return current_app.extensions["token_versions"]
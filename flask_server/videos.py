@@ -0,0 +1,285 @@
+""" Canonical YouTube videos: URL normalization and per-video aggregates.
+
+Posts store whatever the poster typed in `url`; `video_id` holds the video it
+points to, extracted by `video_id()` from any of the usual forms:
+
+    dQw4w9WgXcQ
+    https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=42s
+    https://youtu.be/dQw4w9WgXcQ
+    https://www.youtube.com/embed/dQw4w9WgXcQ   (and /shorts/, /live/, /v/)
+
+The `video` table lives in the main database, next to `user`, and is updated
+after every post is created or deleted: `post_added()` bumps the count and the
+latest post in one UPDATE; deletes recompute the video from the shards
+(`refresh()`), since the removed post may have been its first or latest.
+
+    flask videos backfill        # link posts created before `video_id` existed
+    flask videos recount         # rebuild every video's aggregates
+"""
+import re
+from urllib.parse import parse_qs, urlsplit
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import and_, bindparam, case, exc, or_, select, union_all
+from flask_server import db
+from flask_server.models import Post, ArchivedPost, Video
+from flask_server.sharding import shards
+
+VIDEO_ID = re.compile(r"^[A-Za-z0-9_-]{11}$")
+YOUTUBE_HOSTS = {
+    "youtube.com",
+    "www.youtube.com",
+    "m.youtube.com",
+    "music.youtube.com",
+    "youtube-nocookie.com",
+    "www.youtube-nocookie.com",
+}
+PATH_PREFIXES = {"embed", "shorts", "live", "v", "e"}
+
+VIDEOS, HOT, COLD = Video.__table__, Post.__table__, ArchivedPost.__table__
+# The aggregate columns of a video without posts.
+EMPTY_VIDEO = {
+    "post_count": 0,
+    "first_poster_id": None,
+    "first_post_id": None,
+    "first_posted_at": None,
+    "last_poster_id": None,
+    "last_post_id": None,
+    "last_posted_at": None,
+}
+
+videos_cli = AppGroup("videos", help="Maintain the canonical video table.")
+
+
+def video_id(url):
+    """ The YouTube video id in `url`, or None if it doesn't name a video. """
+    url = (url or "").strip()
+    # A bare id, possibly followed by the rest of a watch URL's query string.
+    head = re.split(r"[?&#]", url, 1)[0]
+    if VIDEO_ID.match(head):
+        return head
+    if "://" not in url:
+        url = "https://" + url
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    segments = [segment for segment in parts.path.split("/") if segment]
+    if host in ("youtu.be", "www.youtu.be"):
+        candidate = segments[0] if segments else ""
+    elif host in YOUTUBE_HOSTS:
+        candidate = parse_qs(parts.query).get("v", [""])[0]
+        if not candidate and len(segments) >= 2 and segments[0] in PATH_PREFIXES:
+            candidate = segments[1]
+    else:
+        return None
+    return candidate if VIDEO_ID.match(candidate) else None
+
+
+def ensure(session, id):
+    """ Insert an empty `video` row for `id` if there is none; commits. """
+    if session.query(Video.id).filter_by(id=id).first() is not None:
+        return
+    try:
+        session.add(Video(id=id, post_count=0))
+        session.commit()
+    except exc.IntegrityError:
+        # Created concurrently by another request.
+        session.rollback()
+
+
+def post_added(session, post):
+    """ Count a new post of `post.video_id` in `session`'s transaction.
+
+    Call after `ensure()` and after the post was flushed; committing is up to
+    the caller, together with the post where both live in the same database.
+    """
+    if post.video_id is None:
+        return
+    c = VIDEOS.c
+    latest = or_(c.last_posted_at.is_(None), c.last_posted_at <= post.timestamp)
+    first = c.first_posted_at.is_(None)
+    pick = lambda condition, value, column: case([(condition, value)], else_=column)
+    session.execute(
+        VIDEOS.update()
+        .where(c.id == post.video_id)
+        .values(
+            post_count=c.post_count + 1,
+            last_poster_id=pick(latest, post.user_id, c.last_poster_id),
+            last_post_id=pick(latest, post.id, c.last_post_id),
+            last_posted_at=pick(latest, post.timestamp, c.last_posted_at),
+            first_poster_id=pick(first, post.user_id, c.first_poster_id),
+            first_post_id=pick(first, post.id, c.first_post_id),
+            first_posted_at=pick(first, post.timestamp, c.first_posted_at),
+        )
+    )
+
+
+def _post_rows(connection, where_hot, where_cold):
+    # (video_id, user_id, post id, timestamp, archived) of hot and archived posts.
+    columns = lambda table, post_id, archived: [
+        table.c.video_id,
+        table.c.user_id,
+        post_id,
+        table.c.timestamp,
+        archived,
+    ]
+    query = union_all(
+        select(columns(HOT, HOT.c.id, bindparam("hot", False))).where(where_hot),
+        select(columns(COLD, COLD.c.post_id, bindparam("cold", True))).where(
+            where_cold
+        ),
+    )
+    return connection.execute(query)
+
+
+def aggregate(connections, ids=None):
+    """ Recompute `{video id: video row}` from the posts on `connections`.
+
+    Connections and sessions work alike. Limited to the videos in `ids`, if
+    given.
+    """
+    where_hot, where_cold = HOT.c.video_id.isnot(None), COLD.c.video_id.isnot(None)
+    if ids is not None:
+        where_hot, where_cold = HOT.c.video_id.in_(ids), COLD.c.video_id.in_(ids)
+    videos = {}
+    for connection in connections:
+        for video, user_id, post_id, timestamp, archived in _post_rows(
+            connection, where_hot, where_cold
+        ):
+            row = videos.get(video)
+            if row is None:
+                row = videos[video] = dict(EMPTY_VIDEO, id=video)
+            row["post_count"] += 1
+            if row["first_posted_at"] is None or timestamp < row["first_posted_at"]:
+                row["first_poster_id"], row["first_post_id"] = user_id, post_id
+                row["first_posted_at"] = timestamp
+            if not archived and (
+                row["last_posted_at"] is None or timestamp >= row["last_posted_at"]
+            ):
+                row["last_poster_id"], row["last_post_id"] = user_id, post_id
+                row["last_posted_at"] = timestamp
+    return videos
+
+
+def store(connection, videos, ids=None):
+    """ Replace the `video` rows of `ids` (default: all) with `videos`.
+
+    Videos in `ids` without posts are kept, with a count of zero.
+    """
+    ids = list(videos) if ids is None else list(ids)
+    existing = set()
+    for start in range(0, len(ids), 500):
+        chunk = ids[start : start + 500]
+        query = select([VIDEOS.c.id]).where(VIDEOS.c.id.in_(chunk))
+        existing.update(row[0] for row in connection.execute(query))
+    updates = [
+        dict({name: videos.get(id, EMPTY_VIDEO)[name] for name in EMPTY_VIDEO}, b_id=id)
+        for id in ids
+        if id in existing
+    ]
+    inserts = [videos[id] for id in ids if id not in existing and id in videos]
+    if updates:
+        connection.execute(
+            VIDEOS.update()
+            .where(VIDEOS.c.id == bindparam("b_id"))
+            .values({name: bindparam(name) for name in EMPTY_VIDEO}),
+            updates,
+        )
+    if inserts:
+        connection.execute(VIDEOS.insert(), inserts)
+
+
+def refresh(session, ids):
+    """ Recompute the videos in `ids` from every shard; commits `session`.
+
+    `session` is a main database session; shards are read through theirs.
+    """
+    ids = [id for id in set(ids) if id]
+    if not ids:
+        return
+    sources = shards.sessions() if shards.enabled else [session]
+    store(session, aggregate(sources, ids), ids)
+    session.commit()
+
+
+def _insert_missing(connection, ids):
+    """ Insert empty `video` rows for the `ids` that have none. """
+    ids = list(ids)
+    existing = set()
+    for start in range(0, len(ids), 500):
+        chunk = ids[start : start + 500]
+        query = select([VIDEOS.c.id]).where(VIDEOS.c.id.in_(chunk))
+        existing.update(row[0] for row in connection.execute(query))
+    missing = [dict(EMPTY_VIDEO, id=id) for id in ids if id not in existing]
+    if missing:
+        connection.execute(VIDEOS.insert(), missing)
+
+
+def link_posts(connection, table, batch_size=1000):
+    """ Set `video_id` of the posts in `table` that don't have one yet.
+
+    Walks the table in primary-key order, `batch_size` rows at a time, each
+    batch in its own transaction. The videos of a batch are inserted (empty,
+    for `recount()` to fill in) before the posts reference them. Returns the
+    number of posts linked.
+    """
+    linked, last = 0, 0
+    while True:
+        rows = connection.execute(
+            select([table.c.id, table.c.url])
+            .where(and_(table.c.id > last, table.c.video_id.is_(None)))
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).fetchall()
+        if not rows:
+            return linked
+        last = rows[-1].id
+        updates = [
+            {"b_id": row.id, "video_id": video_id(row.url)}
+            for row in rows
+            if video_id(row.url)
+        ]
+        if updates:
+            with db.engine.begin() as videos:
+                _insert_missing(videos, {update["video_id"] for update in updates})
+            with connection.begin():
+                connection.execute(
+                    table.update()
+                    .where(table.c.id == bindparam("b_id"))
+                    .values(video_id=bindparam("video_id")),
+                    updates,
+                )
+        linked += len(updates)
+
+
+def recount(engines=None):
+    """ Rebuild every video from the posts on `engines` (default: the shards). """
+    engines = shards.engines() if engines is None else engines
+    connections = [engine.connect() for engine in engines]
+    try:
+        videos = aggregate(connections)
+    finally:
+        for connection in connections:
+            connection.close()
+    with db.engine.begin() as connection:
+        stored = [row[0] for row in connection.execute(select([VIDEOS.c.id]))]
+        store(connection, videos, set(stored) | set(videos))
+    return len(videos)
+
+
+@videos_cli.command("backfill")
+@click.option("--batch-size", default=1000, show_default=True)
+def backfill_command(batch_size):
+    """Link existing posts to their videos on every shard, then recount."""
+    for i, engine in enumerate(shards.engines()):
+        with engine.connect() as connection:
+            for table in (HOT, COLD):
+                linked = link_posts(connection, table, batch_size)
+                click.echo("shard {} {}: linked {} posts".format(i, table.name, linked))
+    click.echo("{} videos".format(recount()))
+
+
+@videos_cli.command("recount")
+def recount_command():
+    """Rebuild the post count and first/latest post of every video."""
+    click.echo("{} videos".format(recount()))
@@ -0,0 +1,250 @@
+""" Post view counters, batched in memory and flushed in bulk.
+
+Every post card rendered (`_post.html` calls `record_view(post)`) counts as a
+view. Writing one UPDATE per card would turn every page view into several
+writes on hot rows, so each worker keeps, per post,
+
+    - a plain view count, and
+    - a HyperLogLog sketch of who viewed it (2**10 one-byte registers, about
+      3% error), which estimates unique viewers in constant space,
+
+and every `VIEW_FLUSH_SECONDS` adds them to `post_stats` on the author's shard:
+one SELECT of the existing sketches, then one executemany UPDATE and one
+executemany INSERT, in a single transaction per shard. Counts merge by
+addition, sketches by taking the larger register, so workers can flush in any
+order. The flush runs at the teardown of whichever request finds it due, never
+while a template is rendering, and once more when a gunicorn worker exits
+(`startup.before_exit`); views recorded after the last flush of a killed
+worker are lost.
+
+`post_views()` and `author_views()` read the flushed totals, see also the
+`/api/v1/users/<username>/views` endpoints.
+"""
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app, request
+from flask_login import current_user
+from sqlalchemy import and_, bindparam, exc, select
+from flask_server.models import PostStats
+from flask_server.sharding import shards
+
+STATS = PostStats.__table__
+PRECISION = 10
+
+
+class HyperLogLog(object):
+    """ Distinct-count sketch with `2 ** precision` registers. """
+
+    def __init__(self, precision=PRECISION, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers or self.size)
+
+    def add(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "big")
+        bits = 64 - self.precision
+        index = value >> bits
+        # Position of the leftmost 1 in the remaining bits.
+        rank = bits - (value & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def __len__(self):
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size ** 2 / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.size and zeros:
+            # Small-range correction (linear counting).
+            estimate = self.size * math.log(float(self.size) / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if not data:
+            return cls()
+        return cls(len(data).bit_length() - 1, data)
+
+
+def write_stats(connection, entries, now=None):
+    """ Add `{(author_id, post_id): [views, sketch]}` to the stats on `connection`.
+
+    All keys must live on the shard behind `connection`.
+    """
+    now = now or datetime.utcnow()
+    authors = {author_id for author_id, _ in entries}
+    posts = {post_id for _, post_id in entries}
+    query = (
+        select([STATS.c.author_id, STATS.c.post_id, STATS.c.viewers])
+        .where(and_(STATS.c.author_id.in_(authors), STATS.c.post_id.in_(posts)))
+        .with_for_update()
+    )
+    existing = {
+        (author_id, post_id): viewers
+        for author_id, post_id, viewers in connection.execute(query)
+        if (author_id, post_id) in entries
+    }
+
+    updates, inserts = [], []
+    for (author_id, post_id), (views, sketch) in entries.items():
+        if (author_id, post_id) in existing:
+            stored = existing[author_id, post_id]
+            if stored:
+                sketch = HyperLogLog.from_bytes(stored).merge(sketch)
+            updates.append(
+                {
+                    "a": author_id,
+                    "p": post_id,
+                    "n": views,
+                    "v": sketch.to_bytes(),
+                    "t": now,
+                }
+            )
+        else:
+            inserts.append(
+                {
+                    "author_id": author_id,
+                    "post_id": post_id,
+                    "views": views,
+                    "viewers": sketch.to_bytes(),
+                    "updated_at": now,
+                }
+            )
+    if updates:
+        connection.execute(
+            STATS.update()
+            .where(
+                and_(
+                    STATS.c.author_id == bindparam("a"),
+                    STATS.c.post_id == bindparam("p"),
+                )
+            )
+            .values(
+                views=STATS.c.views + bindparam("n"),
+                viewers=bindparam("v"),
+                updated_at=bindparam("t"),
+            ),
+            updates,
+        )
+    if inserts:
+        connection.execute(STATS.insert(), inserts)
+
+
+class ViewCounter(object):
+    def __init__(self, interval=30, precision=PRECISION):
+        self.interval = interval
+        self.precision = precision
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    def record(self, author_id, post_id, viewer):
+        with self._lock:
+            entry = self._pending.get((author_id, post_id))
+            if entry is None:
+                entry = [0, HyperLogLog(self.precision)]
+                self._pending[author_id, post_id] = entry
+            entry[0] += 1
+            entry[1].add(viewer)
+
+    def flush_if_due(self):
+        if time.monotonic() - self._flushed_at > self.interval:
+            self.flush()
+
+    def _merge_back(self, pending):
+        with self._lock:
+            for key, (views, sketch) in pending.items():
+                entry = self._pending.setdefault(key, [0, sketch])
+                if entry[1] is not sketch:
+                    entry[1].merge(sketch)
+                entry[0] += views
+
+    def flush(self):
+        """ Write the pending counts to the database; returns how many posts. """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed_at = time.monotonic()
+        if not pending:
+            return 0
+        by_shard = {}
+        for key, entry in pending.items():
+            by_shard.setdefault(shards.index_for(key[0]), {})[key] = entry
+        engines = shards.engines()
+        for index, entries in by_shard.items():
+            try:
+                self._write(engines[index], entries)
+            except exc.SQLAlchemyError:
+                current_app.logger.exception("Flushing view counts failed")
+                self._merge_back(entries)
+        return len(pending)
+
+    def _write(self, engine, entries):
+        try:
+            with engine.begin() as connection:
+                write_stats(connection, entries)
+        except exc.IntegrityError:
+            # Another worker inserted one of the rows first; now it's an update.
+            with engine.begin() as connection:
+                write_stats(connection, entries)
+
+
+def _viewer():
+    if current_user.is_authenticated:
+        return "user:{}".format(current_user.id)
+    return "anon:{}:{}".format(request.remote_addr, request.user_agent.string)
+
+
+def record_view(post):
+    """ Count a view of `post` by the current visitor; renders as nothing. """
+    post_id = post.post_id if post.archived else post.id
+    counter().record(post.user_id, post_id, _viewer())
+    return ""
+
+
+def post_views(author_id, post_id):
+    """ `{"views": ..., "viewers": ...}` of one post, as of the last flush. """
+    query = select([STATS.c.views, STATS.c.viewers]).where(
+        and_(STATS.c.author_id == author_id, STATS.c.post_id == post_id)
+    )
+    row = shards.session_for(author_id).execute(query).first()
+    if row is None:
+        return {"views": 0, "viewers": 0}
+    return {"views": row.views, "viewers": len(HyperLogLog.from_bytes(row.viewers))}
+
+
+def author_views(author_id):
+    """ Total views of an author's posts and distinct viewers across all of them. """
+    query = select([STATS.c.views, STATS.c.viewers]).where(
+        STATS.c.author_id == author_id
+    )
+    views, posts, sketch = 0, 0, HyperLogLog()
+    for row in shards.session_for(author_id).execute(query):
+        views += row.views
+        posts += 1
+        sketch.merge(HyperLogLog.from_bytes(row.viewers))
+    return {"views": views, "viewers": len(sketch), "posts": posts}
+
+
+def _flush_if_due(error=None):
+    counter().flush_if_due()
+
+
+def init_app(app):
+    app.extensions["views"] = ViewCounter(app.config["VIEW_FLUSH_SECONDS"])
+    app.add_template_global(record_view)
+    app.teardown_request(_flush_if_due)
+
+
+def counter():
+    return current_app.extensions["views"]
@@ -0,0 +1,43 @@
+""" gunicorn settings for the pages; `flask_server/startup.py` explains the fork
+handling. `/stream` is served by a separate process, see `gunicorn.stream.conf.py`.
+"""
+import gc
+import os
+
+from flask_server import startup
+
+bind = "0.0.0.0:{}".format(os.environ.get("PORT", "8000"))
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+# Pages only: an open `/stream` would keep one of these threads for as long as
+# the browser stays, so the proxy sends streams to the gevent process instead.
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+preload_app = True
+
+# Keep the master from leaving freed holes in pages the workers will share.
+gc.disable()
+
+
+def pre_fork(server, worker):
+    startup.before_fork(server.app.wsgi())
+
+
+def post_fork(server, worker):
+    gc.enable()
+    memory = startup.format_memory(startup.memory_usage())
+    server.log.info("Worker %s started: %s", worker.pid, memory)
+
+
+def worker_exit(server, worker):
+    startup.before_exit(server.app.wsgi())
+
+
+def when_ready(server):
+    app = server.app.wsgi()
+    startup.warmup_data(app)
+    timings = app.extensions["startup"]
+    server.log.info(
+        "App ready: create_app %.1fms, warmup %.1fms",
+        timings["create_app"] * 1000,
+        timings["warmup"] * 1000,
+    )
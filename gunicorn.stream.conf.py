@@ -0,0 +1,32 @@
+""" gunicorn settings for the process that serves `/stream` (Server-Sent Events).
+
+An open stream is a response that doesn't end until the browser leaves. On the
+page workers (`gunicorn.conf.py`) each one would hold a thread, and a few hundred
+readers would take every thread the pages have. Here the workers are gevent's,
+where an idle stream is a greenlet waiting on its `Subscription`. The proxy in
+front sends `/stream` to this process and everything else to the page workers:
+
+    location /stream { proxy_pass http://127.0.0.1:8001; proxy_buffering off; }
+    location /       { proxy_pass http://127.0.0.1:8000; }
+
+Posts are created by the page workers, so both processes need a shared
+`PUBSUB_TRANSPORT` (a `redis://` URL, see `flask_server/pubsub.py`).
+"""
+import os
+
+bind = "0.0.0.0:{}".format(os.environ.get("STREAM_PORT", "8001"))
+workers = int(os.environ.get("STREAM_CONCURRENCY", "1"))
+worker_class = "gevent"
+worker_connections = int(os.environ.get("STREAM_CONNECTIONS", "2000"))
+# gevent patches threading and sockets when a worker starts; the app must be
+# imported after that, in the worker, or its locks and connections would block
+# the whole worker.
+preload_app = False
+
+
+def when_ready(server):
+    if not os.environ.get("PUBSUB_TRANSPORT", "").startswith("redis://"):
+        server.log.warning(
+            "PUBSUB_TRANSPORT is not a redis:// URL: streams will only see "
+            "posts created by this process, which creates none"
+        )
@@ -19,6 +19,9 @@ logger = logging.getLogger("alembic.env")
 # target_metadata = mymodel.Base.metadata
 from flask import current_app
 
+# Registers op.create_index_online() and op.backfill() for migration scripts.
+import flask_server.online_migrations  # noqa: F401
+
 config.set_main_option(
     "sqlalchemy.url", current_app.config.get("SQLALCHEMY_DATABASE_URI")
 )
@@ -78,6 +81,9 @@ def run_migrations_online():
         connection=connection,
         target_metadata=target_metadata,
         process_revision_directives=process_revision_directives,
+        # Commit after every revision, so a long migration that fails part way
+        # keeps the revisions (and backfill batches) already done.
+        transaction_per_migration=True,
         **current_app.extensions["migrate"].configure_args
     )
 
@@ -0,0 +1,190 @@
+"""videos
+
+Revision ID: 9c4e7f1a2b35
+Revises: 5b8e2d0c4a17
+Create Date: 2026-10-19 15:02:44.187301
+
+"""
+import re
+from urllib.parse import parse_qs, urlsplit
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "9c4e7f1a2b35"
+down_revision = "5b8e2d0c4a17"
+branch_labels = None
+depends_on = None
+
+# A copy of `flask_server.videos.video_id()` as of this revision, so that the
+# migration keeps doing the same thing whatever the app code becomes.
+VIDEO_ID = re.compile(r"^[A-Za-z0-9_-]{11}$")
+YOUTUBE_HOSTS = {
+    "youtube.com",
+    "www.youtube.com",
+    "m.youtube.com",
+    "music.youtube.com",
+    "youtube-nocookie.com",
+    "www.youtube-nocookie.com",
+}
+PATH_PREFIXES = {"embed", "shorts", "live", "v", "e"}
+
+video = sa.table(
+    "video",
+    sa.column("id"),
+    sa.column("post_count"),
+    sa.column("first_poster_id"),
+    sa.column("first_post_id"),
+    sa.column("first_posted_at", sa.DateTime()),
+    sa.column("last_poster_id"),
+    sa.column("last_post_id"),
+    sa.column("last_posted_at", sa.DateTime()),
+)
+
+
+def video_id(url):
+    url = (url or "").strip()
+    head = re.split(r"[?&#]", url, 1)[0]
+    if VIDEO_ID.match(head):
+        return head
+    if "://" not in url:
+        url = "https://" + url
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    segments = [segment for segment in parts.path.split("/") if segment]
+    if host in ("youtu.be", "www.youtu.be"):
+        candidate = segments[0] if segments else ""
+    elif host in YOUTUBE_HOSTS:
+        candidate = parse_qs(parts.query).get("v", [""])[0]
+        if not candidate and len(segments) >= 2 and segments[0] in PATH_PREFIXES:
+            candidate = segments[1]
+    else:
+        return None
+    return candidate if VIDEO_ID.match(candidate) else None
+
+
+def link_post(row):
+    """ The backfill of a post's `video_id`, None for a URL of no video. """
+    id = video_id(row.url)
+    return {"video_id": id} if id else None
+
+
+def build_videos(connection):
+    hot = sa.table(
+        "post",
+        sa.column("id"),
+        sa.column("user_id"),
+        sa.column("timestamp", sa.DateTime()),
+        sa.column("video_id"),
+    )
+    cold = sa.table(
+        "post_archive",
+        sa.column("post_id"),
+        sa.column("user_id"),
+        sa.column("timestamp", sa.DateTime()),
+        sa.column("video_id"),
+    )
+    columns = lambda table, post_id, archived: [
+        table.c.video_id,
+        table.c.user_id,
+        post_id,
+        table.c.timestamp,
+        sa.literal(archived),
+    ]
+    # The latest post of a video is its newest hot one.
+    query = sa.union_all(
+        sa.select(columns(hot, hot.c.id, False)).where(hot.c.video_id.isnot(None)),
+        sa.select(columns(cold, cold.c.post_id, True)).where(
+            cold.c.video_id.isnot(None)
+        ),
+    )
+    videos = {}
+    for id, user_id, post_id, timestamp, archived in connection.execute(query):
+        row = videos.setdefault(
+            id,
+            {
+                "id": id,
+                "post_count": 0,
+                "first_poster_id": None,
+                "first_post_id": None,
+                "first_posted_at": None,
+                "last_poster_id": None,
+                "last_post_id": None,
+                "last_posted_at": None,
+            },
+        )
+        row["post_count"] += 1
+        if row["first_posted_at"] is None or timestamp < row["first_posted_at"]:
+            row["first_poster_id"], row["first_post_id"] = user_id, post_id
+            row["first_posted_at"] = timestamp
+        if not archived and (
+            row["last_posted_at"] is None or timestamp >= row["last_posted_at"]
+        ):
+            row["last_poster_id"], row["last_post_id"] = user_id, post_id
+            row["last_posted_at"] = timestamp
+    if videos:
+        connection.execute(video.insert(), list(videos.values()))
+
+
+def upgrade():
+    op.create_table(
+        "video",
+        sa.Column("id", sa.String(length=11), nullable=False),
+        sa.Column("post_count", sa.Integer(), nullable=False),
+        sa.Column("first_poster_id", sa.Integer(), nullable=True),
+        sa.Column("first_post_id", sa.Integer(), nullable=True),
+        sa.Column("first_posted_at", sa.DateTime(), nullable=True),
+        sa.Column("last_poster_id", sa.Integer(), nullable=True),
+        sa.Column("last_post_id", sa.Integer(), nullable=True),
+        sa.Column("last_posted_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["first_poster_id"], ["user.id"],),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        op.f("ix_video_first_poster_id"), "video", ["first_poster_id"], unique=False
+    )
+    op.create_index(
+        op.f("ix_video_last_posted_at"), "video", ["last_posted_at"], unique=False
+    )
+    op.create_index(op.f("ix_video_post_count"), "video", ["post_count"], unique=False)
+    with op.batch_alter_table("post") as batch_op:
+        batch_op.add_column(sa.Column("video_id", sa.String(length=11), nullable=True))
+        batch_op.create_index(op.f("ix_post_video_id"), ["video_id"], unique=False)
+    op.add_column(
+        "post_archive", sa.Column("video_id", sa.String(length=11), nullable=True)
+    )
+    op.create_index(
+        op.f("ix_post_archive_video_id"), "post_archive", ["video_id"], unique=False
+    )
+
+    # Link existing posts to their videos and build the videos from them, and
+    # only then reference the videos: until they exist every link would break
+    # the foreign key.
+    for name in ("post", "post_archive"):
+        op.backfill(
+            name,
+            link_post,
+            columns=["url"],
+            where="video_id IS NULL",
+            name="{}:{}.video_id".format(revision, name),
+        )
+    build_videos(op.get_bind())
+    with op.batch_alter_table("post") as batch_op:
+        batch_op.create_foreign_key(
+            op.f("fk_post_video_id_video"), "video", ["video_id"], ["id"]
+        )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_post_archive_video_id"), table_name="post_archive")
+    op.drop_column("post_archive", "video_id")
+    with op.batch_alter_table("post") as batch_op:
+        batch_op.drop_constraint(op.f("fk_post_video_id_video"), type_="foreignkey")
+        batch_op.drop_index(op.f("ix_post_video_id"))
+        batch_op.drop_column("video_id")
+    op.drop_index(op.f("ix_video_post_count"), table_name="video")
+    op.drop_index(op.f("ix_video_last_posted_at"), table_name="video")
+    op.drop_index(op.f("ix_video_first_poster_id"), table_name="video")
+    op.drop_table("video")
@@ -0,0 +1,28 @@
+"""user token version
+
+Revision ID: b7d3e9a41c06
+Revises: 9c4e7f1a2b35
+Create Date: 2026-10-19 18:21:53.604117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "b7d3e9a41c06"
+down_revision = "9c4e7f1a2b35"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "user",
+        sa.Column("token_version", sa.Integer(), server_default="0", nullable=False),
+    )
+
+
+def downgrade():
+    with op.batch_alter_table("user") as batch_op:
+        batch_op.drop_column("token_version")
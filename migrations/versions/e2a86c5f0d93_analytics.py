@@ -0,0 +1,54 @@
+"""analytics
+
+Revision ID: e2a86c5f0d93
+Revises: b7d3e9a41c06
+Create Date: 2026-10-19 19:47:12.385026
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e2a86c5f0d93"
+down_revision = "b7d3e9a41c06"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "analytics_day",
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("posts", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("day"),
+    )
+    op.create_table(
+        "analytics_user",
+        sa.Column("user_id", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("posts", sa.Integer(), nullable=False),
+        sa.Column("followers", sa.Integer(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["user_id"], ["user.id"],),
+        sa.PrimaryKeyConstraint("user_id"),
+    )
+    op.create_table(
+        "analytics_followers",
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("user_id", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("followers", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("day", "user_id"),
+    )
+    op.create_table(
+        "analytics_mark",
+        sa.Column("name", sa.String(length=64), nullable=False),
+        sa.Column("last_key", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("name"),
+    )
+
+
+def downgrade():
+    op.drop_table("analytics_mark")
+    op.drop_table("analytics_followers")
+    op.drop_table("analytics_user")
+    op.drop_table("analytics_day")
@@ -0,0 +1,50 @@
+"""post autoincrement
+
+Revision ID: f3c17d2b9e54
+Revises: e2a86c5f0d93
+Create Date: 2026-10-19 20:36:18.512947
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "f3c17d2b9e54"
+down_revision = "e2a86c5f0d93"
+branch_labels = None
+depends_on = None
+
+# Past every id a post has had: archived posts and view stats keep theirs.
+LAST_POST_ID = """
+SELECT MAX(id) FROM (
+    SELECT MAX(id) AS id FROM post
+    UNION ALL SELECT MAX(post_id) FROM post_archive
+    UNION ALL SELECT MAX(post_id) FROM post_stats
+) AS ids
+"""
+
+
+def upgrade():
+    # SQLite hands out max(id) + 1, so ids of deleted or archived posts came
+    # back; AUTOINCREMENT makes it remember the highest id ever used.
+    connection = op.get_bind()
+    last = connection.execute(sa.text(LAST_POST_ID)).scalar() or 0
+    if connection.dialect.name == "sqlite":
+        with op.batch_alter_table(
+            "post", recreate="always", table_kwargs={"sqlite_autoincrement": True}
+        ):
+            pass
+        op.execute("DELETE FROM sqlite_sequence WHERE name = 'post'")
+        op.execute(
+            "INSERT INTO sqlite_sequence (name, seq) VALUES ('post', {})".format(last)
+        )
+    elif connection.dialect.name == "mysql":
+        # InnoDB also restarts from max(id) + 1; at least skip archived ids.
+        op.execute("ALTER TABLE post AUTO_INCREMENT = {}".format(last + 1))
+
+
+def downgrade():
+    if op.get_bind().dialect.name == "sqlite":
+        with op.batch_alter_table("post", recreate="always"):
+            pass
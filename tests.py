@@ -1,17 +1,67 @@
+import base64
 from datetime import datetime, timedelta
+from functools import partial
+import json
+import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import time
 import unittest
-from flask_server import flask_server, db
-from flask_server.models import User, Post
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from alembic.util import CommandError
+from jinja2 import ChoiceLoader, DictLoader
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.exc import OperationalError
+from config import Config, _create_secret_key
+from flask_server import (
+    analytics,
+    create_app,
+    db,
+    readmodel,
+    sqlite,
+    startup,
+    tokens,
+    videos,
+)
+from flask_server.avatars import AvatarStore
+from flask_server.bloom import BloomFilter, usernames
+from flask_server.breaker import DatabaseUnavailable
+from flask_server.sharding import reuses_post_ids, shards, upgrade_schema
+from flask_server.archive import archive_posts
+from flask_server.online_migrations import PROGRESS_TABLE
+from flask_server.pagecache import PageCache, SingleFlight
+from flask_server.profiler import Sampler, collapsed, profiler
+from flask_server.models import (
+    AnalyticsDay,
+    AnalyticsUser,
+    User,
+    Post,
+    ArchivedPost,
+    PostStats,
+    Video,
+    followers,
+)
+from flask_server.pubsub import Broker, RedisTransport
+from flask_server.testing import SNAPSHOT_PASSWORD, DatabaseTestCase
+from flask_server.viewcounts import HyperLogLog, author_views, post_views
 
 
-class UserModelCase(unittest.TestCase):
-    def setUp(self):
-        flask_server.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
-        db.create_all()
+class TestConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    AVATAR_CACHE_DIR = tempfile.mkdtemp()
+    AVATAR_OFFLINE = True
+    TEMPLATE_CACHE_DIR = tempfile.mkdtemp()
+    PAGE_CACHE_SECONDS = 0
+    WTF_CSRF_ENABLED = False
 
-    def tearDown(self):
-        db.session.remove()
-        db.drop_all()
+
+class UserModelCase(DatabaseTestCase):
+    config = TestConfig
 
     def test_password_hashing(self):
         u = User(username="susan")
@@ -96,5 +146,1514 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f4, [p4])
 
 
+class BulkDataCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def seed(self):
+        u1 = User(username="john", email="john@example.com", poster=True)
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([u1, u2])
+        db.session.add_all(
+            [Post(url="abc", body="post {}".format(i), author=u1) for i in range(7)]
+        )
+        u2.follow(u1)
+        db.session.commit()
+        # Archived after the hot posts were created, with the next id.
+        db.session.add(ArchivedPost(post_id=8, url="old", author=u1))
+        db.session.add(PostStats(author_id=u1.id, post_id=8, views=3, viewers=b"\0\1"))
+        db.session.commit()
+
+    def round_trip(self, fmt):
+        self.seed()
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(
+            args=["data", "export", self.directory, "--format", fmt, "--batch-size", "3"]
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("post: exported 7 rows", result.output)
+        self.assertIn("post_archive: exported 1 rows", result.output)
+        self.assertIn("post_stats: exported 1 rows", result.output)
+
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        result = runner.invoke(
+            args=["data", "import", self.directory, "--format", fmt, "--batch-size", "3"]
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        john = User.query.filter_by(username="john").first()
+        susan = User.query.filter_by(username="susan").first()
+        self.assertTrue(john.poster)
+        self.assertEqual(john.posts.count(), 7)
+        self.assertIsInstance(john.posts.first().timestamp, datetime)
+        self.assertTrue(susan.is_following(john))
+        self.assertEqual(ArchivedPost.query.one().post_id, 8)
+        self.assertEqual(PostStats.query.one().viewers, b"\0\1")
+        new = Post(url="new", author=john)
+        db.session.add(new)
+        db.session.commit()
+        self.assertGreater(new.id, 8)
+
+    def test_jsonl_round_trip(self):
+        self.round_trip("jsonl")
+
+    def test_csv_round_trip(self):
+        self.round_trip("csv")
+
+    def test_import_resumes_from_checkpoint(self):
+        self.seed()
+        runner = self.app.test_cli_runner()
+        runner.invoke(args=["data", "export", self.directory])
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+        # Pretend the first import died after committing users and 3 posts.
+        db.session.execute(
+            User.__table__.insert(),
+            [
+                {"id": 1, "username": "john", "email": "john@example.com"},
+                {"id": 2, "username": "susan", "email": "susan@example.com"},
+            ],
+        )
+        db.session.execute(
+            Post.__table__.insert(), [{"id": i, "user_id": 1} for i in range(1, 4)]
+        )
+        db.session.commit()
+        with open(os.path.join(self.directory, ".import-checkpoint.json"), "w") as f:
+            f.write('{"user": 2, "post": 3}')
+
+        result = runner.invoke(args=["data", "import", self.directory, "--resume"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(Post.query.count(), 7)
+        self.assertEqual(db.session.query(followers).count(), 1)
+
+
+class AvatarCase(DatabaseTestCase):
+    config = TestConfig
+
+    def setUp(self):
+        super(AvatarCase, self).setUp()
+        self.store = AvatarStore(tempfile.mkdtemp())
+        self.app.extensions["avatars"] = self.store
+        self.user = User(username="john", email="john@example.com")
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        super(AvatarCase, self).tearDown()
+        shutil.rmtree(self.store.directory)
+
+    def url(self, size=128):
+        digest = self.user.avatar_digest()
+        return "/avatar/{}/{}?v={}".format(self.user.id, size, digest)
+
+    def test_fetches_once_per_size(self):
+        calls = []
+
+        def fetcher(user, size):
+            calls.append(size)
+            return b"image-%d" % size, "image/jpeg"
+
+        self.store.fetcher = fetcher
+        client = self.app.test_client()
+        for _ in range(3):
+            response = client.get(self.url(64))
+            self.assertEqual(response.data, b"image-64")
+        client.get(self.url(128))
+        self.assertEqual(calls, [64, 128])
+        self.assertEqual(response.mimetype, "image/jpeg")
+        self.assertIn("immutable", response.headers["Cache-Control"])
+
+        etag = response.headers["ETag"]
+        response = client.get(self.url(64), headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_offline_identicon(self):
+        response = self.app.test_client().get(self.url(32))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "image/png")
+        self.assertEqual(struct.unpack(">II", response.data[16:24]), (32, 32))
+
+    def test_failed_fetch_is_retried(self):
+        def failing(user, size):
+            raise OSError("gravatar is down")
+
+        self.store.fetcher = failing
+        client = self.app.test_client()
+        response = client.get(self.url(64))
+        self.assertEqual(response.mimetype, "image/png")
+        self.assertNotIn("immutable", response.headers["Cache-Control"])
+
+        self.store.fetcher = lambda user, size: (b"real", "image/jpeg")
+        self.assertEqual(client.get(self.url(64)).data, b"real")
+
+    def test_stale_or_unknown_urls(self):
+        client = self.app.test_client()
+        response = client.get("/avatar/{}/128?v=old".format(self.user.id))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(self.user.avatar_digest(), response.location)
+        self.assertEqual(client.get(self.url(100)).status_code, 404)
+
+
+class ShardingCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        class ShardedConfig(TestConfig):
+            SHARD_DATABASE_URIS = [self.shard_uri(i) for i in range(2)]
+
+        self.app = create_app(ShardedConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        shards.create_schema()
+        self.users = [
+            User(username=name, email="{}@example.com".format(name))
+            for name in ("john", "susan", "mary", "david")
+        ]
+        db.session.add_all(self.users)
+        db.session.commit()
+        now = datetime.utcnow()
+        for i, user in enumerate(self.users * 2):
+            session = shards.session_for(user.id)
+            session.add(
+                Post(
+                    user_id=user.id,
+                    url="v{}".format(i),
+                    timestamp=now - timedelta(seconds=8 - i),
+                )
+            )
+            session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def shard_uri(self, i):
+        return "sqlite:///" + os.path.join(self.directory, "shard{}.db".format(i))
+
+    def test_bulk_data_refuses_shards(self):
+        runner = self.app.test_cli_runner()
+        for command in ("export", "import"):
+            result = runner.invoke(args=["data", command, self.directory])
+            self.assertNotEqual(result.exit_code, 0)
+            self.assertIn("SHARD_DATABASE_URIS", result.output)
+
+    def test_upgrade_old_shard(self):
+        engine = shards.engines()[0]
+        # As created before AUTOINCREMENT and `video_id`.
+        columns = "id, url, body, timestamp, user_id"
+        with engine.begin() as connection:
+            connection.execute("ALTER TABLE post RENAME TO post_new")
+            connection.execute(
+                "CREATE TABLE post (id INTEGER NOT NULL PRIMARY KEY, "
+                "url VARCHAR(140), body VARCHAR(140), timestamp DATETIME, "
+                "user_id INTEGER)"
+            )
+            connection.execute(
+                "INSERT INTO post SELECT {0} FROM post_new".format(columns)
+            )
+            connection.execute("DROP TABLE post_new")
+        self.assertTrue(reuses_post_ids(engine))
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=["archive", "run", "--days", 0])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("flask shards upgrade", result.output)
+
+        result = runner.invoke(args=["shards", "upgrade"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("flask videos backfill", result.output)
+        self.assertFalse(reuses_post_ids(engine))
+        inspector = inspect(engine)
+        columns = [column["name"] for column in inspector.get_columns("post")]
+        self.assertIn("video_id", columns)
+        indexes = [index["name"] for index in inspector.get_indexes("post")]
+        self.assertIn("ix_post_video_id", indexes)
+        result = runner.invoke(args=["videos", "backfill"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        result = runner.invoke(args=["archive", "run", "--days", 0])
+        self.assertEqual(result.exit_code, 0, result.output)
+        with engine.begin() as connection:
+            archived = connection.execute("SELECT MAX(post_id) FROM post_archive")
+            last = archived.scalar()
+            connection.execute("INSERT INTO post (url) VALUES ('new')")
+            new = connection.execute("SELECT MAX(id) FROM post").scalar()
+        self.assertGreater(new, last)
+
+    def test_posts_live_on_owner_shard(self):
+        john, susan = self.users[:2]
+        self.assertEqual(Post.query.count(), 0)
+        self.assertNotEqual(shards.index_for(john.id), shards.index_for(susan.id))
+        query = lambda session: session.query(Post).filter_by(user_id=john.id)
+        self.assertEqual(query(shards.session_for(john.id)).count(), 2)
+        self.assertEqual(query(shards.session_for(susan.id)).count(), 0)
+        self.assertEqual(shards.user_posts(john, 1, 10).total, 2)
+
+    def test_discover_merges_shards(self):
+        page = shards.discover(2, 3)
+        self.assertEqual(page.total, 8)
+        self.assertEqual([p.url for p in page.items], ["v4", "v3", "v2"])
+        self.assertEqual(page.items[0].author.username, "john")
+
+    def test_follow_edges_and_feed(self):
+        john, susan, mary, david = self.users
+        shards.follow(john, susan)
+        shards.follow(john, mary)
+        shards.session_for(john.id).commit()
+        self.assertTrue(shards.is_following(john, susan))
+        self.assertFalse(shards.is_following(susan, john))
+        feed = shards.feed(john, 1, 10)
+        urls = [p.url for p in feed.items]
+        self.assertEqual(urls, ["v6", "v5", "v4", "v2", "v1", "v0"])
+
+    def test_routes_use_owning_shard(self):
+        john = self.users[0]
+        john.set_password("cat")
+        john.poster = True
+        db.session.commit()
+        client = self.app.test_client()
+        client.post("/login", data={"username": "john", "password": "cat"})
+        new = "https://youtu.be/dQw4w9WgXcQ"
+        client.post("/create", data={"url": new, "body": "hello"})
+        session = shards.session_for(john.id)
+        post = session.query(Post).filter_by(url=new).one()
+        self.assertEqual(post.video_id, "dQw4w9WgXcQ")
+        self.assertIn(b"hello", client.get("/discover").data)
+        data = {"url": new, "body": "edited"}
+        client.post("/update/{}".format(post.id), data=data)
+        session.expire_all()
+        self.assertEqual(session.query(Post).get(post.id).body, "edited")
+        client.get("/delete/{}".format(post.id))
+        self.assertEqual(shards.user_posts(john, 1, 10).total, 2)
+
+    def test_rebalance(self):
+        john = self.users[0]
+        shards.follow(john, self.users[1])
+        session = shards.session_for(john.id)
+        post = session.query(Post).filter_by(url="v4").one()
+        post.video_id = "dQw4w9WgXcQ"
+        session.add(PostStats(author_id=john.id, post_id=post.id, views=3))
+        old = session.query(Post).filter_by(url="v0").one()
+        session.add(PostStats(author_id=john.id, post_id=old.id, views=5))
+        session.commit()
+        cutoff = old.timestamp + timedelta(milliseconds=1)
+        archive_posts(shards.engines()[shards.index_for(john.id)], cutoff)
+        videos.recount()
+        uris = [self.shard_uri(i) for i in range(1, 4)]
+        runner = self.app.test_cli_runner()
+        # Running it again after it completed must not lose anything.
+        for _ in range(2):
+            result = runner.invoke(args=["shards", "rebalance"] + uris)
+            self.assertEqual(result.exit_code, 0, result.output)
+
+        self.app.config["SHARD_DATABASE_URIS"] = uris
+        shards.init_app(self.app)
+        self.assertEqual(shards.discover(1, 10).total, 7)
+        for user in self.users:
+            self.assertEqual(shards.user_posts(user, 1, 10).total, 2)
+        self.assertTrue(shards.is_following(john, self.users[1]))
+        post = shards.session_for(john.id).query(Post).filter_by(url="v4").one()
+        self.assertEqual(post_views(john.id, post.id)["views"], 3)
+        self.assertEqual(Video.query.get("dQw4w9WgXcQ").last_post_id, post.id)
+        old = shards.session_for(john.id).query(ArchivedPost).one()
+        self.assertEqual(post_views(john.id, old.post_id)["views"], 5)
+
+    def test_rebalance_keeps_rows_on_mismatch(self):
+        john = self.users[0]
+        uris = [self.shard_uri(i) for i in range(1, 4)]
+        # A stray copy of one of john's posts on his new shard.
+        target = create_engine(uris[john.id % 3])
+        upgrade_schema(target)
+        target.execute(Post.__table__.insert(), {"user_id": john.id, "url": "v0"})
+        result = self.app.test_cli_runner().invoke(args=["shards", "rebalance"] + uris)
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("nothing was deleted", result.output)
+        self.assertEqual(shards.user_posts(john, 1, 10).total, 2)
+
+
+class ArchiveCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username="john", email="john@example.com")
+        db.session.add(self.user)
+        now = datetime.utcnow()
+        db.session.add_all(
+            [
+                Post(
+                    url="v{}".format(days),
+                    author=self.user,
+                    timestamp=now - timedelta(days=days),
+                )
+                for days in (1, 2, 30, 40, 50)
+            ]
+        )
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_archive_moves_old_posts(self):
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=["archive", "run", "--days", 10, "--batch-size", 2])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("archived 3 posts", result.output)
+        self.assertIn("after shard 0 post_archive: ", result.output)
+        self.assertEqual(Post.query.count(), 2)
+        self.assertEqual(ArchivedPost.query.count(), 3)
+
+    def test_archived_ids_are_not_reused(self):
+        archive_posts(db.engine, datetime.utcnow())
+        self.assertEqual(Post.query.count(), 0)
+        post = Post(url="new", author=self.user)
+        db.session.add(post)
+        db.session.commit()
+        archived = [p.post_id for p in ArchivedPost.query]
+        self.assertGreater(post.id, max(archived))
+
+    def test_profile_continues_into_archive(self):
+        archive_posts(db.engine, datetime.utcnow() - timedelta(days=10))
+        pages = [shards.user_posts(self.user, page, 2) for page in (1, 2, 3)]
+        self.assertEqual(pages[0].total, 5)
+        self.assertEqual(
+            [[p.url for p in page.items] for page in pages],
+            [["v1", "v2"], ["v30", "v40"], ["v50"]],
+        )
+        self.assertTrue(pages[1].items[0].archived)
+        cards, cursor = readmodel.user_posts_after(self.user, None, 3)
+        more, end = readmodel.user_posts_after(
+            self.user, readmodel.decode_cursor(cursor), 3
+        )
+        urls = [p.url for p in cards + more]
+        self.assertEqual(urls, ["v1", "v2", "v30", "v40", "v50"])
+        self.assertEqual((more[0].archived, end), (True, None))
+        self.assertEqual(pages[2].items[0].author.username, "john")
+        cards = [readmodel.user_posts(self.user, page, 2) for page in (1, 2, 3)]
+        self.assertEqual(
+            [[(p.id, p.archived) for p in page.items] for page in cards],
+            [[(p.id, p.archived) for p in page.items] for page in pages],
+        )
+
+
+class ViewCountCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username="john", email="john@example.com")
+        db.session.add(self.user)
+        db.session.add_all(
+            [Post(url=id, video_id=id, author=self.user) for id in ("a" * 11, "b" * 11)]
+        )
+        db.session.commit()
+        videos.refresh(db.session, ["a" * 11, "b" * 11])
+        self.counter = self.app.extensions["views"]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_hyperloglog(self):
+        sketch, other = HyperLogLog(), HyperLogLog()
+        for i in range(5000):
+            sketch.add("viewer{}".format(i))
+            other.add("viewer{}".format(i + 2500))
+        self.assertAlmostEqual(len(sketch), 5000, delta=500)
+        merged = HyperLogLog.from_bytes(sketch.to_bytes()).merge(other)
+        self.assertAlmostEqual(len(merged), 7500, delta=750)
+
+    def test_views_are_batched(self):
+        client = self.app.test_client()
+        statements = []
+        record = lambda *args: statements.append(args[2])
+        event.listen(db.engine, "before_cursor_execute", record)
+        for _ in range(3):
+            client.get("/discover", environ_base={"REMOTE_ADDR": "10.0.0.1"})
+        client.get("/discover", environ_base={"REMOTE_ADDR": "10.0.0.2"})
+        event.remove(db.engine, "before_cursor_execute", record)
+        self.assertFalse([s for s in statements if "post_stats" in s])
+        self.assertEqual(post_views(self.user.id, 2), {"views": 0, "viewers": 0})
+
+        self.assertEqual(self.counter.flush(), 2)
+        self.assertEqual(post_views(self.user.id, 2), {"views": 4, "viewers": 2})
+        client.get("/discover", environ_base={"REMOTE_ADDR": "10.0.0.3"})
+        self.counter.flush()
+        self.assertEqual(post_views(self.user.id, 1), {"views": 5, "viewers": 3})
+        self.assertEqual(
+            author_views(self.user.id), {"views": 10, "viewers": 3, "posts": 2}
+        )
+        response = client.get("/api/v1/users/john/posts/1/views")
+        self.assertEqual(response.get_json(), {"views": 5, "viewers": 3})
+        response = client.get("/api/v1/users/john/views")
+        self.assertEqual(response.get_json()["views"], 10)
+
+    def test_flush_after_rendering(self):
+        self.counter.interval, user_id = 0, self.user.id
+        statements = []
+        record = lambda *args: statements.append(args[2])
+        event.listen(db.engine, "before_cursor_execute", record)
+        self.counter.record(user_id, 1, "user:1")
+        event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(statements, [])
+
+        self.app.test_client().get("/discover")
+        self.assertEqual(post_views(user_id, 1)["views"], 2)
+
+
+class VideoCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = [
+            User(username=name, email="{}@example.com".format(name), poster=True)
+            for name in ("john", "susan")
+        ]
+        for user in self.users:
+            user.set_password("cat")
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_video_id(self):
+        for url in (
+            "dQw4w9WgXcQ",
+            "dQw4w9WgXcQ&t=42s",
+            " https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PL1 ",
+            "http://m.youtube.com/watch?feature=share&v=dQw4w9WgXcQ",
+            "youtube.com/watch?v=dQw4w9WgXcQ",
+            "https://youtu.be/dQw4w9WgXcQ?t=10",
+            "https://www.youtube.com/embed/dQw4w9WgXcQ",
+            "https://www.youtube.com/shorts/dQw4w9WgXcQ",
+            "https://www.youtube-nocookie.com/embed/dQw4w9WgXcQ?rel=0",
+        ):
+            self.assertEqual(videos.video_id(url), "dQw4w9WgXcQ", url)
+        for url in ("", "new", "https://vimeo.com/dQw4w9WgXcQ", "youtu.be/short"):
+            self.assertIsNone(videos.video_id(url), url)
+
+    def post(self, user, url):
+        client = self.app.test_client()
+        client.post("/login", data={"username": user.username, "password": "cat"})
+        response = client.post("/create", data={"url": url, "body": "look"})
+        self.assertEqual(response.status_code, 302)
+        return client, Post.query.filter_by(user_id=user.id).order_by(Post.id).all()[-1]
+
+    def test_posts_are_grouped_by_video(self):
+        john, susan = self.users
+        self.post(john, "https://youtu.be/dQw4w9WgXcQ")
+        client, post = self.post(susan, "https://www.youtube.com/watch?v=dQw4w9WgXcQ")
+        self.post(susan, "abcdefghijk")
+        video = Video.query.get("dQw4w9WgXcQ")
+        self.assertEqual(video.post_count, 2)
+        self.assertEqual(video.first_poster, john)
+        self.assertEqual(video.last_post_id, post.id)
+
+        page = readmodel.discover(1, 10, collapse=True)
+        self.assertEqual(page.total, 2)
+        self.assertEqual(
+            [(card.video_id, card.author.username) for card in page.items],
+            [("abcdefghijk", "susan"), ("dQw4w9WgXcQ", "susan")],
+        )
+
+        client.get("/delete/{}".format(post.id))
+        video = Video.query.get("dQw4w9WgXcQ")
+        self.assertEqual((video.post_count, video.last_poster_id), (1, john.id))
+
+        client, post = self.post(john, "abcdefghijk")
+        data = {"url": "https://youtu.be/zzzzzzzzzzz", "body": "moved"}
+        client.post("/update/{}".format(post.id), data=data)
+        self.assertEqual(Video.query.get("abcdefghijk").post_count, 1)
+        self.assertEqual(Video.query.get("zzzzzzzzzzz").post_count, 1)
+
+    def test_post_and_video_commit_together(self):
+        def fail(session, post):
+            raise OperationalError("UPDATE video", {}, Exception("locked"))
+
+        post_added = videos.post_added
+        videos.post_added = fail
+        self.addCleanup(setattr, videos, "post_added", post_added)
+        client = self.app.test_client()
+        client.post("/login", data={"username": "john", "password": "cat"})
+        response = client.post("/create", data={"url": "abcdefghijk", "body": "x"})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Post.query.count(), 0)
+
+    def test_rejects_other_links(self):
+        client = self.app.test_client()
+        client.post("/login", data={"username": "john", "password": "cat"})
+        response = client.post("/create", data={"url": "https://vimeo.com/1", "body": "x"})
+        self.assertIn(b"Please enter a YouTube link or video id.", response.data)
+        self.assertEqual(Post.query.count(), 0)
+
+    def test_backfill(self):
+        # Posts may only link to videos that exist, as on PostgreSQL.
+        db.session.execute("PRAGMA foreign_keys = ON")
+        john = self.users[0]
+        db.session.add_all(
+            [
+                Post(url="https://youtu.be/dQw4w9WgXcQ", author=john),
+                Post(url="dQw4w9WgXcQ", author=john),
+                Post(url="not a video", author=john),
+            ]
+        )
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=["videos", "backfill"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("shard 0 post: linked 2 posts", result.output)
+        self.assertEqual(Video.query.one().post_count, 2)
+
+
+class OnlineMigrationCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        self.connection = self.engine.connect()
+        self.connection.execute(
+            "CREATE TABLE item (id INTEGER PRIMARY KEY, url TEXT, video_id TEXT)"
+        )
+        self.connection.execute(
+            "INSERT INTO item (id, url) VALUES (?, ?)",
+            [(i, "https://youtu.be/{:011d}".format(i)) for i in range(1, 26)],
+        )
+        self.op = Operations(MigrationContext.configure(self.connection))
+
+    def tearDown(self):
+        self.connection.close()
+        self.engine.dispose()
+
+    def linked(self):
+        return self.connection.execute(
+            "SELECT count(*) FROM item WHERE video_id IS NOT NULL"
+        ).scalar()
+
+    def test_create_index_online(self):
+        self.op.create_index_online("ix_item_video_id", "item", ["video_id"])
+        indexes = inspect(self.connection).get_indexes("item")
+        self.assertEqual([index["name"] for index in indexes], ["ix_item_video_id"])
+        self.op.drop_index_online("ix_item_video_id", "item")
+        self.assertEqual(inspect(self.connection).get_indexes("item"), [])
+
+    def test_backfill_resumes(self):
+        seen, fail_at = [], [13]
+
+        def link(row):
+            if row.id in fail_at:
+                fail_at.remove(row.id)
+                raise RuntimeError("interrupted")
+            seen.append(row.id)
+            return {"video_id": videos.video_id(row.url)}
+
+        backfill = dict(columns=["url"], where="video_id IS NULL", batch_size=5)
+        with self.assertRaises(RuntimeError):
+            self.op.backfill("item", link, name="link", **backfill)
+        # The first two batches were committed, the third one wasn't.
+        self.assertEqual(self.linked(), 10)
+        self.op.backfill("item", link, name="link", **backfill)
+        self.assertEqual(self.linked(), 25)
+        self.assertEqual(seen, list(range(1, 13)) + list(range(11, 26)))
+        query = "SELECT count(*) FROM {}".format(PROGRESS_TABLE)
+        self.assertEqual(self.connection.execute(query).scalar(), 0)
+
+    def test_backfill_with_sql(self):
+        self.op.backfill("item", {"video_id": "substr(url, 18)"}, batch_size=7)
+        self.assertEqual(self.linked(), 25)
+        self.assertEqual(
+            self.connection.execute("SELECT video_id FROM item WHERE id = 3").scalar(),
+            "00000000003",
+        )
+
+    def test_backfill_needs_connection(self):
+        context = MigrationContext.configure(
+            dialect_name="sqlite", opts={"as_sql": True}
+        )
+        with self.assertRaisesRegex(CommandError, "need a database connection"):
+            Operations(context).backfill("item", {"video_id": "url"})
+
+
+class PageCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def slow(self, calls, result, started=None):
+        def compute():
+            if started is not None:
+                started.set()
+            calls.append(1)
+            time.sleep(0.1)
+            return result
+
+        return compute
+
+    def test_concurrent_misses_are_coalesced(self):
+        page_cache, calls, results = PageCache(60), [], []
+        fetch = lambda: results.append(
+            page_cache.fetch("discover:1", self.slow(calls, "page"))
+        )
+        threads = [threading.Thread(target=fetch) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["page"] * 8)
+        self.assertEqual(page_cache.stats["coalesced"], 7)
+        self.assertEqual(page_cache.fetch("discover:1", list), "page")
+        self.assertEqual(page_cache.stats["hits"], 1)
+
+    def test_errors_reach_every_waiter(self):
+        flight, errors = SingleFlight(), []
+
+        def fail():
+            time.sleep(0.1)
+            raise ValueError("down")
+
+        def call():
+            try:
+                flight.do("key", fail)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(flight.do("key", lambda: "up"), "up")
+
+    def test_workers_share_entries_and_locks(self):
+        # Two caches on one directory behave like two workers on one host.
+        first, second = PageCache(60, self.directory), PageCache(60, self.directory)
+        calls, started = [], threading.Event()
+        thread = threading.Thread(
+            target=first.fetch, args=("user:1:1", self.slow(calls, "a", started))
+        )
+        thread.start()
+        started.wait()
+        self.assertEqual(second.fetch("user:1:1", self.slow(calls, "b")), "a")
+        thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(second.stats["coalesced_across_workers"], 1)
+
+        time.sleep(0.01)
+        first.invalidate()
+        self.assertEqual(second.get("user:1:1"), (False, None))
+
+    def test_directory_is_private(self):
+        directory = os.path.join(self.directory, "cache")
+        PageCache(60, directory)
+        self.assertEqual(os.stat(directory).st_mode & 0o777, 0o700)
+        os.chmod(directory, 0o777)
+        with self.assertRaisesRegex(RuntimeError, "not writable by others"):
+            PageCache(60, directory)
+
+    def test_pages_are_cached(self):
+        class CachingConfig(TestConfig):
+            PAGE_CACHE_SECONDS = 60
+            ADMIN_USERNAMES = ["admin"]
+
+        app = create_app(CachingConfig)
+        with app.app_context():
+            db.create_all()
+            admin = User(username="admin", email="admin@example.com")
+            admin.set_password("cat")
+            db.session.add(admin)
+            db.session.commit()
+            client = app.test_client()
+            for _ in range(3):
+                self.assertEqual(client.get("/discover").status_code, 200)
+            self.assertEqual(client.get("/api/v1/cache").status_code, 404)
+            client.post("/login", data={"username": "admin", "password": "cat"})
+            stats = client.get("/api/v1/cache").get_json()
+            self.assertEqual((stats["misses"], stats["hits"]), (1, 2))
+            db.session.remove()
+            db.drop_all()
+
+
+class BreakerCase(unittest.TestCase):
+    def setUp(self):
+        class BreakerConfig(TestConfig):
+            BREAKER_FAILURES = 2
+            BREAKER_RESET_SECONDS = 60
+
+        self.app = create_app(BreakerConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.breaker = self.app.extensions["breaker"]
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        del self.app.extensions["breaker"]
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def trip(self):
+        for _ in range(self.breaker.failures):
+            self.breaker.failed()
+        self.assertTrue(self.breaker.is_open)
+
+    def test_opens_on_errors_and_slow_statements(self):
+        with self.assertRaises(OperationalError):
+            db.session.execute("SELECT * FROM no_such_table")
+        db.session.rollback()
+        self.assertEqual(self.breaker.state, "closed")
+        db.session.execute("SELECT 1")  # a success resets the count
+        self.breaker.slow_seconds = 0
+        db.session.execute("SELECT 1")
+        db.session.execute("SELECT 1")
+        self.assertEqual(self.breaker.state, "open")
+        with self.assertRaises(DatabaseUnavailable):
+            db.session.execute("SELECT 1")
+
+    def test_serves_stale_pages(self):
+        fresh = self.client.get("/discover")
+        self.assertEqual(fresh.status_code, 200)
+        self.trip()
+        stale = self.client.get("/discover")
+        self.assertEqual(stale.status_code, 200)
+        self.assertIn(b"trouble reaching its database", stale.data)
+        self.assertEqual(stale.headers["Warning"], '110 - "Response is Stale"')
+        # Never rendered before: nothing to fall back on.
+        self.assertEqual(self.client.get("/discover?page=2").status_code, 503)
+
+    def test_writes_fail_fast(self):
+        self.trip()
+        response = self.client.post(
+            "/register",
+            data={
+                "username": "susan",
+                "email": "susan@example.com",
+                "password": "cat",
+                "password2": "cat",
+            },
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertIn(b"nothing was saved", response.data)
+        self.breaker.state = "closed"
+        self.assertIsNone(User.query.filter_by(username="susan").first())
+
+    def test_api_errors_are_json(self):
+        self.trip()
+        response = self.client.get("/api/v1/users/john/views")
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("temporarily unavailable", response.get_json()["error"])
+
+    def test_view_counts_survive_an_outage(self):
+        counter = self.app.extensions["views"]
+        counter.record(1, 1, "user:2")
+        self.trip()
+        with self.assertLogs(self.app.logger, "ERROR"):
+            counter.flush()
+        self.breaker.state = "closed"
+        counter.flush()
+        self.assertEqual(post_views(1, 1)["views"], 1)
+
+    def test_recovers_in_the_background(self):
+        self.trip()
+        self.breaker.reset_seconds = 0
+        self.assertTrue(self.breaker.is_open)  # starts the probe
+        for _ in range(100):
+            if self.breaker.state == "closed":
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.breaker.state, "closed")
+        response = self.client.get("/discover")
+        self.assertNotIn("Warning", response.headers)
+
+
+class AdminConfig(TestConfig):
+    ADMIN_USERNAMES = ["admin"]
+    PROFILE_DIR = tempfile.mkdtemp()
+
+
+class ProfilerCase(DatabaseTestCase):
+    config = AdminConfig
+
+    def setUp(self):
+        super(ProfilerCase, self).setUp()
+        for username in ("admin", "susan"):
+            user = User(username=username, email=username + "@example.com")
+            user.set_password("password")
+            db.session.add(user)
+        db.session.commit()
+
+    def test_profiles_one_request(self):
+        self.login("admin")
+        response = self.client.get("/discover?profile=1")
+        self.assertEqual(response.mimetype, "text/plain")
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertRegex(line, r"^main\.discover;.+ \d+$")
+
+    def test_admins_only(self):
+        self.login("susan")
+        response = self.client.get("/discover", headers={"X-Profile": "1"})
+        self.assertEqual(response.mimetype, "text/html")
+        self.assertEqual(self.client.get("/admin/profiler").status_code, 404)
+
+    def test_profiles_a_window(self):
+        self.login("admin")
+        response = self.client.post("/admin/profiler", data={"seconds": 0.2})
+        self.assertEqual(response.status_code, 202)
+        name = response.get_json()["profile"]
+        self.assertEqual(self.client.post("/admin/profiler").status_code, 409)
+        # Keep a page busy for the whole window, so the sampler can't miss it.
+        deadline = time.monotonic() + 5
+        while profiler().window.running:
+            self.assertLess(time.monotonic(), deadline)
+            self.client.get("/discover")
+        while name not in profiler().profiles():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        response = self.client.get("/admin/profiler/" + name)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("main.discover;", response.get_data(as_text=True))
+
+    def test_form_needs_csrf_token(self):
+        self.login("admin")
+        self.app.config["WTF_CSRF_ENABLED"] = True
+        self.addCleanup(self.app.config.__setitem__, "WTF_CSRF_ENABLED", False)
+        response = self.client.post("/admin/profiler", data={"seconds": 0.01})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("csrf_token", response.get_json()["fields"])
+
+        html = {"Accept": "text/html"}
+        page_text = self.client.get("/admin/profiler", headers=html).get_data(True)
+        token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page_text)
+        data = {"seconds": 0.01, "csrf_token": token.group(1)}
+        response = self.client.post("/admin/profiler", data=data, headers=html)
+        self.assertEqual(response.status_code, 302)
+        # Wait for its (empty) profile and remove it.
+        deadline = time.monotonic() + 5
+        while not profiler().profiles():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        for name in profiler().profiles():
+            os.remove(os.path.join(self.app.config["PROFILE_DIR"], name))
+
+    def test_sampler(self):
+        sampler = Sampler(interval=0.001, max_depth=3)
+        sampler.threads[threading.get_ident()] = "root"
+        sampler.start(0.05)
+        deadline = time.monotonic() + 0.05
+        while time.monotonic() < deadline:
+            pass
+        samples = sampler.stop()
+        self.assertTrue(samples)
+        for stack in samples:
+            self.assertTrue(stack.startswith("root;"))
+            self.assertEqual(stack.count(";"), 3)
+        self.assertIn(" ", collapsed(samples).splitlines()[0])
+
+
+class SqliteCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        class WalConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(
+                self.directory, "app.db"
+            )
+            SQLITE_WAL = True
+
+        self.app = create_app(WalConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        sqlite.dispose(self.app)
+        db.get_engine(self.app).dispose()
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def test_pragmas(self):
+        pragma = lambda name: db.session.execute("PRAGMA " + name).scalar()
+        self.assertEqual(pragma("journal_mode"), "wal")
+        self.assertEqual(pragma("synchronous"), 1)  # NORMAL
+        self.assertEqual(pragma("busy_timeout"), 5000)
+        self.assertEqual(sqlite.reader().execute("PRAGMA query_only").scalar(), 1)
+
+    def test_reads_use_the_reader_pool(self):
+        with self.assertRaises(OperationalError):
+            sqlite.reader().execute("DELETE FROM user")
+        sqlite.reader().rollback()
+        john = User(username="john", email="john@example.com")
+        db.session.add(john)
+        db.session.commit()
+        db.session.add(Post(url="dQw4w9WgXcQ", video_id="dQw4w9WgXcQ", author=john))
+        db.session.commit()
+        self.assertIsNot(shards.read_sessions()[0], db.session)
+        self.assertEqual(readmodel.discover(1, 10).total, 1)
+
+    def test_bench_command(self):
+        result = self.app.test_cli_runner().invoke(
+            args=["bench", "sqlite", "--workers", 2, "--seconds", 0.3]
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertRegex(result.output, r"\nwal +\d+")
+
+
+class AnalyticsCase(DatabaseTestCase):
+    config = AdminConfig
+    snapshot = "small"
+
+    def summaries(self):
+        return (
+            [(d.day, d.posts) for d in AnalyticsDay.query.order_by(AnalyticsDay.day)],
+            [
+                (u.user_id, u.posts, u.followers)
+                for u in AnalyticsUser.query.order_by(AnalyticsUser.user_id)
+            ],
+        )
+
+    def test_refresh_is_incremental(self):
+        self.assertEqual(analytics.refresh(chunk_size=3), Post.query.count())
+        days, users = self.summaries()
+        self.assertEqual(sum(posts for day, posts in days), Post.query.count())
+        user = User.query.get(3)
+        self.assertIn((user.id, user.posts.count(), user.followers.count()), users)
+        self.assertEqual(analytics.refresh(), 0)
+        self.assertEqual(self.summaries(), (days, users))
+
+        db.session.add(Post(url="new", author=user))
+        user.follow(User.query.get(4))
+        db.session.commit()
+        self.assertEqual(analytics.refresh(chunk_size=3), 1)
+        incremental = self.summaries()
+        self.assertEqual(incremental[0][-1][1], 1)
+        analytics.clear()
+        analytics.refresh()
+        self.assertEqual(self.summaries(), incremental)
+        self.assertEqual(analytics.refresh(rebuild=True), Post.query.count())
+        self.assertEqual(self.summaries(), incremental)
+
+    def test_refresh_after_newest_posts_go(self):
+        analytics.refresh()
+        total = Post.query.count()
+        newest, archived = Post.query.order_by(Post.id.desc()).limit(2).all()
+        db.session.delete(newest)
+        columns = ["url", "body", "timestamp", "user_id", "video_id"]
+        moved = {name: getattr(archived, name) for name in columns}
+        db.session.add(ArchivedPost(post_id=archived.id, **moved))
+        db.session.delete(archived)
+        db.session.commit()
+        user = User.query.get(3)
+        db.session.add(Post(url="new", author=user))
+        db.session.commit()
+        # The new post gets an id the summaries haven't seen, so it counts.
+        self.assertEqual(analytics.refresh(), 1)
+        days, users = self.summaries()
+        self.assertEqual(sum(posts for day, posts in days), total + 1)
+
+    def test_reports(self):
+        analytics.refresh()
+        self.assertEqual(analytics.posts_per_day(7).sum(), 0)
+        self.assertEqual(
+            analytics.follower_growth(1).sum(),
+            db.session.query(followers).count(),
+        )
+        top = analytics.top_posters(3)
+        self.assertEqual(len(top), 3)
+        self.assertTrue(top["followers"].is_monotonic_decreasing)
+        self.assertEqual(top["growth"].tolist(), [0, 0, 0])
+        result = self.app.test_cli_runner().invoke(
+            args=["analytics", "report", "--days", 3]
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Top posters", result.output)
+
+    def test_admin_page(self):
+        admin = User(username="admin", email="admin@example.com")
+        admin.set_password("password")
+        db.session.add(admin)
+        db.session.commit()
+        self.assertEqual(self.client.get("/admin/analytics").status_code, 404)
+        self.login("admin")
+        self.assertIn(b"Not refreshed yet", self.client.get("/admin/analytics").data)
+        self.assertEqual(self.client.post("/admin/analytics").status_code, 405)
+        analytics.refresh()
+        response = self.client.get("/admin/analytics")
+        self.assertIn(b"As of", response.data)
+        self.assertIn(User.query.get(1).username.encode(), response.data)
+        for days in ("0", "-5", "100000"):
+            response = self.client.get("/admin/analytics?days=" + days)
+            self.assertEqual(response.status_code, 200)
+
+
+class TokenCase(DatabaseTestCase):
+    config = TestConfig
+    snapshot = "small"
+
+    def setUp(self):
+        super().setUp()
+        # Versions cached by an earlier test outlive its rolled back revocation.
+        tokens.init_app(self.app)
+
+    def token(self, username, scope="read"):
+        credentials = base64.b64encode(
+            "{}:{}".format(username, SNAPSHOT_PASSWORD).encode("utf-8")
+        )
+        response = self.client.post(
+            "/api/v1/tokens",
+            data={"scope": scope},
+            headers={"Authorization": "Basic " + credentials.decode("ascii")},
+        )
+        self.assertEqual(response.status_code, 200, response.get_data())
+        return {"Authorization": "Bearer " + response.get_json()["token"]}
+
+    def test_token_requests_skip_user_loading(self):
+        user = User.query.get(3)
+        last_seen = user.last_seen
+        headers = self.token(user.username)
+        client = self.app.test_client()
+        client.get("/api/v1/feed", headers=headers)
+        with self.assertMaxQueries(2) as statements:
+            response = client.get("/api/v1/feed", headers=headers)
+        self.assertEqual(response.status_code, 200, response.get_data())
+        self.assertNotIn("password_hash", "".join(statements))
+        self.assertNotIn("token_version", "".join(statements))
+        page = response.get_json()
+        self.assertEqual(
+            [post["id"] for post in page["posts"]],
+            [card.post_id for card in readmodel.feed(user, 1, 10).items],
+        )
+        self.assertIsNotNone(page["next_cursor"])
+        more = client.get("/api/v1/feed?cursor=" + page["next_cursor"], headers=headers)
+        self.assertEqual(more.status_code, 200)
+        self.assertEqual(User.query.get(3).last_seen, last_seen)
+
+    def test_rejected_tokens(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get("/api/v1/feed").status_code, 401)
+        response = client.get("/api/v1/feed", headers={"Authorization": "Bearer x"})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.get_json(), {"error": "The token is invalid."})
+        response = client.post(
+            "/api/v1/tokens", headers={"Authorization": "Basic am9objpub3Bl"}
+        )
+        self.assertEqual(response.status_code, 401)
+        seconds = self.app.config["API_TOKEN_SECONDS"]
+        self.addCleanup(self.app.config.__setitem__, "API_TOKEN_SECONDS", seconds)
+        self.app.config["API_TOKEN_SECONDS"] = -1
+        expired = self.token(User.query.get(2).username)
+        response = client.get("/api/v1/feed", headers=expired)
+        self.assertEqual(response.get_json(), {"error": "The token has expired."})
+
+    def test_revoke(self):
+        username = User.query.get(3).username
+        read, write = self.token(username), self.token(username, "read write")
+        client = self.app.test_client()
+        response = client.delete("/api/v1/tokens", headers=read)
+        self.assertEqual(response.status_code, 403)
+        response = client.delete("/api/v1/tokens", headers=write)
+        self.assertEqual(response.status_code, 204)
+        for headers in (read, write):
+            response = client.get("/api/v1/feed", headers=headers)
+            self.assertEqual(response.status_code, 401)
+            self.assertIn("revoked", response.get_json()["error"])
+        fresh = self.token(username)
+        self.assertEqual(client.get("/api/v1/feed", headers=fresh).status_code, 200)
+
+    def test_revoke_after_user_is_deleted(self):
+        user = User.query.get(3)
+        write = self.token(user.username, "read write")
+        client = self.app.test_client()
+        self.assertEqual(client.get("/api/v1/feed", headers=write).status_code, 200)
+        db.session.delete(user)
+        db.session.commit()
+        response = client.delete("/api/v1/tokens", headers=write)
+        self.assertEqual(response.status_code, 401)
+        self.assertIn("no longer exists", response.get_json()["error"])
+
+
+class PubSubCase(unittest.TestCase):
+    def test_delivers_by_topic(self):
+        broker = Broker(buffer_size=10)
+        followers_of_1 = broker.subscribe([1, 2])
+        followers_of_3 = broker.subscribe([3])
+        broker.publish(1, "a")
+        broker.publish(3, "b")
+        self.assertEqual(followers_of_1.get(0), (["a"], 0))
+        self.assertEqual(followers_of_3.get(0), (["b"], 0))
+        self.assertEqual(followers_of_1.get(0), ([], 0))
+
+        broker.unsubscribe(followers_of_1)
+        broker.unsubscribe(followers_of_3)
+        self.assertEqual(broker.subscriber_count(), 0)
+        self.assertEqual(broker._topics, {})
+
+    def test_buffer_is_bounded(self):
+        broker = Broker(buffer_size=3)
+        subscription = broker.subscribe([1])
+        for i in range(5):
+            broker.publish(1, i)
+        self.assertEqual(subscription.get(0), ([2, 3, 4], 2))
+
+    def test_redis_listener_reconnects(self):
+        received = []
+        done = threading.Event()
+
+        class PubSub(object):
+            def __init__(self, items):
+                self.items = items
+
+            def subscribe(self, channel):
+                pass
+
+            def listen(self):
+                for item in self.items:
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+                threading.Event().wait()
+
+            def close(self):
+                pass
+
+        message = {"data": json.dumps({"topic": 1, "message": "a"})}
+        connections = iter([PubSub([ConnectionError("gone")]), PubSub([message])])
+
+        class Redis(object):
+            def pubsub(self, ignore_subscribe_messages):
+                return next(connections)
+
+        transport = RedisTransport.__new__(RedisTransport)
+        transport.min_backoff = 0
+        transport.redis = Redis()
+
+        def deliver(topic, message):
+            received.append((topic, message))
+            done.set()
+
+        with self.assertLogs("flask_server.pubsub", "ERROR"):
+            transport.start(deliver)
+            self.assertTrue(done.wait(5))
+        self.assertEqual(received, [(1, "a")])
+
+    def test_stream_endpoint(self):
+        class StreamConfig(TestConfig):
+            SSE_HEARTBEAT_SECONDS = 0.01
+
+        app = create_app(StreamConfig)
+        with app.app_context():
+            db.create_all()
+            john = User(username="john", email="john@example.com")
+            susan = User(username="susan", email="susan@example.com")
+            john.set_password("cat")
+            db.session.add_all([john, susan])
+            john.follow(susan)
+            db.session.commit()
+            client = app.test_client()
+            client.post("/login", data={"username": "john", "password": "cat"})
+            response = client.get("/stream", buffered=False)
+            self.assertEqual(response.mimetype, "text/event-stream")
+            events = iter(response.response)
+            self.assertEqual(next(events), b"retry: 5000\n\n")
+            self.assertEqual(next(events), b": heartbeat\n\n")
+            app.extensions["pubsub"].publish(susan.id, {"post_id": 7})
+            self.assertEqual(next(events), b'event: post\ndata: {"post_id": 7}\n\n')
+            response.close()
+            self.assertEqual(app.extensions["pubsub"].subscriber_count(), 0)
+            db.drop_all()
+
+
+class UsernameAvailabilityCase(DatabaseTestCase):
+    config = TestConfig
+
+    def setUp(self):
+        super(UsernameAvailabilityCase, self).setUp()
+        db.session.add(User(username="john", email="john@example.com"))
+        db.session.commit()
+        # In-memory SQLite is per thread, so build here rather than in the
+        # background thread a stale filter would start.
+        self.index = usernames()
+        self.index.build(self.connection)
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add("user{}".format(i))
+        self.assertTrue(all("user{}".format(i) in bloom for i in range(1000)))
+        false_positives = sum("other{}".format(i) in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_free_name_skips_database(self):
+        with self.assertMaxQueries(0):
+            response = self.client.get("/api/v1/username-available?username=mary")
+        self.assertEqual(response.get_json(), {"username": "mary", "available": True})
+
+    def test_taken_names(self):
+        response = self.client.get("/api/v1/username-available?username=john")
+        self.assertFalse(response.get_json()["available"])
+        response = self.client.get("/api/v1/username-available?email=john@example.com")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get("/api/v1/username-available")
+        self.assertEqual(response.status_code, 400)
+
+    def test_answers_from_database_during_rebuild(self):
+        self.index.filter, self.index._building = None, True
+        self.addCleanup(setattr, self.index, "_building", False)
+        with self.assertMaxQueries(1):
+            response = self.client.get("/api/v1/username-available?username=john")
+        self.assertFalse(response.get_json()["available"])
+        response = self.client.get("/api/v1/username-available?username=mary")
+        self.assertTrue(response.get_json()["available"])
+
+        # Names registered while the table was being read make it in.
+        self.index.add(User(username="mary"))
+        self.index.build(self.connection)
+        self.assertIn("mary", self.index.filter)
+
+    def test_rename_to_taken_name(self):
+        susan = User(username="susan", email="susan@example.com")
+        susan.set_password("cat")
+        db.session.add(susan)
+        db.session.commit()
+        self.index.add(susan)
+        self.login("susan", "cat")
+        data = {"username": "john", "about_me": ""}
+        response = self.client.post("/edit_profile", data=data)
+        self.assertIn(b"Please use a different username.", response.data)
+        response = self.client.post("/edit_profile", data=dict(data, username="sue"))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn("sue", self.index.filter)
+
+    def test_registration_relies_on_unique_index(self):
+        data = {"email": "j@example.com", "password": "cat", "password2": "cat"}
+        response = self.client.post("/register", data=dict(data, username="john"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"Please use a different username.", response.data)
+        self.assertEqual(User.query.count(), 1)
+
+        response = self.client.post("/register", data=dict(data, username="susan"))
+        self.assertEqual(response.status_code, 302)
+        response = self.client.get("/api/v1/username-available?username=susan")
+        self.assertFalse(response.get_json()["available"])
+
+
+# Statements per page view, including loading the user and updating last_seen.
+QUERY_BUDGETS = {
+    "/discover": 5,
+    "/feed": 4,
+    "/user/user2": 8,
+    "/user/user2/following": 5,
+}
+
+
+class PerformanceCase(DatabaseTestCase):
+    config = TestConfig
+    snapshot = "medium"
+
+    def setUp(self):
+        super(PerformanceCase, self).setUp()
+        self.login("user1")
+
+    def test_snapshot_is_loaded(self):
+        self.assertEqual(User.query.count(), 200)
+        self.assertEqual(Post.query.count(), 4000)
+
+    def test_changes_are_rolled_back(self):
+        db.session.add(User(username="john", email="john@example.com"))
+        db.session.commit()
+        self.tearDown()
+        self.setUp()
+        self.assertIsNone(User.query.filter_by(username="john").first())
+
+    def test_query_counts(self):
+        for url in QUERY_BUDGETS:
+            db.session.remove()  # a fresh session, as in a real request
+            with self.assertMaxQueries(QUERY_BUDGETS[url]):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+
+    def test_latency(self):
+        self.assertFasterThan(0.1, lambda: self.client.get("/discover"))
+        self.assertFasterThan(0.1, lambda: self.client.get("/feed"))
+
+
+class ReadModelCase(DatabaseTestCase):
+    config = TestConfig
+    snapshot = "small"
+
+    def fields(self, posts):
+        return [
+            (p.id, p.url, p.body, p.timestamp, p.archived, p.author.username)
+            for p in posts.items
+        ]
+
+    def test_matches_orm_pages(self):
+        user = User.query.get(3)
+        for page in (1, 2, 5):
+            pairs = [
+                (shards.discover(page, 4), readmodel.discover(page, 4)),
+                (shards.feed(user, page, 4), readmodel.feed(user, page, 4)),
+                (shards.user_posts(user, page, 4), readmodel.user_posts(user, page, 4)),
+            ]
+            for orm, core in pairs:
+                self.assertEqual(self.fields(core), self.fields(orm))
+                self.assertEqual(core.total, orm.total)
+        self.assertEqual(
+            [author.id for author in readmodel.followed_users(user)],
+            [u.id for u in user.followed.order_by(User.username)],
+        )
+
+    def test_collapsed_discover(self):
+        page = readmodel.discover(1, 50, collapse=True)
+        self.assertEqual(page.total, Video.query.filter(Video.post_count > 0).count())
+        ids = [card.video_id for card in page.items]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertLess(page.total, Post.query.count())
+
+    def walk(self, after, limit=3):
+        cards, cursor = after(None, limit)
+        while cursor is not None:
+            more, cursor = after(readmodel.decode_cursor(cursor), limit)
+            self.assertLessEqual(len(more), limit)
+            cards += more
+        return cards
+
+    def test_cursors_continue_pages(self):
+        user = User.query.get(3)
+        pairs = [
+            (readmodel.discover(1, 1000), readmodel.discover_after),
+            (readmodel.feed(user, 1, 1000), partial(readmodel.feed_after, user)),
+            (
+                readmodel.user_posts(user, 1, 1000),
+                partial(readmodel.user_posts_after, user),
+            ),
+        ]
+        for page, after in pairs:
+            self.assertEqual(self.walk(after), page.items)
+        collapsed = self.walk(partial(readmodel.discover_after, collapse=True))
+        self.assertEqual(collapsed, readmodel.discover(1, 1000, collapse=True).items)
+        unknown = readmodel.encode_cursor("x", datetime.utcnow(), 1)
+        for cursor in ("", "abc", "bm90IGpzb24=", unknown):
+            self.assertRaises(ValueError, readmodel.decode_cursor, cursor)
+        cold = readmodel.encode_cursor(readmodel.COLD_KIND, datetime.utcnow(), 1)
+        self.assertRaises(
+            ValueError, readmodel.decode_cursor, cold, (readmodel.HOT_KIND,)
+        )
+
+    def test_card_fragments(self):
+        user = User.query.get(3)
+        self.login(user.username)
+        for url in ("/discover", "/feed", "/user/" + user.username):
+            page = self.client.get(url).get_data(as_text=True)
+            cursor = re.search(r'data-cursor="([^"]+)"', page).group(1)
+            response = self.client.get(url + "/cards?cursor=" + cursor)
+            self.assertEqual(response.status_code, 200)
+            fragment = response.get_data(as_text=True)
+            self.assertNotIn("<html", fragment)
+            self.assertIn('class="card m-2"', fragment)
+            if url == "/discover":
+                self.assertIn("X-Next-Cursor", response.headers)
+        response = self.client.get("/feed/cards?cursor=garbage")
+        self.assertEqual(response.status_code, 400)
+        # A cursor from another kind of list is rejected, not compared.
+        video = readmodel.encode_cursor(readmodel.VIDEO_KIND, datetime.utcnow(), "a")
+        for url in ("/feed", "/user/" + user.username):
+            response = self.client.get(url + "/cards?cursor=" + video)
+            self.assertEqual(response.status_code, 400)
+
+    def test_cards_have_no_instance_dict(self):
+        card = readmodel.discover(1, 1).items[0]
+        self.assertFalse(hasattr(card, "__dict__"))
+        self.assertFalse(hasattr(card.author, "__dict__"))
+
+    def test_bench_command(self):
+        result = self.app.test_cli_runner().invoke(
+            args=["bench", "pages", "--repeat", 1]
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("discover", result.output)
+
+
+class StartupCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+
+    def test_secret_key_is_stable(self):
+        self.assertEqual(self.app.secret_key, create_app(TestConfig).secret_key)
+
+    def test_secret_key_file_is_private(self):
+        path = os.path.join(tempfile.mkdtemp(), ".secret_key")
+        _create_secret_key(path)
+        with open(path) as f:
+            key = f.read()
+        _create_secret_key(path)
+        with open(path) as f:
+            self.assertEqual(f.read(), key)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        self.assertEqual(os.listdir(os.path.dirname(path)), [".secret_key"])
+
+    def test_warmup_compiles_templates(self):
+        self.assertGreater(self.app.extensions["startup"]["warmup"], 0)
+        self.assertGreaterEqual(
+            len(self.app.jinja_env.cache), len(self.app.jinja_env.list_templates())
+        )
+
+    def test_templates_compile(self):
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=["templates", "compile", "--clear"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        names = self.app.jinja_env.list_templates()
+        self.assertEqual(len(os.listdir(TestConfig.TEMPLATE_CACHE_DIR)), len(names))
+        self.assertIn("{} templates".format(len(names)), result.output)
+
+    def test_warmup_fails_on_syntax_errors(self):
+        broken = DictLoader({"broken.html": "{% if %}"})
+        self.app.jinja_env.loader = ChoiceLoader([self.app.jinja_loader, broken])
+        self.app.jinja_env.cache.clear()
+        with self.assertRaisesRegex(RuntimeError, "broken.html:1"):
+            startup.warmup(self.app)
+
+    def test_bench_templates(self):
+        result = self.app.test_cli_runner().invoke(
+            args=["bench", "templates", "--repeat", 1]
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("bytecode", result.output)
+
+    def test_startup_report(self):
+        result = self.app.test_cli_runner().invoke(
+            args=["startup-report", "--workers", "1"]
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("create_app:", result.output)
+        self.assertIn("worker 1:", result.output)
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)